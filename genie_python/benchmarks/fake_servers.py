@@ -0,0 +1,173 @@
+import base64
+import io
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    '''
+    OpenAI-compatible chat completions endpoint (as served by Ollama under /v1).
+    Scene splitting requests are answered with a location change after every SCENE_EVERY paragraphs,
+    batched prompt requests with a JSON object holding one prompt per scene,
+    all other requests with an image prompt of PROMPT_WORDS words.
+    Split answers are followed by SPLIT_EXTRA_WORDS words of explanation, like a talkative reasoning model.
+    Every word of an answer takes TOKEN_LATENCY seconds; with "stream": true the words are sent as server-sent events.
+    '''
+    LATENCY = 0.05
+    TOKEN_LATENCY = 0.0
+    PROMPT_WORDS = 40
+    SCENE_EVERY = 4
+    SPLIT_EXTRA_WORDS = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        messages = body.get("messages", [])
+        system = next((m["content"] for m in messages if m["role"] == "system"), "")
+        user = next((m["content"] for m in messages if m["role"] == "user"), "")
+
+        time.sleep(self.LATENCY)
+
+        if "location change" in system:
+            num_paragraphs = len(re.split(r'\n\s*\n', user))
+            content = json.dumps(list(range(self.SCENE_EVERY - 1, num_paragraphs, self.SCENE_EVERY)))
+            content += "".join(f" word{i}" for i in range(self.SPLIT_EXTRA_WORDS))
+        elif '"prompts"' in system:
+            scenes = re.findall(r"^### Scene (\d+)$", user, re.MULTILINE)
+            prompt = " ".join(["panorama"] * self.PROMPT_WORDS)
+            content = json.dumps({"prompts": [{"scene": int(n), "prompt": prompt} for n in scenes]})
+        else:
+            content = " ".join(["panorama"] * self.PROMPT_WORDS)
+
+        prompt_tokens = (len(system) + len(user)) // 4
+        completion_tokens = max(1, len(content) // 4)
+
+        if body.get("stream"):
+            self._stream(body, re.findall(r"\S+\s*", content), prompt_tokens, completion_tokens)
+            return
+
+        time.sleep(self.TOKEN_LATENCY * len(content.split()))
+        _send_json(self, {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "benchmark"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+
+    def _stream(self, body: dict, pieces: list[str], prompt_tokens: int, completion_tokens: int):
+        def event(choices: list, usage: dict | None = None) -> bytes:
+            chunk = {"id": "chatcmpl-benchmark", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "benchmark"), "choices": choices}
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        try:
+            for piece in pieces:
+                time.sleep(self.TOKEN_LATENCY)
+                self.wfile.write(event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}]))
+                self.wfile.flush()
+            self.wfile.write(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+            if body.get("stream_options", {}).get("include_usage"):
+                self.wfile.write(event([], {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                            "total_tokens": prompt_tokens + completion_tokens}))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client hat den Stream vorzeitig geschlossen
+
+
+class FakeWebUIHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in for the AUTOMATIC1111 API: txt2img (incl. the batch script), extra-single-image, extra-batch-images
+    and the progress endpoint used for health checks. LATENCY is spent per upscaled image and per generated image
+    at 50 steps (proportionally less for preview renders with fewer steps).
+    '''
+    LATENCY = 0.2
+    IMAGE_SIZE = (512, 256)
+    UPSCALE_FACTOR = 2
+
+    _images = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        _send_json(self, {"progress": 0.0, "state": {}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        width, height = self.IMAGE_SIZE
+        big = (width * self.UPSCALE_FACTOR, height * self.UPSCALE_FACTOR)
+
+        if self.path.endswith("/txt2img"):
+            count = len(body["script_args"][-1].split("\n")) if body.get("script_name") else 1
+            time.sleep(self.LATENCY * count * body.get("steps", 50) / 50)
+            images = [self._image((width, height))] * count
+            if count > 1:
+                images = [self._image((width, height))] + images  # Grid wie in A1111
+            _send_json(self, {"images": images})
+        elif self.path.endswith("/extra-single-image"):
+            time.sleep(self.LATENCY)
+            _send_json(self, {"image": self._image(big)})
+        elif self.path.endswith("/extra-batch-images"):
+            count = len(body["imageList"])
+            time.sleep(self.LATENCY * count)
+            _send_json(self, {"images": [self._image(big)] * count})
+        else:
+            self.send_error(404)
+
+    @classmethod
+    def _image(cls, size: tuple[int, int]) -> str:
+        # Rauschen, damit die PNG-Größe der eines echten Bildes nahekommt; einmal pro Größe erzeugen
+        if size not in cls._images:
+            rng = np.random.default_rng(0)
+            pixels = rng.integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+            buffer = io.BytesIO()
+            Image.fromarray(pixels).save(buffer, "PNG")
+            cls._images[size] = base64.b64encode(buffer.getvalue()).decode("ascii")
+        return cls._images[size]
+
+
+def serve(kind: str, port: int, options: dict):
+    '''
+    Runs a fake server until the process is terminated
+
+    :param kind: "openai" or "webui"
+    :type kind: str
+    :param port: port on 127.0.0.1
+    :type port: int
+    :param options: class attributes of the handler to override, e.g. {"LATENCY": 0.1}
+    :type options: dict
+    '''
+    handler = {"openai": FakeOpenAIHandler, "webui": FakeWebUIHandler}[kind]
+    for name, value in options.items():
+        setattr(handler, name, value)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def _send_json(handler: BaseHTTPRequestHandler, data: dict):
+    payload = json.dumps(data).encode("utf-8")
+    handler.send_response(200)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(payload)))
+    handler.end_headers()
+    handler.wfile.write(payload)
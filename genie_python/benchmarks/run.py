@@ -0,0 +1,258 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import config
+
+from benchmarks import fake_servers as FS
+
+WORDS = ("der", "alte", "Turm", "stand", "am", "Rand", "des", "Waldes", "und", "the", "river", "wound",
+         "through", "a", "quiet", "valley", "Nebel", "lag", "über", "den", "Feldern")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the generation pipeline and the content server")
+    parser.add_argument("--scenes", type=int, default=24, help="number of scenes in the generated book")
+    parser.add_argument("--paragraph-words", type=int, default=80, help="words per paragraph")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds per LLM response")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per LLM output word")
+    parser.add_argument("--split-extra-words", type=int, default=0, help="words the LLM writes after the split array")
+    parser.add_argument("--no-streaming", action="store_true", help="read split answers without streaming")
+    parser.add_argument("--prompt-words", type=int, default=40, help="words per generated image prompt")
+    parser.add_argument("--sd-latency", type=float, default=0.2, help="seconds per generated or upscaled image")
+    parser.add_argument("--no-preview", action="store_true", help="render final panoramas right away, without preview pass")
+    parser.add_argument("--sd-backends", type=int, default=1, help="number of fake WebUI instances")
+    parser.add_argument("--image-size", default="512x256", help="txt2img output size, upscaled 2x")
+    parser.add_argument("--book-store", choices=("json", "sqlite"), default=config.BOOK_STORE, help="storage of the book data")
+    parser.add_argument("--prompt-batch", type=int, default=config.PROMPT_BATCH_MAX_SCENES, help="maximum scenes per prompt request")
+    parser.add_argument("--requests", type=int, default=200, help="requests per server endpoint")
+    parser.add_argument("--json", type=Path, help="write the results to this file")
+    parser.add_argument("--baseline", type=Path, help="results of an earlier run; fail if a stage got slower")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput loss against the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the benchmarked code")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    workdir = Path(tempfile.mkdtemp(prefix="genie-benchmark-"))
+
+    # --- Fake servers in separate processes, so they neither share the GIL nor count towards the memory peak ---
+    ctx = multiprocessing.get_context("spawn")
+    servers = []
+    llm_port = _free_port()
+    servers.append(ctx.Process(target=FS.serve, daemon=True, args=("openai", llm_port, {
+        "LATENCY": args.llm_latency, "TOKEN_LATENCY": args.token_latency, "PROMPT_WORDS": args.prompt_words,
+        "SCENE_EVERY": 4, "SPLIT_EXTRA_WORDS": args.split_extra_words})))
+    sd_ports = [_free_port() for _ in range(args.sd_backends)]
+    for port in sd_ports:
+        servers.append(ctx.Process(target=FS.serve, daemon=True, args=("webui", port, {
+            "LATENCY": args.sd_latency, "IMAGE_SIZE": (width, height), "UPSCALE_FACTOR": 2})))
+    for server in servers:
+        server.start()
+    for port in [llm_port] + sd_ports:
+        _wait_for_port(port)
+
+    # --- Configuration has to be set before the modules are imported (they read it at import time) ---
+    config.USE_OPENAI_API = False
+    config.OLLAMA_BASE_URL = f"http://127.0.0.1:{llm_port}/v1"
+    config.SD_TXT2IMG_BACKENDS = [f"http://127.0.0.1:{port}" for port in sd_ports]
+    config.SD_UPSCALE_BACKENDS = []
+    config.DATABASE_DIRECTORY = str(workdir / "database")
+    config.BOOK_STORE = args.book_store
+    config.BOOK_STORE_SQLITE_FILE = str(workdir / "books.sqlite3")
+    config.DERIVATIVE_DIRECTORY = str(workdir / "derivatives")
+    config.LLM_CACHE_DIRECTORY = str(workdir / "cache")
+    config.LLM_CACHE_BYPASS = True
+    config.PROMPT_BATCH_MAX_SCENES = args.prompt_batch
+    config.SPLIT_STREAMING = not args.no_streaming
+    config.PANORAMA_PREVIEW = not args.no_preview
+    config.REPORT_DIRECTORY = str(workdir / "reports")
+    config.SEARCH_INDEX_FILE = str(workdir / "search.sqlite3")
+    config.JOBS_DIRECTORY = str(workdir / "jobs")
+
+    import generate_vrbook as GV
+    from modules import panorama_generator as PG
+    from modules import scene_deconstructor as SD
+
+    book_path = workdir / "benchmark_book.txt"
+    _write_book(book_path, args.scenes * 4, args.paragraph_words)
+
+    tracemalloc.start()
+    results = []
+    output = None if args.verbose else io.StringIO()
+
+    try:
+        with contextlib.redirect_stdout(output) if output is not None else contextlib.nullcontext():
+            # --- Generation stages ---
+            splitter = SD.SceneSplitterGPT()
+            scenes = []
+            def split():
+                scenes.extend(splitter.split_book(str(book_path)))
+                return len(scenes)
+            with _timed(splitter, "_call_openai") as samples:
+                results.append(_measure("split_book", split, samples))
+
+            prompter = SD.PromptGeneratorGPT()
+            with _timed(prompter, "_call_openai") as samples, _timed(prompter, "_call_openai_batch", samples):
+                results.append(_measure("generate_prompts", lambda: len(prompter.generate_prompts(scenes)), samples))
+
+            published = []
+            with _timed(PG.PanoramaGenerator, "generate_360_panoramas") as samples:
+                def generate():
+                    start = time.perf_counter()
+                    def on_progress(event, index):
+                        if event == "published":
+                            published.append(time.perf_counter() - start)
+                    GV.generate_vrbook(book_path, "Benchmark", use_cache=False, on_progress=on_progress)
+                    return len(GV.read_book(book_path.stem)["scenes"])
+                results.append(_measure("generate_vrbook", generate, samples))
+
+            # Zeit bis das Buch lesbar ist (book.json geschrieben, ggf. mit Vorschaubildern)
+            generated = results[-1]
+            results.append(dict(generated, stage="generate_vrbook (readable)", seconds=round(published[0], 4),
+                                throughput=round(generated["items"] / published[0], 2), calls=0, p50_ms=None, p99_ms=None))
+
+            # --- Content server ---
+            from fastapi.testclient import TestClient
+            import server
+
+            book_id = book_path.stem
+            image_file = GV.read_book(book_id)["scenes"][0]["image_file"]
+            routes = [
+                ("GET /books", "/books"),
+                ("GET /books/{id}", f"/books/{book_id}"),
+                ("GET /books/{id}/scenes", f"/books/{book_id}/scenes?offset=0&limit=20"),
+                ("GET /books/{id}/scenes/{index}", f"/books/{book_id}/scenes/0"),
+                ("GET /images/{file}?width=1024", f"/images/{image_file}?width=1024&format=jpeg"),
+                ("GET /static/{file}", f"/static/{image_file}"),
+                ("GET /books/{id}/scenes/{index}/cubemap", f"/books/{book_id}/scenes/0/cubemap/px"),
+                ("GET /search", "/search?q=Nebel%20Feld"),
+            ]
+
+            with TestClient(server.app) as client:
+                for stage, url in routes:
+                    samples = []
+                    def request_all():
+                        for _ in range(args.requests):
+                            start = time.perf_counter()
+                            response = client.get(url, headers={"Accept-Encoding": "gzip"})
+                            samples.append(time.perf_counter() - start)
+                            if response.status_code != 200:
+                                raise RuntimeError(f"GET {url}: {response.status_code}")
+                        return args.requests
+                    results.append(_measure(stage, request_all, samples))
+    finally:
+        for server in servers:
+            server.terminate()
+
+    _print_results(results)
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+    if args.baseline:
+        baseline = {r["stage"]: r for r in json.loads(args.baseline.read_text(encoding="utf-8"))}
+        regressions = [
+            r for r in results
+            if r["stage"] in baseline and r["throughput"] < baseline[r["stage"]]["throughput"] * (1 - args.tolerance)
+        ]
+        for r in regressions:
+            print(f"REGRESSION {r['stage']}: {r['throughput']:.1f}/s, baseline {baseline[r['stage']]['throughput']:.1f}/s")
+        if regressions:
+            sys.exit(1)
+
+
+def _measure(stage: str, run, samples: list[float]) -> dict:
+    '''
+    Runs a stage once and returns its throughput (items per second), latency percentiles of the recorded samples
+    and the peak of traced Python memory during the stage
+    '''
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    items = run()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+
+    return {
+        "stage": stage,
+        "items": items,
+        "seconds": round(seconds, 4),
+        "throughput": round(items / seconds, 2) if seconds > 0 else None,
+        "calls": len(samples),
+        "p50_ms": _percentile(samples, 50),
+        "p99_ms": _percentile(samples, 99),
+        "peak_mib": round(peak / (1024 * 1024), 2),
+    }
+
+
+@contextlib.contextmanager
+def _timed(owner, name: str, samples: list[float] | None = None):
+    # Misst jeden Aufruf von owner.<name>; owner kann eine Instanz oder eine Klasse sein
+    samples = [] if samples is None else samples
+    original = getattr(owner, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+
+    setattr(owner, name, wrapper)
+    try:
+        yield samples
+    finally:
+        if isinstance(owner, type):
+            setattr(owner, name, original)
+        else:
+            delattr(owner, name)
+
+
+def _percentile(samples: list[float], percent: float) -> float | None:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return round(ordered[rank] * 1000, 2)
+
+
+def _print_results(results: list[dict]):
+    print(f"\n{'stage':<40} {'items':>6} {'sec':>8} {'items/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'peak MiB':>9}")
+    for r in results:
+        p50 = "-" if r["p50_ms"] is None else f"{r['p50_ms']:.1f}"
+        p99 = "-" if r["p99_ms"] is None else f"{r['p99_ms']:.1f}"
+        print(f"{r['stage']:<40} {r['items']:>6} {r['seconds']:>8.2f} {r['throughput']:>9.1f} {p50:>8} {p99:>8} {r['peak_mib']:>9.1f}")
+
+
+def _write_book(path: Path, paragraphs: int, words: int):
+    with path.open("w", encoding="utf-8") as f:
+        for p in range(paragraphs):
+            text = " ".join(WORDS[(p * 7 + w) % len(WORDS)] for w in range(words))
+            f.write(f"{text}.\n\n")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise RuntimeError(f"Fake server on port {port} did not start")
+
+
+if __name__ == "__main__":
+    main()
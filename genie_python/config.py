@@ -6,9 +6,131 @@ load_dotenv()
 
 DATABASE_DIRECTORY = "database"
 
-# Number of characters per text chunk for scene splitting
+# Storage of the book data: "json" (one book.json per book folder, editable by hand; every scene update rewrites the
+# whole file, O(n) per update in the number of scenes, writers are serialized by a lock file per book) or
+# "sqlite" (one row per scene in BOOK_STORE_SQLITE_FILE, single scenes are read and updated without rewriting the book)
+BOOK_STORE = os.getenv("BOOK_STORE", "json")
+BOOK_STORE_SQLITE_FILE = "books.sqlite3"
+
+# Book uploads to the content server (POST /books) are queued as generation jobs in this directory
+JOBS_DIRECTORY = "jobs"
+JOB_WORKERS = 2  # books generated at the same time
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+# Full-text search over scene texts and image prompts (GET /search), the index is rebuilt from the book store if deleted
+SEARCH_INDEX_FILE = ".cache/search.sqlite3"
+SEARCH_LIMIT = 20
+SEARCH_LIMIT_MAX = 100
+
+# Minimum number of seconds between two scans of the database by the content server
+CATALOG_REFRESH_INTERVAL = 2.0
+
+# HTTP caching and compression of the content server
+RESPONSE_CACHE_SIZE = 256
+COMPRESSION_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+STATIC_MAX_AGE = 3600
+SCENE_PAGE_SIZE = 20
+SCENE_PAGE_MAX = 200
+
+# Maximum number of characters per text chunk for scene splitting (chunks always end at a paragraph)
 CHUNKSIZE = 5000
 
+# Scene splitting streams the LLM answer and stops reading as soon as the first integer array is complete.
+# Budget per call: maximum streamed output tokens (incl. reasoning) and seconds, None = unlimited. A chunk whose answer
+# exceeds the budget is requested once more without streaming, limited to SPLIT_MAX_OUTPUT_TOKENS; if that answer is cut off
+# as well, the chunk is kept as one scene.
+# The time budget is checked whenever data arrives; a stream that stalls completely is aborted by the read timeout,
+# which is set to SPLIT_TIME_BUDGET as well
+SPLIT_STREAMING = True
+SPLIT_MAX_OUTPUT_TOKENS = 4096
+SPLIT_TIME_BUDGET = 180.0
+
+# Maximum number of concurrent requests per generation stage
+SPLIT_WORKERS = 4
+PROMPT_WORKERS = 4
+IMAGE_WORKERS = None  # None = one per txt2img backend in SD_TXT2IMG_BACKENDS
+POSTPROCESS_WORKERS = 2
+
+# Number of panoramas rendered and upscaled per request to the Stable Diffusion WebUI.
+# Batches use the built-in "Prompts from file or textbox" script; its arguments before the prompt list
+# depend on the WebUI version ([iterate seed, same seed for batch, prompt position] for v1.6+).
+# Every prompt line sets its own seed (--seed), derived from the prompt
+IMAGE_BATCH_SIZE = 4
+TXT2IMG_BATCH_SCRIPT = "prompts from file or textbox"
+TXT2IMG_BATCH_SCRIPT_ARGS = [False, False, "start"]
+
+# Two-phase panorama generation: every scene is first rendered as a fast preview (fewer steps, no upscaling) and the book
+# is published with it, then a refine pass renders the final panoramas (same seed) and swaps them in one by one.
+# False = render final panoramas right away, the book becomes readable only after all of them are done
+PANORAMA_PREVIEW = True
+PANORAMA_PREVIEW_STEPS = 15
+
+# Prompt generation sends several scenes per LLM request, as many as fit into the token budget
+# (scene texts + expected answers; keep it well below the context window of the model, Ollama's default is 4096 tokens).
+# PROMPT_BATCH_MAX_SCENES = 1 sends one request per scene
+PROMPT_BATCH_MAX_SCENES = 8
+PROMPT_BATCH_TOKENS = 3000
+PROMPT_ANSWER_TOKENS = 100  # expected output tokens per image prompt
+LLM_CHARS_PER_TOKEN = 3.5   # rough estimate for German and English text
+# Request the batch answer as JSON schema (structured output); falls back to plain JSON if the backend rejects it
+LLM_STRUCTURED_OUTPUT = True
+
+# Scenes whose image prompt is at least this similar (0-1, Jaccard similarity of the prompt words) to the prompt
+# of an earlier scene reuse its panorama instead of rendering a new one. Lower values reuse more aggressively,
+# prompts of the same location typically score 0.3-0.6. None = render every scene
+PROMPT_REUSE_THRESHOLD = 0.5
+
+# Compressed, downscaled panorama versions served by the content server
+DERIVATIVE_DIRECTORY = ".cache/derivatives"
+DERIVATIVE_WIDTHS = [1024, 2048, 4096]
+DERIVATIVE_PREVIEW_WIDTH = 128
+DERIVATIVE_QUALITY = 85
+DERIVATIVE_PREVIEW_QUALITY = 60
+DERIVATIVE_PROCESSES = None  # None = one process per CPU core
+
+# Offline book bundles (GET /books/<book-id>/bundle, generate_vrbook.py --export-bundle): one file per book with
+# metadata, scene texts and the compressed panoramas. Unity only decodes JPEG and PNG, so keep "jpeg" for the VR client
+BUNDLE_DIRECTORY = ".cache/bundles"
+BUNDLE_IMAGE_FORMAT = "jpeg"
+BUNDLE_IMAGE_WIDTH = 4096
+BUNDLE_RETENTION = 600  # seconds outdated bundles are kept for running downloads (the previous version is always kept)
+
+# Cubemap faces generated from every panorama
+GENERATE_CUBEMAPS = True
+CUBEMAP_FACE_SIZE = 1024
+CUBEMAP_QUALITY = 90
+
+# Persistent cache for LLM responses
+LLM_CACHE_DIRECTORY = ".cache"
+LLM_CACHE_MAX_BYTES = 100 * 1024 * 1024
+LLM_CACHE_BYPASS = False
+
+# Shared HTTP transport for the LLM and Stable Diffusion backends.
+# Transient failures (connection errors, timeouts, 429/5xx) are retried with exponential backoff and jitter;
+# the concurrency limits are upper bounds that are halved automatically while a backend reports overload (429/503)
+HTTP_TIMEOUT = (10, 900)  # (connect, read) in seconds; batched renders with upscaling can take minutes
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_BASE = 1.0
+HTTP_BACKOFF_MAX = 60.0
+LLM_TIMEOUT = 300
+LLM_MAX_CONCURRENCY = 8
+
+# Stable Diffusion WebUI instances (started with --api). Requests go to the healthy instance with the fewest
+# outstanding requests; upscales use SD_UPSCALE_BACKENDS if set, otherwise the txt2img instances
+SD_TXT2IMG_BACKENDS = [url for url in os.getenv("SD_TXT2IMG_BACKENDS", "http://127.0.0.1:7860").split(",") if url]
+SD_UPSCALE_BACKENDS = [url for url in os.getenv("SD_UPSCALE_BACKENDS", "").split(",") if url]
+SD_HEALTH_CHECK_INTERVAL = 10.0
+SD_MAX_CONCURRENCY = 1  # concurrent requests per instance (the WebUI processes one request at a time)
+
+# Local Ollama server used when USE_OPENAI_API is False
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+OLLAMA_MODEL = "gpt-oss:20b"
+
+# JSON run reports (and cProfile output with GENIE_PROFILE=1) of every generation
+REPORT_DIRECTORY = ".cache/reports"
+
 # OpenAI Configuration
 USE_OPENAI_API = False
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
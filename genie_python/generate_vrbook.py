@@ -1,16 +1,25 @@
-import json
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+from modules import book_store as BS
+from modules import bundle as BD
+from modules import image_derivatives as ID
+from modules import image_stats as IS
+from modules import llm_cache as LC
+from modules import manifest as BM
+from modules import metrics as MT
 from modules import panorama_generator as PG
+from modules import pipeline as PL
 from modules import scene_deconstructor as SD
+from modules import search_index as SI
 import config
 
 
 DATA_ROOT = Path(config.DATABASE_DIRECTORY)
 
-def generate_vrbook(book_path: Path, book_name: str, author=None, prompts_only=False):
+def generate_vrbook(book_path: Path, book_name: str, author=None, prompts_only=False, use_cache=True, on_progress=None):
     # --- Prepare target directory ---
     vrbook_id = book_path.stem
     vrbook_dir = DATA_ROOT / vrbook_id
@@ -19,63 +28,154 @@ def generate_vrbook(book_path: Path, book_name: str, author=None, prompts_only=F
     print(f"Importing book: {book_path}")
     print(f"Output folder: {vrbook_dir}")
 
-    # --- 1. Text Splitting ---
-    print("Splitting book into scenes...")
-    splitter = SD.SceneSplitterGPT()
-    scenes = splitter.split_book(str(book_path))
+    # Zeiten und Zähler dieses Laufs landen im Laufbericht
+    started = datetime.now()
+    with MT.run_metrics() as run_registry:
+        llm_cache = LC.get_default_cache()
+        llm_cache.bypass = not use_cache
 
-    # --- 2. Prompt Generation ---
-    print("Generating prompts...")
-    prompter = SD.PromptGeneratorGPT()
-    prompts = prompter.generate_prompts(scenes)
+        # --- 1.-3. Text Splitting, Prompt & Image Generation ---
+        # Die Stufen laufen als Pipeline: jede fertige Szene geht direkt in die Prompt-Generierung,
+        # jeder fertige Prompt direkt in die Bildgenerierung
+        print("Splitting book into scenes and generating prompts" + ("..." if prompts_only else " and panorama images..."))
+        splitter = SD.SceneSplitterGPT()
+        prompter = SD.PromptGeneratorGPT()
+        pano_gen = None if prompts_only else PG.PanoramaGenerator(DATA_ROOT)
 
-    # --- 3. Image Generation ---
-    if not prompts_only:
-        print("Generating panorama images...")
-        pano_gen = PG.PanoramaGenerator(DATA_ROOT)
+        # Fortschritt wird im Manifest gesichert; ein erneuter Lauf setzt dort wieder an
+        manifest = BM.BookManifest(vrbook_dir)
+
+        pipeline = PL.BookPipeline(splitter, prompter, pano_gen, manifest, on_progress=on_progress)
+        with MT.span("stage", stage="pipeline"):
+            scene_entries = pipeline.run(str(book_path), vrbook_id)
+        manifest.truncate(len(scene_entries))
+
+        # --- 4. Write Book-JSON to Database ---
+        vrbook_json = {
+            "id": vrbook_id,
+            "title": book_name,
+            "author": author,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "scenes": scene_entries
+        }
 
-    scene_entries = []
+        write_book(vrbook_id, vrbook_json)
+        # ab hier kann das Buch gelesen werden, mit Vorschaubildern, falls PANORAMA_PREVIEW gesetzt ist
+        if on_progress is not None:
+            on_progress("published", len(scene_entries))
 
-    for i, (scene_text, prompt) in enumerate(zip(scenes, prompts)):
-        img_filepath = f"{vrbook_id}/scene_{i}.png"
+        # --- 5. Refine preview panoramas, each final image replaces its preview as soon as it is done ---
+        if any(scene.get("quality") == "preview" for scene in scene_entries):
+            print("Refining panorama images...")
+            with MT.span("stage", stage="refine"):
+                pano_gen.regenerate_360_panoramas(vrbook_id, on_progress=on_progress)
 
+        # --- 6. Build compressed image versions for the content server ---
         if not prompts_only:
-            # generate 360° image
-            pano_gen.generate_360_panorama(prompt, "", img_filepath)
-
-        # create scene entry
-        scene_entries.append({
-            "index": i,
-            "text": scene_text,
-            "image_prompt": prompt,
-            "image_file": img_filepath
-        })
-
-    # --- 4. Write Book-JSON to Database ---
-    vrbook_json = {
-        "id": vrbook_id,
-        "title": book_name,
-        "author": None,
-        "created_at": datetime.now().isoformat(timespec="seconds"),
-        "scenes": scene_entries
-    }
-
-    with (vrbook_dir / "book.json").open("w", encoding="utf-8") as f:
-        json.dump(vrbook_json, f, ensure_ascii=False, indent=2)
-
-    print("\nDone!")
-    print(f"Book imported to: {vrbook_dir}")
-
-def regenerate_vrbook_images(book_id: str):
-    print("Regenerating panorama images...")
-    pano_gen = PG.PanoramaGenerator(DATA_ROOT)
-    pano_gen.regenerate_360_panoramas(book_id)
+            print("Building image derivatives...")
+            with MT.span("stage", stage="derivatives"):
+                build_image_derivatives(vrbook_id)
+
+        stats = llm_cache.stats()
+        report = MT.write_run_report(vrbook_id, {
+            "book_id": vrbook_id,
+            "mode": "prompts-only" if prompts_only else "full",
+            "started_at": started.isoformat(timespec="seconds"),
+            "duration_s": round((datetime.now() - started).total_seconds(), 2),
+            "num_scenes": len(scene_entries),
+        }, run_registry)
+        print("\nDone!")
+        print(f"Book imported to: {vrbook_dir}")
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses")
+        print(f"Run report: {report}")
+
+def regenerate_vrbook_images(book_id: str, force=False):
+    started = datetime.now()
+
+    with MT.run_metrics() as run_registry:
+        print("Regenerating panorama images...")
+        pano_gen = PG.PanoramaGenerator(DATA_ROOT)
+        with MT.span("stage", stage="panoramas"):
+            pano_gen.regenerate_360_panoramas(book_id, force)
+
+        print("Updating image statistics...")
+        with MT.span("stage", stage="visuals"):
+            backfill_visual_stats([book_id])
+
+        report = MT.write_run_report(book_id, {
+            "book_id": book_id,
+            "mode": "regenerate-imgs",
+            "started_at": started.isoformat(timespec="seconds"),
+            "duration_s": round((datetime.now() - started).total_seconds(), 2),
+        }, run_registry)
     print("Done!")
+    print(f"Run report: {report}")
+
+def read_book(book_id: str) -> dict:
+    return BS.get_book_store().read_book(book_id)
+
+def write_book(book_id: str, data: dict):
+    store = BS.get_book_store()
+    store.write_book(book_id, data)
+    # Suchindex gleich mitziehen, damit der Server das Buch nicht erst beim nächsten Abgleich indexiert
+    SI.get_search_index().update_book(book_id, data, store.revision(book_id))
+
+def backfill_visual_stats(book_ids: list[str] | None = None):
+    '''
+    Computes the image statistics of all scene panoramas and stores them in the book store, using one process per CPU core
+    
+    :param book_ids: books to update, None for all books in the database
+    :type book_ids: list[str] | None
+    '''
+    store = BS.get_book_store()
+    if book_ids is None:
+        book_ids = store.book_ids()
+
+    jobs = [
+        (book_id, index, scene["image_file"])
+        for book_id in book_ids
+        for index, scene in enumerate(store.read_book(book_id).get("scenes", []))
+        if scene.get("image_file") and (DATA_ROOT / scene["image_file"]).is_file()
+    ]
+
+    # jede Szene einzeln speichern, sobald ihre Statistik fertig ist
+    with ProcessPoolExecutor() as pool:
+        image_paths = [DATA_ROOT / image_file for _, _, image_file in jobs]
+        for (book_id, index, _), visual in zip(jobs, pool.map(IS.compute_visual_stats, image_paths)):
+            store.update_scene(book_id, index, {"visual": visual})
+
+    for book_id in book_ids:
+        print(f"Image statistics updated: {book_id}")
+
+def build_image_derivatives(book_id: str):
+    data = read_book(book_id)
+
+    image_files = [scene["image_file"] for scene in data.get("scenes", []) if scene.get("image_file")]
+    ID.build_book_derivatives(ID.DerivativeStore(DATA_ROOT), image_files)
+
+def export_bundle(book_id: str, bundle_path: Path | None = None) -> Path:
+    '''
+    Writes a book with its scene texts and compressed panoramas into one bundle file for offline reading
+
+    :param book_id: id of the book
+    :type book_id: str
+    :param bundle_path: path of the bundle file, default <book-id>.genie in the current directory
+    :type bundle_path: Path | None
+    :return: path of the bundle file
+    :rtype: Path
+    '''
+    bundle_path = bundle_path or Path(f"{book_id}.genie")
+    BD.write_bundle(bundle_path, book_id, read_book(book_id), ID.DerivativeStore(DATA_ROOT))
+    return bundle_path
 
 
 def main():
     args = sys.argv[1:]
 
+    # --no-cache: LLM-Cache ignorieren (Antworten werden trotzdem neu gespeichert)
+    use_cache = "--no-cache" not in args
+    args = [a for a in args if a != "--no-cache"]
+
     # ------------------------------------------------------------
     # Mode 1: generate VR book from text file
     # Usage: python generate_vrbook.py <path-to-book-file.txt> <book-title>
@@ -92,7 +192,7 @@ def main():
         if len(args) == 3:
             author = args[2]
 
-        generate_vrbook(book_path, book_title, author)
+        generate_vrbook(book_path, book_title, author, use_cache=use_cache)
         return
 
     # ------------------------------------------------------------
@@ -111,16 +211,59 @@ def main():
         if len(args) == 3:
             author = args[2]
 
-        generate_vrbook(book_path, book_title, author, prompts_only=True)
+        generate_vrbook(book_path, book_title, author, prompts_only=True, use_cache=use_cache)
         return
 
     # ------------------------------------------------------------
     # Mode 3: regenerate images for existing VR book
-    # Usage: python generate_vrbook.py --regenerate-imgs <book-id>
+    # Usage: python generate_vrbook.py --regenerate-imgs <book-id> [--force]
     # ------------------------------------------------------------
-    if len(args) == 2 and args[0] == "--regenerate-imgs":
+    if len(args) in (2, 3) and args[0] == "--regenerate-imgs":
         book_id = args[1]
-        regenerate_vrbook_images(book_id)
+        force = len(args) == 3 and args[2] == "--force"
+        regenerate_vrbook_images(book_id, force)
+        return
+
+    # ------------------------------------------------------------
+    # Mode 4: build compressed image versions for existing VR book
+    # Usage: python generate_vrbook.py --build-derivatives <book-id>
+    # ------------------------------------------------------------
+    if len(args) == 2 and args[0] == "--build-derivatives":
+        print("Building image derivatives...")
+        build_image_derivatives(args[1])
+        print("Done!")
+        return
+
+    # ------------------------------------------------------------
+    # Mode 5: compute image statistics for existing VR books
+    # Usage: python generate_vrbook.py --backfill-visuals [<book-id>]
+    # ------------------------------------------------------------
+    if len(args) in (1, 2) and args[0] == "--backfill-visuals":
+        print("Computing image statistics...")
+        backfill_visual_stats(args[1:] or None)
+        print("Done!")
+        return
+
+    # ------------------------------------------------------------
+    # Mode 6: copy books between the book stores, e.g. import all book.json files into SQLite
+    # Usage: python generate_vrbook.py --migrate-store <json|sqlite> [<book-id> ...]
+    # ------------------------------------------------------------
+    if len(args) >= 2 and args[0] == "--migrate-store" and args[1] in ("json", "sqlite"):
+        source = BS.open_book_store("sqlite" if args[1] == "json" else "json")
+        target = BS.open_book_store(args[1])
+        for book_id in BS.migrate_books(source, target, args[2:] or None):
+            print(f"Book migrated: {book_id}")
+        print("Done!")
+        return
+
+    # ------------------------------------------------------------
+    # Mode 7: export a VR book as one bundle file for offline reading
+    # Usage: python generate_vrbook.py --export-bundle <book-id> [<output-file>]
+    # ------------------------------------------------------------
+    if len(args) in (2, 3) and args[0] == "--export-bundle":
+        print("Exporting bundle...")
+        bundle_path = export_bundle(args[1], Path(args[2]) if len(args) == 3 else None)
+        print(f"Bundle written: {bundle_path} ({bundle_path.stat().st_size} bytes)")
         return
 
     # ------------------------------------------------------------
@@ -130,13 +273,29 @@ def main():
     print("  Generate VR book from text file:")
     print("     python generate_vrbook.py <path-to-book-file.txt> <book-title> [<author>]")
     print("")
-    print("  Regenerate images for existing VR book:")
-    print("     python generate_vrbook.py --regenerate-imgs <book-id>")
+    print("  Regenerate changed or missing images for existing VR book (--force: all images):")
+    print("     python generate_vrbook.py --regenerate-imgs <book-id> [--force]")
     print("")
     print("  Generate only prompts (no images):")
     print("     python generate_vrbook.py --prompts-only <path-to-book-file.txt> <book-title> [<author>]")
+    print("")
+    print("  Build compressed image versions for existing VR book:")
+    print("     python generate_vrbook.py --build-derivatives <book-id>")
+    print("")
+    print("  Compute image statistics for existing VR books (all books if no id is given):")
+    print("     python generate_vrbook.py --backfill-visuals [<book-id>]")
+    print("")
+    print("  Copy books into the json or sqlite book store (all books if no id is given):")
+    print("     python generate_vrbook.py --migrate-store <json|sqlite> [<book-id> ...]")
+    print("")
+    print("  Export VR book as one bundle file for offline reading (default: <book-id>.genie):")
+    print("     python generate_vrbook.py --export-bundle <book-id> [<output-file>]")
+    print("")
+    print("  Add --no-cache to ignore cached LLM responses.")
     sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    # GENIE_PROFILE=1 python generate_vrbook.py ... profiles the run with cProfile
+    with MT.profiled("generate_vrbook"):
+        main()
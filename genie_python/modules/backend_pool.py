@@ -0,0 +1,168 @@
+import threading
+import time
+
+import requests
+
+import config
+from modules.transport import Transport
+
+# Leichtgewichtiger Endpunkt der WebUI für Health Checks
+HEALTH_ENDPOINT = "/sdapi/v1/progress?skip_current_image=true"
+
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+
+
+class BackendPool:
+    def __init__(self, name: str, urls: list[str],
+                 health_check_interval: float = config.SD_HEALTH_CHECK_INTERVAL,
+                 requests_per_backend: int = config.SD_MAX_CONCURRENCY):
+        '''
+        Distributes requests over several Stable Diffusion WebUI instances.
+        Every request goes to the healthy instance with the fewest outstanding requests. If an instance cannot be reached
+        (connection error or connect timeout), it is marked as down and the request is retried on another instance;
+        HTTP errors and read timeouts are only retried, since the instance itself is still running.
+        The last healthy instance is never marked as down. If all instances are down anyway, they are checked again
+        right away before a request fails, and a background thread checks them regularly, so failed instances
+        rejoin the pool once they respond again.
+
+        :param name: name of the pool, used in log output
+        :type name: str
+        :param urls: base URLs of the WebUI instances (e.g. "http://127.0.0.1:7860")
+        :type urls: list[str]
+        :param health_check_interval: seconds between two health checks of an instance
+        :type health_check_interval: float
+        :param requests_per_backend: maximum number of concurrent requests per instance
+        :type requests_per_backend: int
+        '''
+        if not urls:
+            raise ValueError(f"No backends configured for {name}")
+
+        self.name = name
+        self.backends = [Backend(url) for url in urls]
+        self.HEALTH_CHECK_INTERVAL = health_check_interval
+
+        # Retries laufen über den Transport; jeder Versuch wählt erneut ein Backend aus
+        self.transport = Transport(name, max(1, requests_per_backend) * len(self.backends))
+
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def post_json(self, path: str, payload: dict) -> dict:
+        '''
+        Sends a JSON POST request to the least busy healthy instance and returns the parsed JSON response
+
+        :param path: API path, e.g. "/sdapi/v1/txt2img"
+        :type path: str
+        :param payload: request body
+        :type payload: dict
+        :return: parsed response
+        :rtype: dict
+        '''
+        self._start_health_checks()
+        return self.transport.call(self._post_once, path, payload)
+
+    def check_health(self):
+        '''
+        Checks all instances once and updates their state
+        '''
+        for backend in self.backends:
+            try:
+                response = self.transport.session.get(backend.url + HEALTH_ENDPOINT, timeout=5)
+                ok = response.status_code < 500
+            except requests.RequestException:
+                ok = False
+
+            with self._lock:
+                if ok and not backend.healthy:
+                    print(f"{self.name}: backend {backend.url} is up again")
+                    backend.failures = 0
+                elif not ok and backend.healthy:
+                    print(f"{self.name}: backend {backend.url} failed the health check")
+                backend.healthy = ok
+
+    def _post_once(self, path: str, payload: dict) -> dict:
+        backend = self._acquire()
+        try:
+            response = self.transport.session.post(backend.url + path, json=payload, timeout=self.transport.TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+        except requests.ConnectionError as e:
+            # nur eine nicht erreichbare Instanz gilt als ausgefallen (ConnectTimeout ist ebenfalls ein ConnectionError)
+            self._mark_down(backend, e)
+            raise
+        finally:
+            with self._lock:
+                backend.outstanding -= 1
+
+    def _acquire(self) -> Backend:
+        backend = self._least_busy()
+        if backend is None:
+            # Alle Instanzen ausgefallen: sofort neu prüfen statt auf den nächsten Health Check zu warten
+            self.check_health()
+            backend = self._least_busy()
+        if backend is None:
+            # der Transport wartet (Backoff) und versucht es erneut
+            raise requests.ConnectionError(f"{self.name}: no healthy backend available")
+        return backend
+
+    def _least_busy(self) -> Backend | None:
+        with self._lock:
+            healthy = [b for b in self.backends if b.healthy]
+            if not healthy:
+                return None
+            backend = min(healthy, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            return backend
+
+    def _mark_down(self, backend: Backend, error: Exception):
+        with self._lock:
+            backend.failures += 1
+            if not backend.healthy:
+                return
+            if not any(b.healthy for b in self.backends if b is not backend):
+                # die letzte Instanz bleibt im Pool, der Transport wiederholt den Request dort
+                return
+            print(f"{self.name}: backend {backend.url} failed ({type(error).__name__}), sending work to the other backends")
+            backend.healthy = False
+
+    def _start_health_checks(self):
+        with self._lock:
+            if self._checker is not None:
+                return
+            self._checker = threading.Thread(target=self._health_loop, daemon=True)
+            self._checker.start()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.HEALTH_CHECK_INTERVAL)
+            self.check_health()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_backend_pools() -> tuple[BackendPool, BackendPool]:
+    '''
+    Returns the shared pools for txt2img and upscale requests.
+    Without separately configured upscale backends, both request types share the txt2img pool.
+
+    :return: (txt2img pool, upscale pool)
+    :rtype: tuple[BackendPool, BackendPool]
+    '''
+    with _pools_lock:
+        if not _pools:
+            _pools["txt2img"] = BackendPool("sd-txt2img", config.SD_TXT2IMG_BACKENDS)
+            if config.SD_UPSCALE_BACKENDS:
+                _pools["upscale"] = BackendPool("sd-upscale", config.SD_UPSCALE_BACKENDS)
+            else:
+                _pools["upscale"] = _pools["txt2img"]
+        return _pools["txt2img"], _pools["upscale"]
@@ -0,0 +1,390 @@
+import abc
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class BookStore(abc.ABC):
+    '''
+    Common interface of the book storage backends.
+    A book is the dict formerly stored as book.json: metadata (id, title, author, ...) and the list "scenes",
+    in which a scene is addressed by its position (= its "index").
+    '''
+
+    def book_ids(self) -> list[str]:
+        '''
+        Returns the ids of all stored books, sorted
+        '''
+        return sorted(self.revisions())
+
+    @abc.abstractmethod
+    def revisions(self) -> dict[str, str]:
+        '''
+        Returns a revision token per book that changes with every write, for cheap change detection
+
+        :return: {book id: revision}
+        :rtype: dict[str, str]
+        '''
+
+    def revision(self, book_id: str) -> str | None:
+        '''
+        Returns the current revision of a book, None if it does not exist
+        '''
+        return self.revisions().get(book_id)
+
+    def exists(self, book_id: str) -> bool:
+        return self.revision(book_id) is not None
+
+    @abc.abstractmethod
+    def read_book(self, book_id: str) -> dict:
+        '''
+        Returns a complete book
+
+        :raises FileNotFoundError: if the book does not exist
+        '''
+
+    @abc.abstractmethod
+    def write_book(self, book_id: str, data: dict):
+        '''
+        Creates or replaces a complete book
+        '''
+
+    @abc.abstractmethod
+    def read_scene(self, book_id: str, index: int) -> dict:
+        '''
+        Returns a single scene of a book
+
+        :raises FileNotFoundError: if the book does not exist
+        :raises IndexError: if the scene does not exist
+        '''
+
+    @abc.abstractmethod
+    def update_scene(self, book_id: str, index: int, fields: dict):
+        '''
+        Sets fields of a single scene, e.g. update_scene("rotkaeppchen", 3, {"visual": {...}})
+
+        :raises FileNotFoundError: if the book does not exist
+        :raises IndexError: if the scene does not exist
+        '''
+
+    def update_scenes(self, book_id: str, updates: dict[int, dict]):
+        '''
+        Sets fields of several scenes in one write, e.g. update_scenes("rotkaeppchen", {3: {...}, 4: {...}})
+
+        :param updates: {scene index: fields}
+        :type updates: dict[int, dict]
+        :raises FileNotFoundError: if the book does not exist
+        :raises IndexError: if a scene does not exist (no scene is updated then)
+        '''
+        for index, fields in updates.items():
+            self.update_scene(book_id, index, fields)
+
+
+class JsonBookStore(BookStore):
+    FILENAME = "book.json"
+    LOCK_FILENAME = "book.json.lock"
+
+    def __init__(self, data_root: Path):
+        '''
+        One book.json per book folder (the original format, easy to inspect and edit by hand).
+        Every scene update reads and rewrites the whole file, so it takes O(n) in the number of scenes and updating
+        every scene of a book O(n²); use SqliteBookStore for large books. Writers are serialized per book through
+        a lock file next to book.json, also across processes (content server and generation runs).
+
+        :param data_root: directory path of the book database
+        :type data_root: Path
+        '''
+        self.DATA_ROOT = data_root
+        self._locks = {}  # ein Lock pro Buch, wie die Sperrdateien
+        self._locks_lock = threading.Lock()
+
+    def revisions(self) -> dict[str, str]:
+        revisions = {}
+        if self.DATA_ROOT.exists():
+            for book_dir in self.DATA_ROOT.iterdir():
+                try:
+                    stat = (book_dir / self.FILENAME).stat()
+                except OSError:
+                    continue  # kein book.json
+                revisions[book_dir.name] = _file_revision(stat)
+        return revisions
+
+    def revision(self, book_id: str) -> str | None:
+        try:
+            stat = (self.DATA_ROOT / book_id / self.FILENAME).stat()
+        except OSError:
+            return None
+        return _file_revision(stat)
+
+    def read_book(self, book_id: str) -> dict:
+        book_json = self.DATA_ROOT / book_id / self.FILENAME
+        if not book_json.exists():
+            raise FileNotFoundError(f"book.json missing: {book_json}")
+
+        with book_json.open("r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def write_book(self, book_id: str, data: dict):
+        with self._locked(book_id):
+            self._write(book_id, data)
+
+    def read_scene(self, book_id: str, index: int) -> dict:
+        scenes = self.read_book(book_id).get("scenes", [])
+        if not 0 <= index < len(scenes):
+            raise IndexError(f"Scene {index} not found in book {book_id}")
+        return scenes[index]
+
+    def update_scene(self, book_id: str, index: int, fields: dict):
+        self.update_scenes(book_id, {index: fields})
+
+    def update_scenes(self, book_id: str, updates: dict[int, dict]):
+        with self._locked(book_id):
+            data = self.read_book(book_id)
+            scenes = data.get("scenes", [])
+            for index in updates:
+                if not 0 <= index < len(scenes):
+                    raise IndexError(f"Scene {index} not found in book {book_id}")
+            for index, fields in updates.items():
+                scenes[index].update(fields)
+            self._write(book_id, data)
+
+    @contextmanager
+    def _locked(self, book_id: str):
+        # Threads dieses Prozesses über den Lock des Buchs, andere Prozesse über seine Sperrdatei
+        book_dir = self.DATA_ROOT / book_id
+        book_dir.mkdir(parents=True, exist_ok=True)
+        with self._locks_lock:
+            lock = self._locks.setdefault(book_id, threading.Lock())
+        with lock, _file_lock(book_dir / self.LOCK_FILENAME):
+            yield
+
+    def _write(self, book_id: str, data: dict):
+        # Erst in Temp-Datei schreiben, dann atomar ersetzen, damit der Server nie eine halbe Datei liest
+        book_dir = self.DATA_ROOT / book_id
+        book_dir.mkdir(parents=True, exist_ok=True)
+        book_json = book_dir / self.FILENAME
+        tmp_path = book_json.with_name(f"{book_json.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, book_json)
+
+
+class SqliteBookStore(BookStore):
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS books (
+            id TEXT PRIMARY KEY,
+            meta TEXT NOT NULL,
+            revision TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS scenes (
+            book_id TEXT NOT NULL REFERENCES books(id) ON DELETE CASCADE,
+            idx INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (book_id, idx)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, db_path: Path, busy_timeout: float = 30.0):
+        '''
+        All books in one SQLite database with one row per scene, so single scenes are read and updated
+        without loading or rewriting the rest of the book.
+        The database runs in WAL mode: readers never block the writer, and concurrent writers
+        (threads or processes, e.g. the content server and a generation run) are serialized by SQLite.
+
+        :param db_path: path of the database file
+        :type db_path: Path
+        :param busy_timeout: seconds a writer waits for another writer before failing
+        :type busy_timeout: float
+        '''
+        self.DB_PATH = db_path
+        self.BUSY_TIMEOUT = busy_timeout
+        self.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+        # sqlite3-Verbindungen dürfen nicht zwischen Threads geteilt werden: eine Verbindung pro Thread
+        self._local = threading.local()
+        self._connection().executescript(self.SCHEMA)
+
+    def revisions(self) -> dict[str, str]:
+        return dict(self._connection().execute("SELECT id, revision FROM books"))
+
+    def revision(self, book_id: str) -> str | None:
+        row = self._connection().execute("SELECT revision FROM books WHERE id = ?", (book_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def read_book(self, book_id: str) -> dict:
+        db = self._connection()
+        # Lesetransaktion, damit Metadaten und Szenen aus demselben Stand stammen
+        db.execute("BEGIN")
+        try:
+            row = db.execute("SELECT meta FROM books WHERE id = ?", (book_id,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(f"Book not found: {book_id}")
+            scenes = db.execute("SELECT data FROM scenes WHERE book_id = ? ORDER BY idx", (book_id,)).fetchall()
+        finally:
+            db.execute("COMMIT")
+
+        data = json.loads(row[0])
+        data["scenes"] = [json.loads(scene) for scene, in scenes]
+        return data
+
+    def write_book(self, book_id: str, data: dict):
+        meta = {k: v for k, v in data.items() if k != "scenes"}
+        scenes = data.get("scenes", [])
+        with self._write() as db:
+            db.execute("INSERT INTO books (id, meta, revision) VALUES (?, ?, ?) "
+                       "ON CONFLICT (id) DO UPDATE SET meta = excluded.meta, revision = excluded.revision",
+                       (book_id, json.dumps(meta, ensure_ascii=False), uuid.uuid4().hex))
+            db.execute("DELETE FROM scenes WHERE book_id = ?", (book_id,))
+            db.executemany("INSERT INTO scenes (book_id, idx, data) VALUES (?, ?, ?)",
+                           [(book_id, i, json.dumps(scene, ensure_ascii=False)) for i, scene in enumerate(scenes)])
+
+    def read_scene(self, book_id: str, index: int) -> dict:
+        db = self._connection()
+        row = db.execute("SELECT data FROM scenes WHERE book_id = ? AND idx = ?", (book_id, index)).fetchone()
+        if row is None:
+            if not db.execute("SELECT 1 FROM books WHERE id = ?", (book_id,)).fetchone():
+                raise FileNotFoundError(f"Book not found: {book_id}")
+            raise IndexError(f"Scene {index} not found in book {book_id}")
+        return json.loads(row[0])
+
+    def update_scene(self, book_id: str, index: int, fields: dict):
+        self.update_scenes(book_id, {index: fields})
+
+    def update_scenes(self, book_id: str, updates: dict[int, dict]):
+        with self._write() as db:
+            rows = []
+            for index, fields in updates.items():
+                row = db.execute("SELECT data FROM scenes WHERE book_id = ? AND idx = ?", (book_id, index)).fetchone()
+                if row is None:
+                    if not db.execute("SELECT 1 FROM books WHERE id = ?", (book_id,)).fetchone():
+                        raise FileNotFoundError(f"Book not found: {book_id}")
+                    raise IndexError(f"Scene {index} not found in book {book_id}")
+
+                scene = json.loads(row[0])
+                scene.update(fields)
+                rows.append((json.dumps(scene, ensure_ascii=False), book_id, index))
+
+            db.executemany("UPDATE scenes SET data = ? WHERE book_id = ? AND idx = ?", rows)
+            db.execute("UPDATE books SET revision = ? WHERE id = ?", (uuid.uuid4().hex, book_id))
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # isolation_level=None: Transaktionen werden explizit gestartet
+            db = sqlite3.connect(self.DB_PATH, timeout=self.BUSY_TIMEOUT, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA foreign_keys=ON")
+            self._local.db = db
+        return db
+
+    def _write(self) -> "_WriteTransaction":
+        return _WriteTransaction(self._connection())
+
+
+class _WriteTransaction:
+    # BEGIN IMMEDIATE sichert die Schreibsperre sofort; Lesen und Schreiben in der Transaktion sind damit atomar
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        return False
+
+
+def _file_revision(stat: os.stat_result) -> str:
+    # book.json wird per os.replace ersetzt und bekommt so bei jedem Schreiben eine neue Inode-Nummer;
+    # damit erkennt die Revision auch Schreibvorgänge mit gleicher Größe im selben mtime-Tick
+    return f"{stat.st_mtime_ns}-{stat.st_size}-{stat.st_ino}"
+
+
+@contextmanager
+def _file_lock(path: Path):
+    '''
+    Holds an exclusive lock on a file for the duration of the with-block, waiting for other processes holding it
+    '''
+    with path.open("a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK gibt nach 10 Sekunden auf
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def open_book_store(kind: str | None = None) -> BookStore:
+    '''
+    Opens the book store configured in config.py
+
+    :param kind: "json" or "sqlite", default config.BOOK_STORE
+    :type kind: str | None
+    :rtype: BookStore
+    '''
+    kind = kind or config.BOOK_STORE
+    if kind == "json":
+        return JsonBookStore(Path(config.DATABASE_DIRECTORY))
+    if kind == "sqlite":
+        return SqliteBookStore(Path(config.BOOK_STORE_SQLITE_FILE))
+    raise ValueError(f"Unknown book store: {kind!r} (allowed: json, sqlite)")
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def get_book_store() -> BookStore:
+    '''
+    Returns the book store shared by all modules of this process
+    '''
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = open_book_store()
+        return _default_store
+
+
+def migrate_books(source: BookStore, target: BookStore, book_ids: list[str] | None = None) -> list[str]:
+    '''
+    Copies books from one store into another, e.g. all book.json files into the SQLite database
+
+    :param source: store to read from
+    :type source: BookStore
+    :param target: store to write to (existing books with the same id are replaced)
+    :type target: BookStore
+    :param book_ids: books to copy, None for all books of the source
+    :type book_ids: list[str] | None
+    :return: ids of the copied books
+    :rtype: list[str]
+    '''
+    if book_ids is None:
+        book_ids = source.book_ids()
+    for book_id in book_ids:
+        target.write_book(book_id, source.read_book(book_id))
+    return book_ids
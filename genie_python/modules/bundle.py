@@ -0,0 +1,337 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from PIL import Image
+
+import config
+from modules.image_derivatives import DerivativeStore
+
+# Bundle file layout (all integers little-endian), one file per book:
+#
+#   header   64 bytes   magic "GENIEBDL", version u16, flags u16, entry count u32,
+#                       index offset u64, index length u64, file size u64, 24 bytes reserved
+#   index    32 bytes per entry: kind u16, codec u16, scene index i32 (-1 = whole book),
+#                       data offset u64, data length u64, CRC-32 u32, 4 bytes reserved
+#   data     entries at their offsets, panoramas aligned to 4096 bytes (page size) for memory mapping
+#
+# The index has a fixed order, so every entry is found without searching (n = number of scenes):
+#   0 metadata (JSON), 1 cover image, 2..n+1 scene texts (UTF-8), n+2..2n+1 panoramas, 2n+2..3n+1 preview images.
+# Missing images have length 0; scenes that reuse a panorama point to the same data as their source scene.
+
+MAGIC = b"GENIEBDL"
+VERSION = 1
+HEADER = struct.Struct("<8sHHIQQQ24x")
+ENTRY = struct.Struct("<HHiQQI4x")
+PAGE_SIZE = 4096
+
+KIND_METADATA, KIND_COVER, KIND_TEXT, KIND_PANORAMA, KIND_PREVIEW = 1, 2, 3, 4, 5
+CODEC_NONE, CODEC_JSON, CODEC_UTF8, CODEC_JPEG, CODEC_WEBP, CODEC_PNG = 0, 1, 2, 3, 4, 5
+IMAGE_CODECS = {"jpeg": CODEC_JPEG, "webp": CODEC_WEBP}
+
+MEDIA_TYPE = "application/vnd.genie.bundle"
+
+
+def write_bundle(path: Path, book_id: str, data: dict, derivatives: DerivativeStore,
+                 image_format: str = config.BUNDLE_IMAGE_FORMAT, image_width: int = config.BUNDLE_IMAGE_WIDTH):
+    '''
+    Writes a book with its scene texts and compressed panoramas into one bundle file
+
+    :param path: path of the bundle file (written atomically)
+    :type path: Path
+    :param book_id: id of the book
+    :type book_id: str
+    :param data: book data as in the book store
+    :type data: dict
+    :param derivatives: store of the compressed panorama versions
+    :type derivatives: DerivativeStore
+    :param image_format: "jpeg" or "webp"
+    :type image_format: str
+    :param image_width: maximum width of the panoramas in pixels (smaller panoramas are not upscaled)
+    :type image_width: int
+    '''
+    scenes = data.get("scenes", [])
+    num_entries = 2 + 3 * len(scenes)
+    data_start = _align(HEADER.size + num_entries * ENTRY.size, PAGE_SIZE)
+
+    # Bilder vorab bestimmen, damit die Metadaten ihre tatsächlichen Breiten enthalten
+    images = {
+        kind: [_derivative(derivatives, scene.get("image_file"), image_width, image_format, preview) for scene in scenes]
+        for kind, preview in ((KIND_PANORAMA, False), (KIND_PREVIEW, True))
+    }
+    widths = {source: _image_width(source) for sources in images.values() for source in sources if source is not None}
+    panorama_widths = [widths.get(source) for source in images[KIND_PANORAMA]]
+
+    metadata = {
+        "format": VERSION,
+        "id": book_id,
+        "title": data.get("title", book_id),
+        "author": data.get("author"),
+        "created_at": data.get("created_at"),
+        "num_scenes": len(scenes),
+        "image_format": image_format,
+        "image_width": max((w for w in panorama_widths if w is not None), default=None),
+        "scenes": [
+            {
+                "index": i,
+                "image_prompt": scene.get("image_prompt"),
+                "reused_from": scene.get("reused_from"),
+                "quality": scene.get("quality", "final") if scene.get("image_file") else None,
+                "visual": scene.get("visual"),
+                "image_width": panorama_widths[i],
+                "preview_width": widths.get(images[KIND_PREVIEW][i]),
+            }
+            for i, scene in enumerate(scenes)
+        ],
+    }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    written = {}  # Quelldatei -> (offset, Länge, CRC), damit geteilte Panoramen nur einmal im Bundle liegen
+
+    with tmp_path.open("wb") as f:
+        f.seek(data_start)
+
+        def put(payload: bytes, alignment: int = 8) -> tuple[int, int, int]:
+            offset = _align(f.tell(), alignment)
+            f.seek(offset)
+            f.write(payload)
+            return offset, len(payload), zlib.crc32(payload)
+
+        def put_file(source: Path | None) -> tuple[int, int, int]:
+            if source is None:
+                return 0, 0, 0
+            if source not in written:
+                written[source] = put(source.read_bytes(), PAGE_SIZE)
+            return written[source]
+
+        index = [(KIND_METADATA, CODEC_JSON, -1) + put(json.dumps(metadata, ensure_ascii=False).encode("utf-8"))]
+
+        cover_path = _source(derivatives, f"{book_id}/{data['cover']}") if data.get("cover") else None
+        if cover_path is not None:
+            index.append((KIND_COVER, _file_codec(cover_path), -1) + put_file(cover_path))
+        else:
+            index.append((KIND_COVER, CODEC_NONE, -1, 0, 0, 0))
+
+        for i, scene in enumerate(scenes):
+            index.append((KIND_TEXT, CODEC_UTF8, i) + put((scene.get("text") or "").encode("utf-8")))
+
+        for kind, sources in images.items():
+            for i, source in enumerate(sources):
+                codec = IMAGE_CODECS[image_format] if source is not None else CODEC_NONE
+                index.append((kind, codec, i) + put_file(source))
+
+        file_size = f.tell()
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(index), HEADER.size, len(index) * ENTRY.size, file_size))
+        for entry in index:
+            f.write(ENTRY.pack(*entry))
+
+    os.replace(tmp_path, path)
+
+
+class BundleReader:
+    def __init__(self, path: Path):
+        '''
+        Random access to a bundle file through a memory map: opening reads only header and index,
+        scene texts and images are returned as views into the mapped file without copying
+
+        :param path: path of the bundle file
+        :type path: Path
+        :raises ValueError: if the file is no bundle, of an unsupported version or incomplete
+        '''
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"Not a bundle file: {path}")
+        self._view = memoryview(self._map)
+
+        try:
+            if len(self._map) < HEADER.size:
+                raise ValueError(f"Not a bundle file: {path}")
+            magic, version, _, count, index_offset, _, file_size = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ValueError(f"Not a bundle file: {path}")
+            if version != VERSION:
+                raise ValueError(f"Unsupported bundle version {version}: {path}")
+            if file_size != len(self._map):
+                raise ValueError(f"Incomplete bundle ({len(self._map)} of {file_size} bytes): {path}")
+        except ValueError:
+            self.close()
+            raise
+
+        self.entries = [ENTRY.unpack_from(self._map, index_offset + i * ENTRY.size) for i in range(count)]
+        self.num_scenes = (count - 2) // 3
+
+    def metadata(self) -> dict:
+        return json.loads(bytes(self._data(0)).decode("utf-8"))
+
+    def scene_text(self, index: int) -> str:
+        return bytes(self._data(2 + self._scene(index))).decode("utf-8")
+
+    def panorama(self, index: int) -> memoryview | None:
+        '''
+        Returns the compressed panorama of a scene (format see metadata()["image_format"]), None if it has none
+        '''
+        return self._data(2 + self.num_scenes + self._scene(index)) or None
+
+    def preview(self, index: int) -> memoryview | None:
+        return self._data(2 + 2 * self.num_scenes + self._scene(index)) or None
+
+    def cover(self) -> memoryview | None:
+        return self._data(1) or None
+
+    def verify(self) -> list[int]:
+        '''
+        Checks the CRC-32 of every entry and returns the positions of broken entries
+        '''
+        return [i for i, entry in enumerate(self.entries) if zlib.crc32(self._data(i)) != entry[5]]
+
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # vom Aufrufer noch gehaltene Views; die Map wird freigegeben, sobald diese freigegeben sind
+        self._file.close()
+
+    def __enter__(self) -> "BundleReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _scene(self, index: int) -> int:
+        if not 0 <= index < self.num_scenes:
+            raise IndexError(f"Scene {index} not in bundle")
+        return index
+
+    def _data(self, position: int) -> memoryview:
+        _, _, _, offset, length, _ = self.entries[position]
+        return self._view[offset:offset + length]
+
+
+class BundleStore:
+    def __init__(self, derivatives: DerivativeStore, cache_dir: Path = Path(config.BUNDLE_DIRECTORY),
+                 retention: float = config.BUNDLE_RETENTION):
+        '''
+        Builds and caches the bundle files served by the content server.
+        A bundle is rebuilt when the book data or one of its images changed.
+
+        :param derivatives: store of the compressed panorama versions
+        :type derivatives: DerivativeStore
+        :param cache_dir: directory in which the bundles are stored
+        :type cache_dir: Path
+        :param retention: seconds an outdated bundle is kept for running downloads (the previous version is always kept)
+        :type retention: float
+        '''
+        self.derivatives = derivatives
+        self.CACHE_DIR = cache_dir
+        self.RETENTION = retention
+        self._locks = {}  # ein Lock pro Buch
+        self._lock = threading.Lock()
+
+    def get(self, book_id: str, data: dict) -> Path:
+        '''
+        Returns the path of the current bundle of a book, building it if necessary
+        '''
+        version = self._version(book_id, data)
+        path = self.CACHE_DIR / f"{book_id}.{version}.genie"
+
+        # parallele Anfragen für dasselbe Buch warten auf dasselbe Ergebnis, andere Bücher werden gleichzeitig gebaut
+        with self._lock:
+            book_lock = self._locks.setdefault(book_id, threading.Lock())
+        with book_lock:
+            if not path.exists():
+                write_bundle(path, book_id, data, self.derivatives)
+                self._remove_old_versions(book_id, path)
+        return path
+
+    def _remove_old_versions(self, book_id: str, current: Path):
+        # laufende Downloads können noch ältere Versionen lesen: die vorige Version bleibt bis zum nächsten Neubau,
+        # noch ältere erst nach BUNDLE_RETENTION Sekunden
+        old_versions = []
+        for old in self.CACHE_DIR.glob(f"{book_id}.*.genie"):
+            try:
+                old_versions.append((old.stat().st_mtime, old))
+            except OSError:
+                continue
+        old_versions = sorted((v for v in old_versions if v[1] != current), reverse=True)
+
+        now = time.time()
+        for mtime, old in old_versions[1:]:
+            if now - mtime > self.RETENTION:
+                try:
+                    old.unlink(missing_ok=True)
+                except OSError:
+                    pass  # unter Windows noch geöffnet, beim nächsten Neubau erneut versuchen
+
+    def _version(self, book_id: str, data: dict) -> str:
+        digest = hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+        image_files = [scene.get("image_file") for scene in data.get("scenes", [])]
+        if data.get("cover"):
+            image_files.append(f"{book_id}/{data['cover']}")
+        for image_file in image_files:
+            try:
+                digest.update(f"{image_file}:{self.derivatives.source_path(image_file).stat().st_mtime_ns};".encode("utf-8"))
+            except (OSError, TypeError):
+                digest.update(f"{image_file}:-;".encode("utf-8"))
+        digest.update(f"{config.BUNDLE_IMAGE_FORMAT}:{config.BUNDLE_IMAGE_WIDTH}".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+
+def _derivative(derivatives: DerivativeStore, image_file: str | None, width: int, fmt: str, preview: bool) -> Path | None:
+    if not image_file:
+        return None
+    try:
+        return derivatives.get(image_file, width, fmt, preview)
+    except FileNotFoundError:
+        return None
+
+
+def _image_width(path: Path) -> int | None:
+    # Image.open liest nur den Header
+    try:
+        with Image.open(path) as img:
+            return img.width
+    except OSError:
+        return None
+
+
+def _source(derivatives: DerivativeStore, image_file: str) -> Path | None:
+    try:
+        source = derivatives.source_path(image_file)
+    except FileNotFoundError:
+        return None
+    return source if source.is_file() else None
+
+
+def _file_codec(path: Path) -> int:
+    return {".jpg": CODEC_JPEG, ".jpeg": CODEC_JPEG, ".webp": CODEC_WEBP, ".png": CODEC_PNG}.get(path.suffix.lower(), CODEC_NONE)
+
+
+def _align(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+
+if __name__ == "__main__":
+    # python -m modules.bundle <file.genie>: Inhalt auflisten und Prüfsummen kontrollieren
+    with BundleReader(Path(sys.argv[1])) as reader:
+        meta = reader.metadata()
+        print(f"{meta['title']} ({meta['id']}): {reader.num_scenes} scenes, {meta['image_format']} up to {meta['image_width']}px")
+        for i in range(reader.num_scenes):
+            panorama = reader.panorama(i)
+            width = meta["scenes"][i].get("image_width")
+            print(f"  Scene {i}: {len(reader.scene_text(i))} characters, panorama {len(panorama) if panorama else 0} bytes"
+                  + (f", {width}px" if width else ""))
+        broken = reader.verify()
+        print("Checksums OK" if not broken else f"Broken entries: {broken}")
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+
+import config
+from modules.book_store import BookStore
+
+class BookCatalog:
+    def __init__(self, data_root: Path, store: BookStore, refresh_interval: float = config.CATALOG_REFRESH_INTERVAL):
+        '''
+        In-memory index of all books in the book store.
+        Every book is read once and only re-read when its revision in the store changes.
+        The store is checked at most once per refresh interval, so requests in between are served from memory.
+
+        :param data_root: directory path of the book database (images)
+        :type data_root: Path
+        :param store: storage backend of the book data
+        :type store: BookStore
+        :param refresh_interval: minimum number of seconds between two scans of the database folder
+        :type refresh_interval: float
+        '''
+        self.DATA_ROOT = data_root
+        self.store = store
+        self.REFRESH_INTERVAL = refresh_interval
+
+        self._books = {}
+        self._overview_etag = None
+        self._last_refresh = None
+        self._lock = threading.Lock()
+
+    def list_books(self) -> list[dict]:
+        '''
+        Returns the overview entries of all readable books
+        '''
+        self.refresh()
+        with self._lock:
+            return [entry["summary"] for entry in self._books.values() if entry["summary"] is not None]
+
+    def overview_etag(self) -> str:
+        '''
+        Returns a hash that changes whenever any book in the store changes
+        '''
+        self.refresh()
+        with self._lock:
+            return self._overview_etag
+
+    def get_book(self, book_id: str) -> dict | None:
+        '''
+        Returns the full entry of a book: raw book data ("data"), the prepared API response ("detail")
+        and a hash of the response content ("etag").
+        Returns None if the book does not exist. "data" and "detail" are None if the book could not be read.
+        '''
+        self.refresh()
+        with self._lock:
+            return self._books.get(book_id)
+
+    def refresh(self, force: bool = False):
+        '''
+        Checks the revisions of all books and re-reads changed books
+
+        :param force: ignore the refresh interval
+        :type force: bool
+        '''
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_refresh is not None and now - self._last_refresh < self.REFRESH_INTERVAL:
+                return
+            self._last_refresh = now
+
+            books = {}
+            for book_id, revision in sorted(self.store.revisions().items()):
+                entry = self._books.get(book_id)
+                if entry is None or entry["revision"] != revision:
+                    entry = self._load(book_id, revision)
+                books[book_id] = entry
+
+            if self._overview_etag is None or books.keys() != self._books.keys() or any(books[k] is not self._books[k] for k in books):
+                overview = hashlib.sha256()
+                for book_id, entry in books.items():
+                    overview.update(f"{book_id}:{entry['etag']};".encode("utf-8"))
+                self._overview_etag = overview.hexdigest()[:32]
+
+            self._books = books
+
+    def _load(self, book_id: str, revision: str) -> dict:
+        entry = {"revision": revision, "etag": None, "data": None, "summary": None, "detail": None}
+
+        try:
+            data = self.store.read_book(book_id)
+        except Exception:
+            # falls ein Buch kaputt ist; das ETag ändert sich dann mit jedem Schreibvorgang
+            entry["etag"] = hashlib.sha256(f"{book_id}:{revision}".encode("utf-8")).hexdigest()[:32]
+            return entry
+
+        entry["data"] = data
+        entry["summary"] = self._summary(book_id, data)
+        entry["detail"] = self._detail(book_id, data)
+        # ETag aus dem Inhalt der Antworten (inkl. Bild-Versionen), nicht aus der Revision: ein erneutes Schreiben
+        # mit gleichem Inhalt lässt die Client-Caches gültig, jede inhaltliche Änderung ändert das ETag
+        payload = json.dumps([entry["summary"], entry["detail"]], ensure_ascii=False, sort_keys=True)
+        entry["etag"] = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+        return entry
+
+    def _summary(self, book_id: str, data: dict) -> dict:
+        return {
+            "id": data.get("id", None),
+            "title": data.get("title", book_id),
+            "author": data.get("author"),
+            "num_scenes": len(data.get("scenes", [])),
+            "cover": data.get("cover", None),
+            "quality": _book_quality(data),
+        }
+
+    def _detail(self, book_id: str, data: dict) -> dict:
+        scenes_out = []
+        for scene in data.get("scenes", []):
+            image_file = scene.get("image_file")
+            image_url = None
+
+            if image_file:
+                # image_file ist relativ zum Datenbank-Ordner (z.B. "<book-id>/scene_0.png")
+                img_path = self.DATA_ROOT / image_file
+                if img_path.exists():
+                    # URL, unter der FastAPI das Bild ausliefert.
+                    # Die Version ändert sich mit jeder neuen Bilddatei, dadurch darf der Client die URL unbegrenzt cachen
+                    image_url = f"/static/{image_file}?v={img_path.stat().st_mtime_ns}"
+
+            scenes_out.append({
+                "index": scene.get("index"),
+                "text": scene.get("text"),
+                "image_prompt": scene.get("image_prompt"),
+                "image_file": image_file,
+                "image_url": image_url,
+                # Bücher von vor der zweistufigen Generierung haben kein Feld "quality", ihre Bilder sind final
+                "quality": scene.get("quality", "final") if image_url else None,
+                "reused_from": scene.get("reused_from"),
+                "visual": scene.get("visual"),
+            })
+
+        return {
+            "id": book_id,
+            "title": data.get("title", book_id),
+            "author": data.get("author"),
+            "source_file": data.get("source_file"),
+            "created_at": data.get("created_at"),
+            "num_scenes": len(scenes_out),
+            "quality": _book_quality(data),
+            "scenes": scenes_out,
+        }
+
+
+def _book_quality(data: dict) -> str | None:
+    '''
+    Returns "preview" while panoramas of a book are still being refined, "final" once all are done, None for books without images
+    '''
+    qualities = {scene.get("quality", "final") for scene in data.get("scenes", []) if scene.get("image_file")}
+    if not qualities:
+        return None
+    return "preview" if "preview" in qualities else "final"
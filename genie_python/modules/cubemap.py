@@ -0,0 +1,229 @@
+import math
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import config
+
+# Unity convention: +X right, +Y up, +Z forward
+FACES = ("px", "nx", "py", "ny", "pz", "nz")
+
+
+def face_path(image_file: str, face: str) -> str:
+    '''
+    Returns the path of a cubemap face relative to the database root
+
+    :param image_file: panorama path relative to the database root (e.g. "<book-id>/scene_0.png")
+    :type image_file: str
+    :param face: one of FACES
+    :type face: str
+    :return: e.g. "<book-id>/cubemap/scene_0_px.jpg"
+    :rtype: str
+    '''
+    p = Path(image_file)
+    return (p.parent / "cubemap" / f"{p.stem}_{face}.jpg").as_posix()
+
+
+def is_up_to_date(data_root: Path, image_file: str) -> bool:
+    '''
+    Checks whether all cube faces of a panorama exist and were converted from its current version.
+    The modification time of the panorama at the start of the conversion is stored next to the faces; comparing the
+    faces' own modification times is not enough, since faces converted from a preview can be written after the
+    final panorama has already replaced it.
+    '''
+    image_mtime = (data_root / image_file).stat().st_mtime_ns
+    try:
+        source_mtime = int((data_root / _source_stamp_path(image_file)).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return False
+    if source_mtime != image_mtime:
+        return False
+    return all((data_root / face_path(image_file, face)).exists() for face in FACES)
+
+
+def _source_stamp_path(image_file: str) -> str:
+    p = Path(image_file)
+    return (p.parent / "cubemap" / f"{p.stem}.source").as_posix()
+
+
+def face_directions(face: str, size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Returns the view directions (x, y, z) through the pixel centers of a cube face, each as a (size, size) array
+    '''
+    # Pixelmitten auf [-1, 1], Zeile 0 = oben
+    t = (np.arange(size, dtype=np.float64) + 0.5) / size * 2.0 - 1.0
+    a, b = np.meshgrid(t, -t)
+    one = np.ones_like(a)
+
+    if face == "px":
+        return one, b, -a
+    if face == "nx":
+        return -one, b, a
+    if face == "py":
+        return a, one, -b
+    if face == "ny":
+        return a, -one, b
+    if face == "pz":
+        return a, b, one
+    if face == "nz":
+        return -a, b, -one
+    raise ValueError(f"Unknown cube face: {face}")
+
+
+def equirect_to_cubemap(equirect: np.ndarray, face_size: int) -> dict[str, np.ndarray]:
+    '''
+    Converts an equirectangular panorama into six cube faces using bilinear sampling
+
+    :param equirect: panorama as (height, width, channels) array, longitude 0 (= +Z) in the horizontal center
+    :type equirect: np.ndarray
+    :param face_size: edge length of each face in pixels
+    :type face_size: int
+    :return: face name -> (face_size, face_size, channels) array with the dtype of the input
+    :rtype: dict[str, np.ndarray]
+    '''
+    src = equirect.astype(np.float32)
+    faces = {}
+
+    for face in FACES:
+        x, y, z = face_directions(face, face_size)
+        u, v = _equirect_coords(x, y, z, equirect.shape[1], equirect.shape[0])
+        sampled = _bilinear(src, u, v)
+
+        if np.issubdtype(equirect.dtype, np.integer):
+            sampled = np.clip(np.rint(sampled), 0, np.iinfo(equirect.dtype).max)
+        faces[face] = sampled.astype(equirect.dtype)
+
+    return faces
+
+
+def generate_cubemap(data_root: Path, image_file: str, face_size: int = config.CUBEMAP_FACE_SIZE) -> list[str]:
+    '''
+    Converts a panorama from the database into six JPEG cube faces stored next to it
+
+    :param data_root: directory path of the book database
+    :type data_root: Path
+    :param image_file: panorama path relative to the database root
+    :type image_file: str
+    :param face_size: edge length of each face in pixels
+    :type face_size: int
+    :return: face paths relative to the database root, in the order of FACES
+    :rtype: list[str]
+    '''
+    # Zeitstempel vor dem Lesen: wird das Bild währenddessen ersetzt, gelten die Faces danach als veraltet
+    source_mtime = (data_root / image_file).stat().st_mtime_ns
+    with Image.open(data_root / image_file) as img:
+        equirect = np.asarray(img.convert("RGB"))
+
+    paths = []
+    for face, pixels in equirect_to_cubemap(equirect, face_size).items():
+        rel_path = face_path(image_file, face)
+        out_path = data_root / rel_path
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Erst in Temp-Datei schreiben, damit der Server nie halbe Dateien ausliefert
+        tmp_path = out_path.with_name(f"{out_path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        Image.fromarray(pixels).save(tmp_path, "JPEG", quality=config.CUBEMAP_QUALITY)
+        os.replace(tmp_path, out_path)
+        paths.append(rel_path)
+
+    # zuletzt schreiben: erst danach gelten die Faces als aktuell
+    stamp_path = data_root / _source_stamp_path(image_file)
+    tmp_path = stamp_path.with_name(f"{stamp_path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    tmp_path.write_text(str(source_mtime), encoding="utf-8")
+    os.replace(tmp_path, stamp_path)
+    return paths
+
+
+def reference_face(equirect: np.ndarray, face: str, face_size: int) -> np.ndarray:
+    '''
+    Straightforward per-pixel implementation of the same mapping, used to check equirect_to_cubemap
+    '''
+    height, width = equirect.shape[:2]
+    out = np.zeros((face_size, face_size, equirect.shape[2]), dtype=np.float64)
+
+    for row in range(face_size):
+        for col in range(face_size):
+            a = (col + 0.5) / face_size * 2.0 - 1.0
+            b = -((row + 0.5) / face_size * 2.0 - 1.0)
+            x, y, z = {
+                "px": (1.0, b, -a), "nx": (-1.0, b, a),
+                "py": (a, 1.0, -b), "ny": (a, -1.0, b),
+                "pz": (a, b, 1.0), "nz": (-a, b, -1.0),
+            }[face]
+
+            lon = math.atan2(x, z)
+            lat = math.asin(y / math.sqrt(x * x + y * y + z * z))
+            u = (lon / (2.0 * math.pi) + 0.5) * width - 0.5
+            v = (0.5 - lat / math.pi) * height - 0.5
+
+            u0 = math.floor(u)
+            v0 = math.floor(v)
+            fu = u - u0
+            fv = v - v0
+            for dv, wv in ((0, 1.0 - fv), (1, fv)):
+                yy = min(max(v0 + dv, 0), height - 1)
+                for du, wu in ((0, 1.0 - fu), (1, fu)):
+                    xx = (u0 + du) % width
+                    out[row, col] += wu * wv * equirect[yy, xx]
+
+    return out
+
+
+def _equirect_coords(x: np.ndarray, y: np.ndarray, z: np.ndarray, width: int, height: int) -> tuple[np.ndarray, np.ndarray]:
+    lon = np.arctan2(x, z)
+    lat = np.arcsin(y / np.sqrt(x * x + y * y + z * z))
+    # Kontinuierliche Pixelkoordinaten (Pixelmitte = ganze Zahl)
+    u = (lon / (2.0 * np.pi) + 0.5) * width - 0.5
+    v = (0.5 - lat / np.pi) * height - 0.5
+    return u, v
+
+
+def _bilinear(src: np.ndarray, u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    height, width = src.shape[:2]
+
+    u0 = np.floor(u)
+    v0 = np.floor(v)
+    fu = (u - u0)[..., None].astype(np.float32)
+    fv = (v - v0)[..., None].astype(np.float32)
+    u0 = u0.astype(np.int64)
+    v0 = v0.astype(np.int64)
+
+    # horizontal umlaufend (Naht bei 180°), vertikal an den Polen abschneiden
+    x0 = u0 % width
+    x1 = (u0 + 1) % width
+    y0 = np.clip(v0, 0, height - 1)
+    y1 = np.clip(v0 + 1, 0, height - 1)
+
+    top = src[y0, x0] * (1.0 - fu) + src[y0, x1] * fu
+    bottom = src[y1, x0] * (1.0 - fu) + src[y1, x1] * fu
+    return top * (1.0 - fv) + bottom * fv
+
+
+if __name__ == "__main__":
+
+    # Measure the vectorized conversion against the per-pixel reference (correctness: tests/test_cubemap.py)
+    rng = np.random.default_rng(0)
+    equirect = rng.integers(0, 256, size=(128, 256, 3), dtype=np.uint8).astype(np.float64)
+    size = 48
+
+    start = time.perf_counter()
+    equirect_to_cubemap(equirect, size)
+    vectorized_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for face in FACES:
+        reference_face(equirect, face, size)
+    reference_time = time.perf_counter() - start
+
+    print(f"Reference sampler: {reference_time * 1000:.1f} ms, vectorized: {vectorized_time * 1000:.1f} ms "
+          f"({reference_time / vectorized_time:.0f}x faster)")
+
+    # Full-size benchmark: 4096x2048 panorama to six 1024px faces
+    equirect = rng.integers(0, 256, size=(2048, 4096, 3), dtype=np.uint8)
+    start = time.perf_counter()
+    equirect_to_cubemap(equirect, 1024)
+    print(f"4096x2048 -> 6x1024x1024: {(time.perf_counter() - start) * 1000:.0f} ms")
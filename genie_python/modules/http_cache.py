@@ -0,0 +1,95 @@
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+import config
+
+try:
+    import brotli  # in requirements.txt; without it responses are only compressed with gzip
+except ImportError:
+    brotli = None
+
+
+def negotiate_encoding(accept_encoding: str | None) -> str:
+    '''
+    Picks the best supported content encoding from an Accept-Encoding header
+
+    :param accept_encoding: value of the Accept-Encoding request header
+    :type accept_encoding: str | None
+    :return: "br", "gzip" or "identity"
+    :rtype: str
+    '''
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        accepted.add(name.strip().lower())
+
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    '''
+    Compresses a response body with the given content encoding
+    '''
+    if encoding == "br":
+        return brotli.compress(body, quality=config.BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=config.GZIP_LEVEL)
+    return body
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    '''
+    Checks an If-None-Match request header against an ETag (weak comparison)
+    '''
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return any(opaque(tag) == opaque(etag) for tag in if_none_match.split(","))
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = config.RESPONSE_CACHE_SIZE):
+        '''
+        LRU cache for serialized (and compressed) response bodies.
+        Keys must contain everything the body depends on, e.g. the content hash of the book, the route and the encoding.
+
+        :param max_entries: maximum number of cached bodies
+        :type max_entries: int
+        '''
+        self.MAX_ENTRIES = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key: tuple, build: Callable[[], Any]) -> Any:
+        '''
+        Returns the cached value for a key, building and storing it on a miss
+        '''
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+
+        value = build()
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+        return value
@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+import config
+
+FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+}
+
+class DerivativeStore:
+    def __init__(self, data_root: Path, cache_dir: Path = Path(config.DERIVATIVE_DIRECTORY),
+                 widths: list[int] = config.DERIVATIVE_WIDTHS, preview_width: int = config.DERIVATIVE_PREVIEW_WIDTH):
+        '''
+        Builds and caches compressed, downscaled versions of the panorama images on disk.
+        Derivatives are built on first request and rebuilt when the source image is newer.
+
+        :param data_root: directory path of the book database
+        :type data_root: Path
+        :param cache_dir: directory in which the derivatives are stored
+        :type cache_dir: Path
+        :param widths: available widths in pixels; requested widths are rounded up to one of these
+        :type widths: list[int]
+        :param preview_width: width of the tiny preview image in pixels
+        :type preview_width: int
+        '''
+        self.DATA_ROOT = data_root
+        self.CACHE_DIR = cache_dir
+        self.WIDTHS = sorted(widths)
+        self.PREVIEW_WIDTH = preview_width
+
+    def get(self, image_file: str, width: int | None = None, fmt: str = "jpeg", preview: bool = False) -> Path:
+        '''
+        Returns the path of a derivative, building it if it is missing or outdated
+
+        :param image_file: image path relative to the database root (e.g. "<book-id>/scene_0.png")
+        :type image_file: str
+        :param width: requested width in pixels, None for the largest available width
+        :type width: int | None
+        :param fmt: "jpeg" or "webp"
+        :type fmt: str
+        :param preview: return the tiny preview instead
+        :type preview: bool
+        :return: path of the derivative file
+        :rtype: Path
+        '''
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+
+        source = self.source_path(image_file)
+        if not source.is_file():
+            raise FileNotFoundError(f"Image not found: {image_file}")
+
+        target_width = self.PREVIEW_WIDTH if preview else self._snap_width(width)
+        target = self._target_path(image_file, target_width, fmt, preview)
+
+        if self._outdated(source, target):
+            with Image.open(source) as img:
+                _write_derivative(img.convert("RGB"), target, target_width, fmt, preview)
+
+        return target
+
+    def source_path(self, image_file: str) -> Path:
+        '''
+        Resolves an image path relative to the database root and rejects paths outside of it
+        '''
+        root = self.DATA_ROOT.resolve()
+        source = (root / image_file).resolve()
+        if root not in source.parents:
+            raise FileNotFoundError(f"Image not found: {image_file}")
+        return source
+
+    def build_all(self, image_file: str) -> list[Path]:
+        '''
+        Builds all configured derivatives of an image in every format, decoding the source image only once
+        '''
+        source = self.source_path(image_file)
+        variants = [(w, fmt, False) for fmt in FORMATS for w in self.WIDTHS]
+        variants += [(self.PREVIEW_WIDTH, fmt, True) for fmt in FORMATS]
+
+        paths = [self._target_path(image_file, w, fmt, preview) for w, fmt, preview in variants]
+        todo = [(v, p) for v, p in zip(variants, paths) if self._outdated(source, p)]
+
+        if todo:
+            with Image.open(source) as img:
+                img = img.convert("RGB")
+                for (w, fmt, preview), path in todo:
+                    _write_derivative(img, path, w, fmt, preview)
+
+        return paths
+
+    def _target_path(self, image_file: str, width: int, fmt: str, preview: bool) -> Path:
+        _, ext, _ = FORMATS[fmt]
+        name = "preview" if preview else f"w{width}"
+        # Namen mit "..", die aus dem Cache-Verzeichnis herausführen würden, ablehnen und den Zielpfad aus dem
+        # aufgelösten Quellpfad bilden, damit nie außerhalb von CACHE_DIR geschrieben wird
+        cache_dir = self.CACHE_DIR.resolve()
+        relative = self.source_path(image_file).relative_to(self.DATA_ROOT.resolve())
+        for candidate in (Path(image_file), relative):
+            target = (cache_dir / f"{candidate.with_suffix('')}.{name}.{ext}").resolve()
+            if cache_dir not in target.parents:
+                raise FileNotFoundError(f"Image not found: {image_file}")
+        return target
+
+    def _outdated(self, source: Path, target: Path) -> bool:
+        return not target.exists() or target.stat().st_mtime_ns < source.stat().st_mtime_ns
+
+    def _snap_width(self, width: int | None) -> int:
+        if width is None:
+            return self.WIDTHS[-1]
+        for w in self.WIDTHS:
+            if w >= width:
+                return w
+        return self.WIDTHS[-1]
+
+
+def media_type(fmt: str) -> str:
+    '''
+    Returns the MIME type of a derivative format
+    '''
+    return FORMATS[fmt][2]
+
+
+def build_book_derivatives(store: DerivativeStore, image_files: list[str], processes: int | None = config.DERIVATIVE_PROCESSES):
+    '''
+    Builds all derivatives for the given images in a process pool. The worker processes are spawned, not forked,
+    so this is safe to call from a thread of the multithreaded content server (job service).
+
+    :param store: derivative store to fill
+    :type store: DerivativeStore
+    :param image_files: image paths relative to the database root
+    :type image_files: list[str]
+    :param processes: number of worker processes, None for one per CPU core
+    :type processes: int | None
+    '''
+    image_files = [f for f in image_files if store.source_path(f).is_file()]
+    if not image_files:
+        return
+
+    # "spawn" statt fork: läuft auch in den Job-Threads des Servers, ein Fork könnte dort fremde Locks im gesperrten Zustand erben
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for image_file, _ in zip(image_files, pool.map(store.build_all, image_files)):
+            print(f"Derivatives built: {image_file}")
+
+
+def _write_derivative(img: Image.Image, target: Path, width: int, fmt: str, preview: bool):
+    pil_format, _, _ = FORMATS[fmt]
+    quality = config.DERIVATIVE_PREVIEW_QUALITY if preview else config.DERIVATIVE_QUALITY
+
+    if img.width > width:
+        height = round(img.height * width / img.width)
+        img = img.resize((width, height), Image.Resampling.LANCZOS)
+
+    # Erst in Temp-Datei schreiben, damit parallele Requests nie halbe Dateien ausliefern
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f"{target.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    img.save(tmp_path, pil_format, quality=quality)
+    os.replace(tmp_path, target)
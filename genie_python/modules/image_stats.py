@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# Anteil der Bildhöhe am unteren Rand, aus dem die Bodenfarbe berechnet wird (wie bisher im Client)
+FLOOR_BAND = 1 / 12
+
+ANALYSIS_WIDTH = 512
+
+
+def compute_visual_stats(image_path: Path) -> dict:
+    '''
+    Computes the image statistics the VR client needs for a scene panorama, so it does not have to read pixels at runtime
+
+    :param image_path: path of the panorama image
+    :type image_path: Path
+    :return: average, dominant and floor color (as "#rrggbb"), brightness (0-1) and a 64 bit perceptual hash (hex)
+    :rtype: dict
+    '''
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+        # Für Farbstatistiken reicht eine verkleinerte Version
+        if img.width > ANALYSIS_WIDTH:
+            img = img.resize((ANALYSIS_WIDTH, max(1, round(img.height * ANALYSIS_WIDTH / img.width))), Image.Resampling.BOX)
+
+        pixels = np.asarray(img, dtype=np.float64) / 255.0
+        phash = perceptual_hash(img)
+        dominant = _dominant_color(img)
+
+    floor_rows = max(1, round(pixels.shape[0] * FLOOR_BAND))
+    average = pixels.reshape(-1, 3).mean(axis=0)
+    floor = pixels[-floor_rows:].reshape(-1, 3).mean(axis=0)
+    luma = pixels @ np.array([0.2126, 0.7152, 0.0722])
+
+    return {
+        "average_color": _to_hex(average),
+        "dominant_color": _to_hex(dominant),
+        "floor_color": _to_hex(floor),
+        "brightness": round(float(luma.mean()), 4),
+        "phash": phash,
+    }
+
+
+def perceptual_hash(img: Image.Image) -> str:
+    '''
+    DCT-based perceptual hash: the low-frequency 8x8 DCT coefficients of a 32x32 grayscale version, thresholded at their median
+    '''
+    gray = np.asarray(img.convert("L").resize((32, 32), Image.Resampling.LANCZOS), dtype=np.float64)
+
+    n = np.arange(32)
+    dct = np.cos(np.pi / 32 * (n[None, :] + 0.5) * n[:, None])
+    coeffs = (dct @ gray @ dct.T)[:8, :8].flatten()
+
+    # DC-Anteil (Gesamthelligkeit) beim Median ignorieren
+    bits = coeffs > np.median(coeffs[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:016x}"
+
+
+def _dominant_color(img: Image.Image) -> np.ndarray:
+    quantized = img.quantize(colors=16, method=Image.Quantize.MEDIANCUT)
+    palette = quantized.getpalette()
+    count, index = max(quantized.getcolors())
+    return np.array(palette[index * 3:index * 3 + 3], dtype=np.float64) / 255.0
+
+
+def _to_hex(rgb: np.ndarray) -> str:
+    r, g, b = (int(round(c * 255)) for c in np.clip(rgb, 0.0, 1.0))
+    return f"#{r:02x}{g:02x}{b:02x}"
@@ -0,0 +1,197 @@
+import json
+import os
+import queue
+import re
+import threading
+import traceback
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import config
+from modules import book_store as BS
+
+# Umlaute für lesbare Buch-IDs ("Rotkäppchen" -> "rotkaeppchen")
+_TRANSLITERATION = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+
+def make_book_id(title: str) -> str:
+    '''
+    Derives a book id (= folder name in the database) from a title
+    '''
+    book_id = re.sub(r"[^a-z0-9]+", "_", title.lower().translate(_TRANSLITERATION)).strip("_")
+    return book_id or "book"
+
+
+class JobService:
+    def __init__(self, jobs_dir: Path, run_job: Callable, workers: int = config.JOB_WORKERS):
+        '''
+        Persistent queue of generation jobs, processed by background threads.
+        Every job is stored as <jobs_dir>/<job-id>/job.json next to the uploaded text, so queued jobs and jobs that were
+        interrupted by a restart are picked up again on start (the book manifest lets them resume where they stopped).
+        Several jobs run at the same time: their LLM requests run concurrently, while their image requests share the
+        Stable Diffusion backend pool, which admits only SD_MAX_CONCURRENCY requests per WebUI instance at a time.
+
+        :param jobs_dir: directory of the job files
+        :type jobs_dir: Path
+        :param run_job: function(book_path, title, author, prompts_only, on_progress) that generates a book
+        :type run_job: Callable
+        :param workers: maximum number of jobs running at the same time
+        :type workers: int
+        '''
+        self.JOBS_DIR = jobs_dir
+        self.JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        self.WORKERS = max(1, workers)
+        self.run_job = run_job
+
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        for job_file in sorted(self.JOBS_DIR.glob("*/job.json")):
+            try:
+                job = json.loads(job_file.read_text(encoding="utf-8"))
+            except Exception:
+                continue  # kaputte Job-Datei überspringen
+            self._jobs[job["id"]] = job
+
+    def start(self):
+        '''
+        Starts the worker threads and re-queues all unfinished jobs
+        '''
+        with self._lock:
+            if self._threads:
+                return
+            for job in sorted(self._jobs.values(), key=lambda j: j["created_at"]):
+                if job["status"] in ("queued", "running"):
+                    job["status"] = "queued"
+                    self._save(job)
+                    self._queue.put(job["id"])
+
+            # Daemon-Threads: ein Neustart des Servers bricht laufende Jobs ab, sie werden beim nächsten Start fortgesetzt
+            self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.WORKERS)]
+            for t in self._threads:
+                t.start()
+
+    def submit(self, text: str, title: str, author: str | None = None, book_id: str | None = None,
+               prompts_only: bool = False, replace: bool = False) -> dict:
+        '''
+        Stores an uploaded book text and queues its generation
+
+        :param text: book text
+        :type text: str
+        :param title: book title
+        :type title: str
+        :param author: book author
+        :type author: str | None
+        :param book_id: id of the book, derived from the title if not given
+        :type book_id: str | None
+        :param prompts_only: only generate prompts, no images
+        :type prompts_only: bool
+        :param replace: regenerate the book even if it already exists in the book store
+        :type replace: bool
+        :return: the new job
+        :rtype: dict
+        :raises ValueError: if the book id is invalid
+        :raises FileExistsError: if a job for the same book is still queued or running, or the book exists and replace is not set
+        '''
+        book_id = book_id or make_book_id(title)
+        if make_book_id(book_id) != book_id:
+            raise ValueError(f"Invalid book id: {book_id!r} (allowed: a-z, 0-9, _)")
+
+        job_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+        job_dir = self.JOBS_DIR / job_id
+
+        with self._lock:
+            if any(j["book_id"] == book_id and j["status"] in ("queued", "running") for j in self._jobs.values()):
+                raise FileExistsError(f"A job for book {book_id!r} is already queued or running")
+            # Ein vorhandenes Buch nur auf ausdrücklichen Wunsch überschreiben
+            if not replace and BS.get_book_store().exists(book_id):
+                raise FileExistsError(f"Book {book_id!r} already exists (use replace=true to regenerate it)")
+
+            job_dir.mkdir(parents=True)
+            # Der Dateiname bestimmt die Buch-ID in generate_vrbook
+            (job_dir / f"{book_id}.txt").write_text(text, encoding="utf-8")
+
+            job = {
+                "id": job_id,
+                "book_id": book_id,
+                "title": title,
+                "author": author,
+                "prompts_only": prompts_only,
+                "status": "queued",
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "started_at": None,
+                "finished_at": None,
+                "progress": {"scenes": 0, "total_scenes": None, "prompts": 0, "images": 0, "readable": False, "refined": 0},
+                "error": None,
+            }
+            self._jobs[job_id] = job
+            self._save(job)
+
+        self._queue.put(job_id)
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def list_jobs(self) -> list[dict]:
+        '''
+        Returns all jobs, newest first
+        '''
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda j: j["created_at"], reverse=True)
+            return json.loads(json.dumps(jobs))
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs[job_id]
+                job["status"] = "running"
+                job["started_at"] = datetime.now().isoformat(timespec="seconds")
+                job["progress"] = {"scenes": 0, "total_scenes": None, "prompts": 0, "images": 0, "readable": False, "refined": 0}
+                self._save(job)
+
+            try:
+                book_path = self.JOBS_DIR / job_id / f"{job['book_id']}.txt"
+                self.run_job(book_path, job["title"], job["author"], job["prompts_only"],
+                             lambda event, index: self._on_progress(job_id, event, index))
+                status, error = "done", None
+            except Exception as e:
+                traceback.print_exc()
+                status, error = "failed", f"{type(e).__name__}: {e}"
+
+            with self._lock:
+                job["status"] = status
+                job["error"] = error
+                job["finished_at"] = datetime.now().isoformat(timespec="seconds")
+                self._save(job)
+
+    def _on_progress(self, job_id: str, event: str, index: int):
+        with self._lock:
+            progress = self._jobs[job_id]["progress"]
+            if event == "scene":
+                progress["scenes"] += 1
+            elif event == "split_done":
+                progress["total_scenes"] = index
+            elif event == "prompt":
+                progress["prompts"] += 1
+            elif event == "image":
+                progress["images"] += 1
+            elif event == "published":
+                progress["readable"] = True
+            elif event == "refined":
+                progress["refined"] += 1
+            self._save(self._jobs[job_id])
+
+    def _save(self, job: dict):
+        # Erst in Temp-Datei schreiben, dann atomar ersetzen
+        job_file = self.JOBS_DIR / job["id"] / "job.json"
+        tmp_path = job_file.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(job, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp_path, job_file)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import config
+
+class LLMCache:
+    def __init__(self, cache_dir: Path = Path(config.LLM_CACHE_DIRECTORY),
+                 max_bytes: int = config.LLM_CACHE_MAX_BYTES,
+                 bypass: bool = config.LLM_CACHE_BYPASS):
+        '''
+        Persistent cache for LLM responses, keyed by a hash of model, system prompt and input text.
+        The least recently used entries are evicted as soon as the cache grows beyond max_bytes.
+
+        :param cache_dir: directory of the cache database
+        :type cache_dir: Path
+        :param max_bytes: maximum total size of all cached responses in bytes
+        :type max_bytes: int
+        :param bypass: if True, lookups always miss, but fresh responses are still written to the cache
+        :type bypass: bool
+        '''
+        self.MAX_BYTES = max_bytes
+        self.bypass = bypass
+
+        self.hits = 0
+        self.misses = 0
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(cache_dir / "llm_cache.sqlite3"), check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, text: str) -> str:
+        '''
+        Builds the cache key for an LLM call
+
+        :param model: name of the model
+        :type model: str
+        :param system_prompt: system prompt of the call
+        :type system_prompt: str
+        :param text: user input of the call
+        :type text: str
+        :return: hex digest identifying the call
+        :rtype: str
+        '''
+        payload = json.dumps([model, system_prompt, text], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        '''
+        Returns the cached response for a key, or None on a miss
+        '''
+        with self._lock:
+            if self.bypass:
+                self.misses += 1
+                return None
+
+            row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        '''
+        Stores a response and evicts least recently used entries if the size cap is exceeded
+        '''
+        size = len(response.encode("utf-8"))
+        if size > self.MAX_BYTES:
+            return
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            self._evict()
+            self._db.commit()
+
+    def stats(self) -> dict:
+        '''
+        Returns hit/miss counters and the current size of the cache
+        '''
+        with self._lock:
+            entries, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "bytes": total
+            }
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.MAX_BYTES:
+            return
+
+        # Älteste Einträge löschen, bis die Größe wieder unter dem Limit liegt
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.MAX_BYTES:
+                break
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache() -> LLMCache:
+    '''
+    Returns the cache shared by all LLM callers of this process
+    '''
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = LLMCache()
+        return _default_cache
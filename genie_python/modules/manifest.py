@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+class BookManifest:
+    FILENAME = "manifest.json"
+
+    def __init__(self, book_dir: Path):
+        '''
+        Per-book record of the inputs every scene's prompt and panorama were generated from.
+        Lets reruns skip all work whose inputs did not change and whose outputs still exist.
+
+        :param book_dir: directory of the book in the database
+        :type book_dir: Path
+        '''
+        self.path = book_dir / self.FILENAME
+        self._lock = threading.Lock()
+        self._scenes = {}
+
+        if self.path.exists():
+            try:
+                with self.path.open("r", encoding="utf-8") as f:
+                    self._scenes = json.load(f).get("scenes", {})
+            except (OSError, ValueError):
+                self._scenes = {}  # kaputtes Manifest: alles neu generieren
+
+    @staticmethod
+    def hash(*parts) -> str:
+        '''
+        Returns a stable hash over strings and JSON-serializable values
+        '''
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup_prompt(self, index: int, scene_text: str) -> str | None:
+        '''
+        Returns the previously generated prompt of a scene if the scene text is unchanged
+
+        :param index: scene index
+        :type index: int
+        :param scene_text: current text of the scene
+        :type scene_text: str
+        :return: prompt from the last run or None
+        :rtype: str | None
+        '''
+        with self._lock:
+            entry = self._scenes.get(str(index))
+        if entry is None or entry.get("text_hash") != self.hash(scene_text):
+            return None
+        return entry.get("prompt")
+
+    def record_prompt(self, index: int, scene_text: str, prompt: str):
+        '''
+        Stores the prompt generated for a scene and saves the manifest
+        '''
+        with self._lock:
+            entry = self._scenes.setdefault(str(index), {})
+            entry["text_hash"] = self.hash(scene_text)
+            entry["prompt"] = prompt
+            self._save()
+
+    def image_up_to_date(self, index: int, image_path: Path, prompt: str, params: dict) -> bool:
+        '''
+        Checks whether the panorama of a scene exists and was rendered from the given prompt and parameters
+
+        :param index: scene index
+        :type index: int
+        :param image_path: absolute path of the panorama image
+        :type image_path: Path
+        :param prompt: image prompt of the scene
+        :type prompt: str
+        :param params: generation parameters of the panorama generator
+        :type params: dict
+        :rtype: bool
+        '''
+        with self._lock:
+            entry = self._scenes.get(str(index))
+        if entry is None or not image_path.exists():
+            return False
+        return entry.get("image_hash") == self.hash(prompt, params)
+
+    def record_image(self, index: int, prompt: str, params: dict):
+        '''
+        Stores the inputs a scene's panorama was rendered from and saves the manifest
+        '''
+        with self._lock:
+            entry = self._scenes.setdefault(str(index), {})
+            entry["image_hash"] = self.hash(prompt, params)
+            self._save()
+
+    def truncate(self, num_scenes: int):
+        '''
+        Removes entries of scenes that no longer exist in the book
+        '''
+        with self._lock:
+            self._scenes = {k: v for k, v in self._scenes.items() if int(k) < num_scenes}
+            self._save()
+
+    def _save(self):
+        # Erst in Temp-Datei schreiben, dann atomar ersetzen
+        tmp_path = self.path.with_suffix(".json.tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump({"scenes": self._scenes}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,304 @@
+import bisect
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+import config
+
+# Obergrenzen der Histogramm-Buckets in Sekunden (von Server-Requests bis zu GPU-Batches)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Anzahl der Messwerte pro Histogramm, aus denen p50/p99 für den Laufbericht berechnet werden
+MAX_SAMPLES = 4096
+
+
+class Registry:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        '''
+        Thread-safe store for counters and timing histograms, labelled like Prometheus metrics.
+        Used for the JSON run report of a generation and the /metrics endpoint of the content server.
+
+        :param buckets: upper bounds of the histogram buckets in seconds
+        :type buckets: tuple
+        '''
+        self.BUCKETS = tuple(sorted(buckets))
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: float = 1, **labels):
+        '''
+        Increases a counter, e.g. incr("llm_tokens_in_total", 812, kind="split")
+        '''
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        '''
+        Records a duration in a histogram
+        '''
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {
+                    "buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0, "samples": deque(maxlen=MAX_SAMPLES)
+                }
+            index = bisect.bisect_left(self.BUCKETS, seconds)
+            if index < len(self.BUCKETS):
+                hist["buckets"][index] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+            hist["samples"].append(seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        '''
+        Measures the duration of a with-block and records it in the histogram "<name>_seconds"
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def report(self) -> dict:
+        '''
+        Returns all counters and a summary (count, total, mean, p50, p99, max) of every histogram
+
+        :return: {"counters": {metric: value}, "spans": {metric: summary}}, metric names with labels in Prometheus notation
+        :rtype: dict
+        '''
+        with self._lock:
+            counters = {_metric_name(name, labels): value for (name, labels), value in sorted(self._counters.items())}
+            spans = {}
+            for (name, labels), hist in sorted(self._histograms.items()):
+                samples = sorted(hist["samples"])
+                spans[_metric_name(name, labels)] = {
+                    "count": hist["count"],
+                    "total_s": round(hist["sum"], 4),
+                    "mean_ms": round(hist["sum"] / hist["count"] * 1000, 2),
+                    "p50_ms": round(_percentile(samples, 50) * 1000, 2),
+                    "p99_ms": round(_percentile(samples, 99) * 1000, 2),
+                    "max_ms": round(samples[-1] * 1000, 2),
+                }
+        return {"counters": counters, "spans": spans}
+
+    def render_prometheus(self, prefix: str = "genie_") -> str:
+        '''
+        Renders all metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}{name} counter")
+                    typed.add(name)
+                lines.append(f"{prefix}{_metric_name(name, labels)} {_format_value(value)}")
+
+            for (name, labels), hist in sorted(self._histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}{name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, hist["buckets"]):
+                    cumulative += count
+                    lines.append(f"{prefix}{_metric_name(name + '_bucket', labels + (('le', repr(bound)),))} {cumulative}")
+                lines.append(f"{prefix}{_metric_name(name + '_bucket', labels + (('le', '+Inf'),))} {hist['count']}")
+                lines.append(f"{prefix}{_metric_name(name + '_sum', labels)} {_format_value(hist['sum'])}")
+                lines.append(f"{prefix}{_metric_name(name + '_count', labels)} {hist['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+_default_registry = Registry()
+
+# Registry der Generierung, zu der der aktuelle Thread gehört; sie erhält zusätzlich alle Messwerte dieses Threads
+_run_registry = contextvars.ContextVar("run_registry", default=None)
+
+def get_registry() -> Registry:
+    '''
+    Returns the registry shared by all modules of this process
+    '''
+    return _default_registry
+
+def incr(name: str, value: float = 1, **labels):
+    for registry in _registries():
+        registry.incr(name, value, **labels)
+
+@contextmanager
+def span(name: str, **labels):
+    '''
+    Measures the duration of a with-block in the process registry and in the registry of the current generation
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for registry in _registries():
+            registry.observe(f"{name}_seconds", seconds, **labels)
+
+@contextmanager
+def run_metrics():
+    '''
+    Collects the metrics recorded during the with-block in a separate registry, e.g. for the report of one generation.
+    Only metrics of the calling thread and of worker threads started through in_run() are collected, so several
+    generations in one process (job service) each get their own report.
+    '''
+    registry = Registry()
+    token = _run_registry.set(registry)
+    try:
+        yield registry
+    finally:
+        _run_registry.reset(token)
+
+def in_run(fn: Callable) -> Callable:
+    '''
+    Binds a function to the generation of the calling thread, so its metrics also end up in that run's registry
+    when it is executed in a worker thread, e.g. pool.submit(MT.in_run(task), ...)
+    '''
+    registry = _run_registry.get()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        token = _run_registry.set(registry)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _run_registry.reset(token)
+    return run
+
+def _registries() -> list[Registry]:
+    registry = _run_registry.get()
+    return [_default_registry] if registry is None else [_default_registry, registry]
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that records the latency of every request per route template (e.g. /books/{book_id}),
+    method and status, and the number of response bytes sent per route
+    """
+    def __init__(self, app, registry: Registry = None, static_prefix: str = "/static"):
+        self.app = app
+        self.registry = registry if registry is not None else _default_registry
+        self.STATIC_PREFIX = static_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        sent = 0
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = self._route(scope)
+            self.registry.observe("http_request_duration_seconds", time.perf_counter() - start,
+                                  route=route, method=scope["method"], status=status)
+            self.registry.incr("http_response_bytes_total", sent, route=route)
+
+    def _route(self, scope) -> str:
+        # Routen-Template statt Pfad, sonst wächst die Zahl der Zeitreihen mit jedem Buch und jeder Szene
+        route = scope.get("route")
+        if route is not None and hasattr(route, "path"):
+            return route.path
+        if scope["path"].startswith(self.STATIC_PREFIX + "/"):
+            return self.STATIC_PREFIX
+        return "unmatched"
+
+
+def write_run_report(name: str, info: dict, registry: Registry, report_dir: Path = Path(config.REPORT_DIRECTORY)) -> Path:
+    '''
+    Writes the metrics of a run together with information about the run to a JSON file
+
+    :param name: name of the run, used in the file name (e.g. the book id)
+    :type name: str
+    :param info: additional information about the run (book, mode, duration, ...)
+    :type info: dict
+    :param registry: metrics of the run (see run_metrics)
+    :type registry: Registry
+    :param report_dir: directory of the reports
+    :type report_dir: Path
+    :return: path of the written report
+    :rtype: Path
+    '''
+    report_dir.mkdir(parents=True, exist_ok=True)
+    path = report_dir / f"{name}_{time.strftime('%Y%m%d-%H%M%S')}.json"
+    path.write_text(json.dumps({**info, **registry.report()}, indent=2), encoding="utf-8")
+    return path
+
+
+@contextmanager
+def profiled(name: str, report_dir: Path = Path(config.REPORT_DIRECTORY)):
+    '''
+    Profiles the with-block with cProfile if the environment variable GENIE_PROFILE is set.
+    The profile is stored next to the run reports (open with snakeviz or pstats) and the top functions are printed.
+    cProfile only sees the calling thread; time spent in worker threads appears there as waiting and is covered by the spans.
+    '''
+    if not os.getenv("GENIE_PROFILE"):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        report_dir.mkdir(parents=True, exist_ok=True)
+        path = report_dir / f"{name}_{time.strftime('%Y%m%d-%H%M%S')}.prof"
+        profiler.dump_stats(path)
+
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(25)
+        print(out.getvalue())
+        print(f"Profile written to: {path}")
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _metric_name(name: str, labels: tuple) -> str:
+    if not labels:
+        return name
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return name + "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _percentile(ordered: list[float], percent: float) -> float:
+    rank = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
@@ -1,8 +1,25 @@
 import base64
-import json
-import requests
+import hashlib
+import os
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import config
+from modules import book_store as BS
+from modules import cubemap as CM
+from modules import image_stats as IS
+from modules import metrics as MT
+from modules.manifest import BookManifest
+from modules.backend_pool import get_backend_pools
+
+# Base64-Zeichen pro Dekodierschritt (Vielfaches von 4)
+DECODE_BLOCK_SIZE = 1 << 20
+
+# "preview": fast render without upscaling, published first; "final": full render with upscaling
+QUALITIES = ("preview", "final")
+
 class PanoramaGenerator:
     def __init__(self, database_dir: Path, lora_name: str = "LatentLabs360", lora_weight: float = 1.0):
         '''
@@ -16,14 +33,23 @@ class PanoramaGenerator:
         :type lora_weight: float
         '''
         
-        self.API_TXT2IMG = "http://127.0.0.1:7860/sdapi/v1/txt2img"
-        self.API_UPSCALE = "http://127.0.0.1:7860/sdapi/v1/extra-single-image"
+        self.API_TXT2IMG = "/sdapi/v1/txt2img"
+        self.API_UPSCALE = "/sdapi/v1/extra-single-image"
+        self.API_UPSCALE_BATCH = "/sdapi/v1/extra-batch-images"
         self.DATA_ROOT = database_dir
         self.DATA_ROOT.mkdir(parents=True, exist_ok=True)
 
         self.LORA_NAME = lora_name
         self.LORA_WEIGHT = lora_weight
 
+        self.STEPS = 50
+        self.PREVIEW_STEPS = config.PANORAMA_PREVIEW_STEPS
+
+        self.BATCH_SIZE = max(1, config.IMAGE_BATCH_SIZE)
+        # txt2img und Upscaling können auf getrennten WebUI-Instanzen laufen
+        self.txt2img_pool, self.upscale_pool = get_backend_pools()
+        self.WORKERS = len(self.txt2img_pool)
+
     def generate_360_panorama(self, prompt: str, negative_prompt: str, filepath: str):
         '''
         Generates a 360° panorama image based on the given prompt and saves it to the output directory.
@@ -35,66 +61,174 @@ class PanoramaGenerator:
         :param filepath: Output filename relative to the database root (including .png ending)
         :type filepath: str
         '''
+        self.generate_360_panoramas([prompt], negative_prompt, [filepath])
 
-        payload = {
-            "prompt": f"<lora:{self.LORA_NAME}:{self.LORA_WEIGHT}>360° panorama view: {prompt}",
-            "negative_prompt": negative_prompt,
-            "width": 1024,
-            "height": 512,
-            "steps": 50,
-            "cfg_scale": 7.0,
-            "sampler_index": "DPM++ 2M Karras",
-            "batch_size": 1,
-            "n_iter": 1,
-            "alwayson_scripts": {
-                "Asymmetric tiling": {
-                    "args": [True, True, False, 0, -1] # [active, tile_x, tile_y, margin, seam_fix]
-                }
-            }
-        }  
+    def generate_360_panoramas(self, prompts: list[str], negative_prompt: str, filepaths: list[str], quality: str = "final"):
+        '''
+        Generates several 360° panorama images with one txt2img request and one upscale request and saves them to the output directory.
+        Existing files are replaced atomically, so a preview can be swapped for the final image while it is being served.
+        
+        :param prompts: Image Prompt for each panorama
+        :type prompts: list[str]
+        :param negative_prompt: Negative Prompt to avoid certain elements in the images
+        :type negative_prompt: str
+        :param filepaths: Output filename relative to the database root for each panorama (including .png ending)
+        :type filepaths: list[str]
+        :param quality: "final" (all steps, upscaled) or "preview" (PREVIEW_STEPS, not upscaled)
+        :type quality: str
+        '''
+        if len(prompts) != len(filepaths):
+            raise ValueError("Number of prompts and filepaths must match")
+        if quality not in QUALITIES:
+            raise ValueError(f"Unknown panorama quality: {quality}")
+        if not prompts:
+            return
 
-        response = requests.post(self.API_TXT2IMG, json=payload)
-        response.raise_for_status()
-        r = response.json()
+        with MT.span("image_batch", quality=quality):
+            with MT.span("txt2img", quality=quality):
+                images = self._txt2img(prompts, negative_prompt, quality)
+            if quality == "final":
+                with MT.span("upscale"):
+                    images = self._upscale_images(images)
 
-        for img_data in r.get("images", []):
-            upscaled_data = self._upscale_image(img_data)
-            b64_str = upscaled_data
-            if "," in b64_str:
-                b64_str = b64_str.split(",", 1)[1]
+            for img_data, filepath in zip(images, filepaths):
+                self._write_image(img_data, self.DATA_ROOT / f"{filepath}")
 
-            image_bytes = base64.b64decode(b64_str)
-            out_path = self.DATA_ROOT / f"{filepath}"
-            with open(out_path, "wb") as f:
-                f.write(image_bytes)
+        MT.incr("images_generated_total", len(prompts), quality=quality)
 
-    def regenerate_360_panoramas(self, book_id: str):
+    def generation_params(self, quality: str = "final") -> dict:
         '''
-        regenerates all 360° panoramas for a given book based on previously generated prompts
+        Returns all parameters besides the prompt that influence the generated panoramas
+        
+        :param quality: "final" or "preview"
+        :type quality: str
+        :return: txt2img and upscale parameters
+        :rtype: dict
+        '''
+        txt2img = self._txt2img_payload("", "", quality)
+        del txt2img["prompt"]
+        del txt2img["negative_prompt"]
+        params = {"lora": f"{self.LORA_NAME}:{self.LORA_WEIGHT}", "txt2img": txt2img}
+        if quality == "final":
+            upscale = self._upscale_payload(None)
+            del upscale["image"]
+            params["upscale"] = upscale
+        return params
+
+    def regenerate_360_panoramas(self, book_id: str, force: bool = False, on_progress=None):
+        '''
+        regenerates the 360° panoramas for a given book based on previously generated prompts.
+        Unless force is set, only scenes whose prompt or generation parameters changed or whose image is missing are rendered.
+        This is also the refine pass after a preview pass: preview panoramas are rendered in final quality, and the scenes of
+        every finished render batch are marked "final" (with updated image statistics) in the book store in one write right away,
+        so the content server serves each image as soon as its batch is refined.
         
         :param book_id: id of the book (= folder name in the database)
         :type book_id: str
+        :param force: regenerate all panoramas
+        :type force: bool
+        :param on_progress: called with ("refined", index) for every scene whose final panorama was published
+        :type on_progress: Callable[[str, int], None] | None
         '''
 
         book_dir = self.DATA_ROOT / book_id
         if not book_dir.exists() or not book_dir.is_dir():
             raise FileNotFoundError(f"Book directory not found: {book_dir}")
         
-        json_file = book_dir / "book.json"
-        if not json_file.exists():
-            raise FileNotFoundError("book.json missing")
+        store = BS.get_book_store()
+        data = store.read_book(book_id)
+
+        manifest = BookManifest(book_dir)
+        params = self.generation_params()
+        todo = []
+        publish_lock = threading.Lock()
 
-        with json_file.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+        def publish(img_filenames: list[str]):
+            # alle Szenen mit diesen Bildern (auch wiederverwendende) zeigen jetzt die finale Version;
+            # ein Schreibvorgang pro Render-Batch, da der JSON-Store dafür das ganze Buch neu schreibt
+            with publish_lock:
+                updates = {}
+                for img_filename in dict.fromkeys(img_filenames):
+                    scenes = [
+                        i for i, scene in enumerate(data.get("scenes", []))
+                        if scene.get("image_file", f"scene_{scene.get('index', i)}.png") == img_filename
+                        and scene.get("quality") == "preview"
+                    ]
+                    if scenes:
+                        visual = IS.compute_visual_stats(self.DATA_ROOT / img_filename)
+                        updates.update({i: {"quality": "final", "visual": visual} for i in scenes})
+                if not updates:
+                    return
+                store.update_scenes(book_id, updates)
+                for i in sorted(updates):
+                    scene = data["scenes"][i]
+                    scene["quality"] = "final"
+                    if on_progress is not None:
+                        on_progress("refined", scene.get("index", i))
 
+        up_to_date = []
         for scene in data.get("scenes", []):
+            index = scene.get("index", 0)
             prompt = scene.get("image_prompt", "")
+            img_filename = scene.get("image_file", f"scene_{index}.png")
+
+            if scene.get("reused_from") is not None:
+                # teilt sich das Panorama mit einer früheren Szene, das dort neu generiert wird
+                print(f"Scene {index}: reuses panorama of scene {scene['reused_from']}, skipping")
+            elif not force and manifest.image_up_to_date(index, self.DATA_ROOT / img_filename, prompt, params):
+                print(f"Scene {index}: panorama up to date, skipping")
+                up_to_date.append(img_filename)
+            else:
+                todo.append((index, prompt, img_filename))
+        publish(up_to_date)
+
+        def render(batch):
+            self.generate_360_panoramas([prompt for _, prompt, _ in batch], "", [f for _, _, f in batch])
+            for index, prompt, img_filename in batch:
+                manifest.record_image(index, prompt, params)
+                print(f"Scene {index}: panorama generated")
+            publish([img_filename for _, _, img_filename in batch])
+
+        # mehrere Szenen pro Request generieren, ein Batch pro WebUI-Instanz gleichzeitig
+        batches = [todo[i:i + self.BATCH_SIZE] for i in range(0, len(todo), self.BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as pool:
+            for future in [pool.submit(MT.in_run(render), batch) for batch in batches]:
+                future.result()
+
+        for scene in data.get("scenes", []):
             img_filename = scene.get("image_file", f"scene_{scene.get('index', 0)}.png")
-            self.generate_360_panorama(prompt, "", f"{img_filename}")
+            if config.GENERATE_CUBEMAPS and not CM.is_up_to_date(self.DATA_ROOT, img_filename):
+                CM.generate_cubemap(self.DATA_ROOT, img_filename)
+                print(f"Scene {scene.get('index', 0)}: cubemap generated")
 
 
-    def _upscale_image(self, img_data):
-        payload = {
+    def _full_prompt(self, prompt: str) -> str:
+        return f"<lora:{self.LORA_NAME}:{self.LORA_WEIGHT}>360° panorama view: {prompt}"
+
+    def _seed(self, prompt: str) -> int:
+        # fester Seed pro Prompt, damit das finale Bild dieselbe Komposition hat wie die Vorschau
+        return int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+
+    def _txt2img_payload(self, prompt: str, negative_prompt: str, quality: str = "final") -> dict:
+        return {
+            "prompt": self._full_prompt(prompt),
+            "negative_prompt": negative_prompt,
+            "width": 1024,
+            "height": 512,
+            "steps": self.PREVIEW_STEPS if quality == "preview" else self.STEPS,
+            "cfg_scale": 7.0,
+            "sampler_index": "DPM++ 2M Karras",
+            "batch_size": 1,
+            "n_iter": 1,
+            "alwayson_scripts": {
+                "Asymmetric tiling": {
+                    "args": [True, True, False, 0, -1] # [active, tile_x, tile_y, margin, seam_fix]
+                }
+            }
+        }
+
+    def _upscale_payload(self, img_data) -> dict:
+        return {
             "resize_mode": 0,
             "upscaling_resize": 4,
             "upscaling_crop": True,
@@ -104,11 +238,74 @@ class PanoramaGenerator:
             "image": img_data
         }
 
-        response = requests.post(self.API_UPSCALE, json=payload)
-        response.raise_for_status()
-        r = response.json()
+    def _txt2img(self, prompts: list[str], negative_prompt: str, quality: str = "final") -> list[str]:
+        '''
+        Renders one image per prompt in a single request and returns them base64-encoded
+        '''
+        if len(prompts) == 1:
+            payload = self._txt2img_payload(prompts[0], negative_prompt, quality)
+            payload["seed"] = self._seed(prompts[0])
+        else:
+            # Mehrere Prompts pro Request über das A1111-Skript "Prompts from file or textbox" (eine Zeile pro Prompt,
+            # als Kommandozeile "--prompt '...' --seed N", damit jeder Prompt seinen eigenen Seed behält)
+            payload = self._txt2img_payload("", negative_prompt, quality)
+            payload["prompt"] = ""
+            lines = []
+            for p in prompts:
+                full_prompt = self._full_prompt(p).replace("\r", " ").replace("\n", " ")
+                lines.append(f"--prompt {shlex.quote(full_prompt)} --seed {self._seed(p)}")
+            payload["script_name"] = config.TXT2IMG_BATCH_SCRIPT
+            payload["script_args"] = list(config.TXT2IMG_BATCH_SCRIPT_ARGS) + ["\n".join(lines)]
+
+        images = self.txt2img_pool.post_json(self.API_TXT2IMG, payload).get("images", [])
+
+        # A1111 stellt bei mehreren Bildern evtl. ein Übersichtsbild (Grid) voran
+        if len(images) == len(prompts) + 1:
+            images = images[1:]
+        if len(images) != len(prompts):
+            raise RuntimeError(f"txt2img returned {len(images)} images for {len(prompts)} prompts")
+
+        return images
+
+    def _upscale_images(self, images: list[str]) -> list[str]:
+        '''
+        Upscales base64-encoded images in a single request
+        '''
+        if len(images) == 1:
+            return [self._upscale_image(images[0])]
+
+        payload = self._upscale_payload(None)
+        del payload["image"]
+        payload["imageList"] = [{"data": img_data, "name": f"{i}.png"} for i, img_data in enumerate(images)]
+
+        upscaled = self.upscale_pool.post_json(self.API_UPSCALE_BATCH, payload).get("images", [])
+
+        if len(upscaled) != len(images):
+            raise RuntimeError(f"Upscaler returned {len(upscaled)} images for {len(images)} inputs")
+
+        return upscaled
+
+    def _upscale_image(self, img_data):
+        payload = self._upscale_payload(img_data)
+
+        r = self.upscale_pool.post_json(self.API_UPSCALE, payload)
         return r.get("image", "")
 
+    def _write_image(self, b64_str: str, out_path: Path):
+        '''
+        Decodes a base64 image block by block into a file, without a second full-size copy of the data in memory
+        '''
+        # optionalen Data-URL-Präfix ("data:image/png;base64,") überspringen
+        start = b64_str.find(",") + 1
+
+        # Erst in Temp-Datei schreiben, damit nie eine halbe Datei ausgeliefert wird
+        tmp_path = out_path.with_name(f"{out_path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            for i in range(start, len(b64_str), DECODE_BLOCK_SIZE):
+                f.write(base64.b64decode(b64_str[i:i + DECODE_BLOCK_SIZE]))
+            MT.incr("image_bytes_total", f.tell())
+        os.replace(tmp_path, out_path)
+
 if __name__ == "__main__":
 
     # Generate a test panorama
@@ -0,0 +1,322 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import config
+from modules import cubemap as CM
+from modules import image_stats as IS
+from modules import metrics as MT
+from modules.prompt_index import PromptIndex
+
+
+class BookPipeline:
+    def __init__(self, splitter, prompter, pano_gen=None, manifest=None,
+                 prompt_workers: int = config.PROMPT_WORKERS,
+                 image_workers: int | None = config.IMAGE_WORKERS,
+                 image_batch_size: int = config.IMAGE_BATCH_SIZE,
+                 post_workers: int = config.POSTPROCESS_WORKERS,
+                 reuse_threshold: float | None = config.PROMPT_REUSE_THRESHOLD,
+                 preview: bool = config.PANORAMA_PREVIEW,
+                 on_progress: Callable[[str, int], None] | None = None):
+        '''
+        Streams a book through scene splitting, prompt generation and panorama generation.
+        Every finished scene goes straight to prompt generation and every finished prompt straight to the image generator,
+        so the LLM and the GPU work at the same time.
+
+        :param splitter: scene splitter providing iter_scenes()
+        :type splitter: SceneSplitterGPT
+        :param prompter: prompt generator providing generate_prompt_batch() and fits_batch()
+        :type prompter: PromptGeneratorGPT
+        :param pano_gen: panorama generator, None if only prompts should be generated
+        :type pano_gen: PanoramaGenerator
+        :param manifest: manifest of a previous run; unchanged prompts and panoramas are reused, progress is checkpointed to it
+        :type manifest: BookManifest
+        :param prompt_workers: maximum number of concurrent prompt requests (each covering one batch of scenes)
+        :type prompt_workers: int
+        :param image_workers: maximum number of concurrent panorama generations, None = one per Stable Diffusion backend
+        :type image_workers: int | None
+        :param image_batch_size: maximum number of panoramas rendered per request
+        :type image_batch_size: int
+        :param post_workers: maximum number of concurrent post-processing steps (cubemap conversion)
+        :type post_workers: int
+        :param reuse_threshold: prompt similarity above which a scene reuses the panorama of an earlier scene, None = always render
+        :type reuse_threshold: float | None
+        :param preview: render fast preview panoramas (scene "quality": "preview"), to be refined by
+            PanoramaGenerator.regenerate_360_panoramas after the book is published
+        :type preview: bool
+        :param on_progress: called with ("scene", index) for every split scene, ("split_done", number of scenes),
+            ("prompt", index) and ("image", index) for every scene whose panorama (or its preview) is ready
+        :type on_progress: Callable[[str, int], None] | None
+        '''
+        self.splitter = splitter
+        self.prompter = prompter
+        self.pano_gen = pano_gen
+        self.manifest = manifest
+
+        self.PROMPT_WORKERS = max(1, prompt_workers)
+        if image_workers is None:
+            image_workers = pano_gen.WORKERS if pano_gen is not None else 1
+        self.IMAGE_WORKERS = max(1, image_workers)
+        self.IMAGE_BATCH_SIZE = max(1, image_batch_size)
+        self.POST_WORKERS = max(1, post_workers)
+        self.REUSE_THRESHOLD = reuse_threshold
+        self.QUALITY = "preview" if preview else "final"
+        self.on_progress = on_progress
+
+        self._entries = {}
+        self._visuals = {}
+        self._error = None
+        self._lock = threading.Lock()
+
+        self._ready = {}
+        self._next_index = 0
+        self._prompt_index = None
+        self._order_lock = threading.Lock()
+
+    def run(self, book_path: str, vrbook_id: str) -> list[dict]:
+        '''
+        Runs all stages for a book and returns its scene entries
+
+        :param book_path: filepath of the book text
+        :type book_path: str
+        :param vrbook_id: id of the book (= folder name in the database)
+        :type vrbook_id: str
+        :return: scene entries ordered by scene index
+        :rtype: list[dict]
+        '''
+        self._entries = {}
+        self._visuals = {}
+        self._error = None
+        self._vrbook_id = vrbook_id
+
+        # Prompts gehen in Szenenreihenfolge an die Bildstufe, damit die Wiederverwendung deterministisch ist
+        self._ready = {}
+        self._next_index = 0
+        use_index = self.pano_gen is not None and self.REUSE_THRESHOLD is not None
+        self._prompt_index = PromptIndex(self.REUSE_THRESHOLD) if use_index else None
+
+        # Begrenzte Queue: blockiert die Prompt-Stufe, wenn die GPU nicht hinterherkommt
+        image_queue = queue.Queue(maxsize=2 * self.IMAGE_WORKERS * self.IMAGE_BATCH_SIZE)
+        image_threads = [
+            threading.Thread(target=MT.in_run(self._image_worker), args=(image_queue,), daemon=True)
+            for _ in range(self.IMAGE_WORKERS)
+        ]
+        for t in image_threads:
+            t.start()
+
+        # Maximal zwei Batches pro Worker warten auf ihre Prompts
+        prompt_slots = threading.Semaphore(2 * self.PROMPT_WORKERS * self.prompter.BATCH_MAX_SCENES)
+
+        # CPU-lastige Nachbearbeitung (Cubemaps) läuft getrennt, damit die GPU nicht darauf wartet
+        self._post_pool = ThreadPoolExecutor(max_workers=self.POST_WORKERS)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.PROMPT_WORKERS) as prompt_pool:
+                num_scenes = 0
+                # Szenen sammeln, bis ein Prompt-Request voll ist (Token-Budget des Prompt-Generators)
+                batch = []
+                for i, scene_text in enumerate(self.splitter.iter_scenes(book_path)):
+                    if self._error is not None:
+                        break
+                    self._progress("scene", i)
+                    num_scenes = i + 1
+                    if batch and not self.prompter.fits_batch([text for _, text in batch] + [scene_text]):
+                        prompt_pool.submit(MT.in_run(self._prompt_task), batch, image_queue, prompt_slots)
+                        batch = []
+                    prompt_slots.acquire()
+                    batch.append((i, scene_text))
+                else:
+                    if batch:
+                        prompt_pool.submit(MT.in_run(self._prompt_task), batch, image_queue, prompt_slots)
+                    self._progress("split_done", num_scenes)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for _ in image_threads:
+                image_queue.put(None)
+            for t in image_threads:
+                t.join()
+            self._post_pool.shutdown(wait=True)
+
+        if self._error is not None:
+            raise self._error
+
+        for i, visual in self._visuals.items():
+            self._entries[i]["visual"] = visual
+        for entry in self._entries.values():
+            if "reused_from" in entry:
+                entry["visual"] = self._visuals.get(entry["reused_from"])
+                if "quality" in self._entries[entry["reused_from"]]:
+                    entry["quality"] = self._entries[entry["reused_from"]]["quality"]
+
+        return [self._entries[i] for i in sorted(self._entries)]
+
+    def _prompt_task(self, batch: list[tuple[int, str]], image_queue: queue.Queue, prompt_slots: threading.Semaphore):
+        try:
+            if self._error is not None:
+                for _ in batch:
+                    prompt_slots.release()
+                return
+
+            prompts = {}
+            todo = []
+            for index, scene_text in batch:
+                prompt = self.manifest.lookup_prompt(index, scene_text) if self.manifest is not None else None
+                if prompt is None:
+                    todo.append((index, scene_text))
+                else:
+                    prompts[index] = prompt
+                    print(f"Scene {index}: prompt unchanged")
+
+            # nur Szenen mit geändertem Text gehen an das LLM, alle in einem Request
+            if todo:
+                generated = self.prompter.generate_prompt_batch([text for _, text in todo])
+                for (index, scene_text), prompt in zip(todo, generated):
+                    prompts[index] = prompt
+                    print(f"Scene {index}: prompt generated")
+                    if self.manifest is not None:
+                        self.manifest.record_prompt(index, scene_text, prompt)
+
+            for index, _ in batch:
+                self._progress("prompt", index)
+        except BaseException as e:
+            self._fail(e)
+            for _ in batch:
+                prompt_slots.release()
+            return
+
+        # Der Slot bleibt belegt, bis die Szene weitergegeben wurde; so wartet nur eine begrenzte Zahl von Prompts
+        with self._order_lock:
+            for index, scene_text in batch:
+                self._ready[index] = (scene_text, prompts[index])
+            while self._next_index in self._ready:
+                i = self._next_index
+                self._next_index += 1
+                self._dispatch(i, *self._ready.pop(i), image_queue)
+                prompt_slots.release()
+
+    def _dispatch(self, index: int, scene_text: str, prompt: str, image_queue: queue.Queue):
+        if self._prompt_index is not None:
+            match = self._prompt_index.find(prompt)
+            if match is not None:
+                # gleicher Ort wie eine frühere Szene: deren Panorama verwenden statt neu zu rendern
+                source, image_file, similarity = match
+                print(f"Scene {index}: reusing panorama of scene {source} (similarity {similarity:.2f})")
+                MT.incr("images_reused_total")
+                with self._lock:
+                    self._entries[index] = {
+                        "index": index,
+                        "text": scene_text,
+                        "image_prompt": prompt,
+                        "image_file": image_file,
+                        "reused_from": source
+                    }
+                self._progress("image", index)
+                return
+            self._prompt_index.add(index, prompt, self._image_file(index))
+
+        image_queue.put((index, scene_text, prompt))
+
+    def _image_file(self, index: int) -> str:
+        return f"{self._vrbook_id}/scene_{index}.png"
+
+    def _image_worker(self, image_queue: queue.Queue):
+        while True:
+            # Alle bereits wartenden Szenen (bis zur Batchgröße) gemeinsam rendern
+            batch = [image_queue.get()]
+            while batch[-1] is not None and len(batch) < self.IMAGE_BATCH_SIZE:
+                try:
+                    batch.append(image_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            items = [item for item in batch if item is not None]
+
+            # Nach einem Fehler die Queue nur noch leeren, damit die Prompt-Stufe nicht blockiert
+            if items and self._error is None:
+                self._render_batch(items)
+
+            if stop:
+                return
+
+    def _render_batch(self, items: list[tuple]):
+        todo = []
+        qualities = {}
+        for index, scene_text, prompt in items:
+            img_filepath = self._image_file(index)
+            if self.pano_gen is None:
+                continue
+            # ein vorhandenes finales Bild ist immer gut genug, eine vorhandene Vorschau nur im Vorschau-Durchlauf
+            if self._image_up_to_date(index, prompt, img_filepath, "final"):
+                qualities[index] = "final"
+            elif self.QUALITY == "preview" and self._image_up_to_date(index, prompt, img_filepath, "preview"):
+                qualities[index] = "preview"
+            else:
+                todo.append((index, prompt, img_filepath))
+                qualities[index] = self.QUALITY
+                continue
+            print(f"Scene {index}: panorama unchanged")
+
+        try:
+            if todo:
+                # generate 360° images
+                self.pano_gen.generate_360_panoramas([p for _, p, _ in todo], "", [f for _, _, f in todo], self.QUALITY)
+                for index, prompt, _ in todo:
+                    if self.manifest is not None:
+                        self.manifest.record_image(index, prompt, self.pano_gen.generation_params(self.QUALITY))
+                    print(f"Scene {index}: {self.QUALITY} panorama generated")
+        except BaseException as e:
+            self._fail(e)
+            return
+
+        for index, scene_text, prompt in items:
+            img_filepath = self._image_file(index)
+            if self.pano_gen is not None:
+                self._post_pool.submit(MT.in_run(self._postprocess_task), index, img_filepath, qualities[index])
+
+            with self._lock:
+                self._entries[index] = {
+                    "index": index,
+                    "text": scene_text,
+                    "image_prompt": prompt,
+                    "image_file": img_filepath
+                }
+                if index in qualities:
+                    self._entries[index]["quality"] = qualities[index]
+            if self.pano_gen is not None:
+                self._progress("image", index)
+
+    def _image_up_to_date(self, index: int, prompt: str, img_filepath: str, quality: str) -> bool:
+        if self.manifest is None:
+            return False
+        params = self.pano_gen.generation_params(quality)
+        return self.manifest.image_up_to_date(index, self.pano_gen.DATA_ROOT / img_filepath, prompt, params)
+
+    def _postprocess_task(self, index: int, img_filepath: str, quality: str):
+        if self._error is not None:
+            return
+
+        try:
+            data_root = self.pano_gen.DATA_ROOT
+            # Cubemaps von Vorschaubildern würden gleich wieder ersetzt; bis dahin erzeugt der Server sie bei Bedarf
+            if config.GENERATE_CUBEMAPS and quality == "final" and not CM.is_up_to_date(data_root, img_filepath):
+                CM.generate_cubemap(data_root, img_filepath)
+                print(f"Scene {index}: cubemap generated")
+
+            # Bildstatistiken für den Client (z.B. Bodenfarbe) einmalig hier berechnen
+            visual = IS.compute_visual_stats(data_root / img_filepath)
+            with self._lock:
+                self._visuals[index] = visual
+        except BaseException as e:
+            self._fail(e)
+
+    def _progress(self, event: str, index: int):
+        if self.on_progress is not None:
+            self.on_progress(event, index)
+
+    def _fail(self, error: BaseException):
+        with self._lock:
+            if self._error is None:
+                self._error = error
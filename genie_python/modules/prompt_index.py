@@ -0,0 +1,84 @@
+import hashlib
+import re
+
+import config
+
+# Füllwörter, die in fast jedem Bildprompt vorkommen und nichts über den Ort aussagen
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "in", "on", "at", "with", "by", "to", "from", "for", "into", "over", "under",
+    "is", "are", "its", "it", "as", "near", "through", "there", "some", "very", "360", "panorama", "view", "scene",
+}
+
+# Mersenne-Primzahl für die Hashfunktionen (a * x + b) mod p
+_PRIME = (1 << 61) - 1
+
+
+def normalize(prompt: str) -> set[str]:
+    '''
+    Reduces an image prompt to the set of its meaningful words (lower case, singular, without punctuation and stopwords)
+    '''
+    words = re.findall(r"[a-z0-9äöüß]+", prompt.lower())
+    # einfacher Plural-Abgleich ("trees" = "tree")
+    return {w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w for w in words if w not in STOPWORDS}
+
+
+class PromptIndex:
+    def __init__(self, threshold: float = config.PROMPT_REUSE_THRESHOLD, num_perm: int = 128):
+        '''
+        Similarity index over the image prompts of a book.
+        Prompts are compared by the Jaccard similarity of their normalized word sets, estimated with MinHash signatures,
+        so every lookup costs the same regardless of prompt length.
+
+        :param threshold: minimum estimated similarity (0-1) for two prompts to count as the same location
+        :type threshold: float
+        :param num_perm: number of hash functions per signature (more = more accurate estimate)
+        :type num_perm: int
+        '''
+        self.THRESHOLD = threshold
+        self.NUM_PERM = num_perm
+
+        # Feste Koeffizienten, damit die Signaturen über Läufe hinweg gleich bleiben
+        self._coeffs = [
+            (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % (_PRIME - 1) + 1,
+             int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _PRIME)
+            for i in range(num_perm)
+        ]
+        self._entries = []
+
+    def signature(self, prompt: str) -> tuple[int, ...] | None:
+        '''
+        Returns the MinHash signature of a prompt, or None if it has no meaningful words
+        '''
+        words = normalize(prompt)
+        if not words:
+            return None
+        hashes = [int.from_bytes(hashlib.blake2b(w.encode("utf-8"), digest_size=8).digest(), "big") for w in words]
+        return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in self._coeffs)
+
+    def find(self, prompt: str) -> tuple[int, str, float] | None:
+        '''
+        Finds the most similar indexed prompt above the threshold
+
+        :param prompt: image prompt to look up
+        :type prompt: str
+        :return: (scene index, image file, estimated similarity) of the match, the earliest scene on ties, or None
+        :rtype: tuple[int, str, float] | None
+        '''
+        sig = self.signature(prompt)
+        if sig is None:
+            return None
+
+        best = None
+        for index, image_file, other in self._entries:
+            similarity = sum(x == y for x, y in zip(sig, other)) / self.NUM_PERM
+            if similarity >= self.THRESHOLD and (best is None or similarity > best[2]):
+                best = (index, image_file, similarity)
+        return best
+
+    def add(self, index: int, prompt: str, image_file: str):
+        '''
+        Adds a rendered scene to the index
+        '''
+        sig = self.signature(prompt)
+        if sig is not None:
+            self._entries.append((index, image_file, sig))
@@ -1,24 +1,50 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import re
 import json
-from pathlib import Path
-from openai import OpenAI
+from typing import Iterable, Iterator
+import time
+import openai
 import config
+from modules import metrics as MT
+from modules.llm_cache import LLMCache, get_default_cache
+from modules.transport import get_transport
+
+
+class BudgetExceededError(RuntimeError):
+    def __init__(self, budget: str, limit: float, partial: str):
+        '''
+        A streamed answer was aborted because its output token or time budget was used up before it was complete
+
+        :param budget: "tokens" or "time"
+        :type budget: str
+        :param limit: the exhausted budget (tokens or seconds)
+        :type limit: float
+        :param partial: the answer text received so far
+        :type partial: str
+        '''
+        super().__init__(f"{budget} budget of {limit:g} used up before the answer was complete")
+        self.budget = budget
+        self.limit = limit
+        self.partial = partial
+
 
 class SceneSplitterGPT:
-    def __init__(self, chunksize: int = config.CHUNKSIZE):
+    def __init__(self, chunksize: int = config.CHUNKSIZE, max_workers: int = config.SPLIT_WORKERS, cache: LLMCache = None):
 
+        self.transport = get_transport("llm")
         if config.USE_OPENAI_API:
             print("Using OpenAI GPT model for scene splitting.")
-            self.client = OpenAI(api_key=config.OPENAI_API_KEY)
+            self.client = self.transport.openai_client(None, config.OPENAI_API_KEY)
             self.model = config.OPENAI_MODEL
         else:
             print("Using local ollama gpt model for scene splitting.")
-            self.client = OpenAI(
-                base_url="http://localhost:11434/v1",  # Local Ollama API
-                api_key="ollama"                       # Dummy key
+            self.client = self.transport.openai_client(
+                config.OLLAMA_BASE_URL,  # Local Ollama API
+                "ollama"                 # Dummy key
             )
-            self.model = "gpt-oss:20b"
+            self.model = config.OLLAMA_MODEL
 
         self.SYSTEM_PROMPT = """
             You are a tool that splits narrative book text into distinct chunks, each chunk representing a different location. 
@@ -27,6 +53,11 @@ class SceneSplitterGPT:
         """
 
         self.CHUNKSIZE = chunksize
+        self.MAX_WORKERS = max(1, max_workers)
+        self.STREAMING = config.SPLIT_STREAMING
+        self.MAX_OUTPUT_TOKENS = config.SPLIT_MAX_OUTPUT_TOKENS
+        self.TIME_BUDGET = config.SPLIT_TIME_BUDGET
+        self.cache = cache if cache is not None else get_default_cache()
 
     def split_book(self, filepath: str) -> list[str]:
         '''
@@ -37,30 +68,124 @@ class SceneSplitterGPT:
         :return: the book split into scenes
         :rtype: list[str]
         '''
-        splitted_chunks = []
+        with MT.span("split_book"):
+            return list(self.iter_scenes(filepath))
 
-        for c in self._chunk_book(filepath, self.CHUNKSIZE):
-            split_indices = self._call_openai(c)
-            splitted_chunk = self._split_with_indices(c, split_indices)
-            splitted_chunks.append(splitted_chunk)
+    def iter_scenes(self, filepath: str) -> Iterator[str]:
+        '''
+        Like split_book, but yields every scene as soon as it is complete.
+        The last scene of a chunk may continue in the next chunk, so it is held back until the next chunk has been split.
         
-        splitted_book = self._merge_chunk_groups(splitted_chunks)
+        :param filepath: filepath of the book text
+        :type filepath: str
+        :return: the book's scenes in reading order
+        :rtype: Iterator[str]
+        '''
+        pending = None
 
-        return splitted_book
+        chunks = self._chunk_book(filepath, self.CHUNKSIZE)
+
+        for c, split_indices in self._split_chunks(chunks):
+            splitted_chunk = self._split_with_indices(c, split_indices)
+            if not splitted_chunk:
+                continue
+
+            # Letzte Szene des vorherigen Chunks mit der ersten des neuen verbinden
+            # (Chunks enden immer an Absatzgrenzen, daher mit Absatztrenner)
+            if pending is not None:
+                splitted_chunk[0] = pending + "\n\n" + splitted_chunk[0]
+
+            # Ortswechsel nach dem letzten Absatz: die letzte Szene ist bereits vollständig
+            num_paragraphs = len(re.split(r'\n\s*\n', c))
+            if num_paragraphs - 1 in split_indices:
+                yield from splitted_chunk
+                pending = None
+            else:
+                yield from splitted_chunk[:-1]
+                pending = splitted_chunk[-1]
+
+        if pending is not None:
+            yield pending
     
-    def _chunk_book(self, filepath: str, chunksize: int) -> list[str]:
+    def _split_chunks(self, chunks: Iterable[str]) -> Iterator[tuple[str, list[int]]]:
+        '''
+        Sends the chunks to the GPT model with up to MAX_WORKERS requests in flight
+        and yields the results in the original chunk order
+        
+        :param chunks: text chunks to analyze
+        :type chunks: Iterable[str]
+        :return: pairs of chunk and split indices
+        :rtype: Iterator[tuple[str, list[int]]]
+        '''
+        if self.MAX_WORKERS == 1:
+            for c in chunks:
+                yield c, self._call_openai(c)
+            return
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+            try:
+                for c in chunks:
+                    pending.append((c, pool.submit(MT.in_run(self._call_openai), c)))
+
+                    # Fenster voll: auf den ältesten Chunk warten
+                    if len(pending) >= self.MAX_WORKERS:
+                        c, future = pending.popleft()
+                        yield c, future.result()
+
+                while pending:
+                    c, future = pending.popleft()
+                    yield c, future.result()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def _chunk_book(self, filepath: str, chunksize: int) -> Iterator[str]:
         '''
-        Reads a file and returns text chunks as a list of strings
+        Reads a file incrementally and yields text chunks that only end at paragraph boundaries.
+        Paragraphs are collected until the next one would exceed the chunk size; a single paragraph longer than the chunk size becomes its own chunk.
         
         :param filepath: path of the file
         :type filepath: str
-        :param chunksize: number of characters per chunk
+        :param chunksize: maximum number of characters per chunk
         :type chunksize: int
-        :return: text chunks
-        :rtype: list[str]
+        :return: text chunks, paragraphs separated by a blank line
+        :rtype: Iterator[str]
         '''
-        text = Path(filepath).read_text(encoding="utf-8")
-        return [text[i:i + chunksize] for i in range(0, len(text), chunksize)]
+        chunk = []
+        chunk_len = 0
+
+        for para in self._read_paragraphs(filepath):
+            # Länge inkl. Trenner "\n\n"
+            para_len = len(para) + (2 if chunk else 0)
+            if chunk and chunk_len + para_len > chunksize:
+                yield "\n\n".join(chunk)
+                chunk = []
+                chunk_len = 0
+                para_len = len(para)
+
+            chunk.append(para)
+            chunk_len += para_len
+
+        if chunk:
+            yield "\n\n".join(chunk)
+
+    def _read_paragraphs(self, filepath: str) -> Iterator[str]:
+        '''
+        Yields the paragraphs of a file line by line, without loading the whole file.
+        Like in _split_with_indices, paragraphs are separated by one or more blank (or whitespace-only) lines.
+        '''
+        lines = []
+        with open(filepath, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    lines.append(line)
+                elif lines:
+                    yield "".join(lines).rstrip("\r\n")
+                    lines = []
+
+        if lines:
+            yield "".join(lines).rstrip("\r\n")
 
     def _call_openai(self, text_chunk: str) -> list[int]:
         '''
@@ -71,6 +196,13 @@ class SceneSplitterGPT:
         :return: Indices of paragraphs after which a location change occurs, starting with zero
         :rtype: list[int]
         '''
+        cache_key = self.cache.make_key(self.model, self.SYSTEM_PROMPT, text_chunk)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            MT.incr("llm_cache_hits_total", kind="split")
+            return self._extract_int_list(cached)
+        MT.incr("llm_cache_misses_total", kind="split")
+
         payload = dict(           
             model = self.model,
             messages = [
@@ -85,18 +217,109 @@ class SceneSplitterGPT:
             ]
         )
 
-        response = self.client.chat.completions.create(**payload)
-
-        raw = response.choices[0].message.content
-        return self._extract_int_list(raw)
+        with MT.span("llm_call", kind="split"):
+            raw = None
+            retry = {}
+            if self.STREAMING:
+                try:
+                    # der ganze Stream läuft im Transport, damit das Concurrency-Limit bis zum Ende gilt
+                    raw = self.transport.call(self._stream_answer, payload)
+                except BudgetExceededError as e:
+                    # Chunk einmal ohne Streaming wiederholen, mit demselben Ausgabe-Budget als Obergrenze
+                    print(f"Scene splitting: {e}, retrying the chunk without streaming")
+                    MT.incr("llm_split_budget_retries_total", budget=e.budget)
+                    if self.MAX_OUTPUT_TOKENS is not None:
+                        # OpenAI-Reasoning-Modelle kennen nur max_completion_tokens, Ollama nur max_tokens
+                        limit_param = "max_completion_tokens" if config.USE_OPENAI_API else "max_tokens"
+                        retry = {limit_param: self.MAX_OUTPUT_TOKENS}
+            if raw is None:
+                response = self.transport.call(self.client.chat.completions.create, **payload, **retry)
+                _record_usage(response, "split")
+                raw = response.choices[0].message.content or ""
+
+                if retry and response.choices[0].finish_reason == "length" and not INT_LIST_PATTERN.search(raw):
+                    # auch der zweite Versuch läuft über: Chunk ohne Szenenwechsel übernehmen statt das Buch abzubrechen
+                    print("Scene splitting: output budget used up again, keeping the chunk as one scene")
+                    MT.incr("llm_split_budget_fallbacks_total")
+                    return []
+        indices = self._extract_int_list(raw)
+
+        # Nur parsebare Antworten cachen
+        self.cache.put(cache_key, raw)
+        return indices
     
+    def _stream_answer(self, payload: dict) -> str:
+        '''
+        Streams a completion and stops reading as soon as the first integer array is complete.
+        The time budget is checked whenever a chunk arrives; a stream that stalls completely is aborted by the
+        read timeout, which is set to the time budget as well (APITimeoutError, retried by the transport).
+
+        :param payload: arguments of the chat completion
+        :type payload: dict
+        :return: answer text up to the end of the first integer array
+        :rtype: str
+        :raises BudgetExceededError: if the output token or time budget is used up before the array is complete
+        '''
+        started = time.monotonic()
+        timeout = config.LLM_TIMEOUT if self.TIME_BUDGET is None else min(config.LLM_TIMEOUT, self.TIME_BUDGET)
+        stream = self.client.chat.completions.create(**payload, stream=True, stream_options={"include_usage": True},
+                                                     timeout=timeout)
+
+        text = ""
+        search_from = 0
+        tokens = 0
+        usage = None
+        exceeded = None
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+
+                # jeder Chunk entspricht etwa einem Token, auch reine Reasoning-Chunks ohne content
+                tokens += 1
+                delta = chunk.choices[0].delta.content or ""
+                if delta:
+                    text += delta
+                    match = INT_LIST_PATTERN.search(text, search_from)
+                    if match:
+                        text = text[:match.end()]
+                        if chunk.choices[0].finish_reason is None:
+                            MT.incr("llm_stream_early_stops_total", kind="split")
+                        break
+                    # ein Array kann erst an der letzten öffnenden Klammer beginnen (Arrays enthalten keine)
+                    search_from = max(search_from, text.rfind("["))
+
+                if self.MAX_OUTPUT_TOKENS is not None and tokens >= self.MAX_OUTPUT_TOKENS:
+                    exceeded = BudgetExceededError("tokens", self.MAX_OUTPUT_TOKENS, text)
+                    break
+                if self.TIME_BUDGET is not None and time.monotonic() - started > self.TIME_BUDGET:
+                    exceeded = BudgetExceededError("time", self.TIME_BUDGET, text)
+                    break
+        finally:
+            # Verbindung schließen: das Backend bricht die Generierung ab, statt weiter zu dekodieren
+            stream.close()
+
+        MT.incr("llm_calls_total", kind="split")
+        if usage is not None:
+            MT.incr("llm_tokens_in_total", usage.prompt_tokens or 0, kind="split")
+            MT.incr("llm_tokens_out_total", usage.completion_tokens or 0, kind="split")
+        else:
+            # bei vorzeitigem Abbruch liefert das Backend keine Zählung mehr
+            MT.incr("llm_tokens_out_total", tokens, kind="split")
+
+        if exceeded is not None:
+            MT.incr("llm_stream_budget_exceeded_total", kind="split", budget=exceeded.budget)
+            raise exceeded
+        return text
+
     def _extract_int_list(self, text: str) -> list[int]:
         '''
         Extracts the first list of integers from a model output.
-        Accepts surrounding text and ignores everything except the first found array like [1,2,3].
+        Accepts surrounding text and ignores everything except the first found array like [1,2,3] (or []).
         '''
-        pattern = r"\[\s*-?\d+(?:\s*,\s*-?\d+)*\s*\]"
-        match = re.search(pattern, text)
+        match = INT_LIST_PATTERN.search(text)
 
         if not match:
             raise ValueError(f"No integer list found in model output: {text!r}")
@@ -104,7 +327,7 @@ class SceneSplitterGPT:
         array_text = match.group(0)
 
         try:
-            items = [int(x) for x in array_text.strip("[]").split(",")]
+            items = [int(x) for x in array_text.strip("[] \t\r\n").split(",") if x.strip()]
         except Exception as e:
             raise ValueError(f"Could not parse integer list from {array_text!r}: {e}")
 
@@ -125,6 +348,7 @@ class SceneSplitterGPT:
         # Absätze extrahieren: ein oder mehrere \n\n trennen Paragraphen
         paragraphs = re.split(r'\n\s*\n', text_chunk)
 
+        cut_after = set(indices)
         result = []
         current = []
 
@@ -132,7 +356,7 @@ class SceneSplitterGPT:
             current.append(para)
 
             # Wenn der Absatzindex in indices ist → cut
-            if i in indices:
+            if i in cut_after:
                 result.append("\n\n".join(current))
                 current = []
 
@@ -141,41 +365,22 @@ class SceneSplitterGPT:
             result.append("\n\n".join(current))
 
         return result
-    
-    def _merge_chunk_groups(self, splitted_chunks: list[list[str]]) -> list[str]:
-        
-        if not splitted_chunks:
-            return []
-
-        # Start mit erstem Unterarray
-        result = splitted_chunks[0].copy()
-
-        for chunk in splitted_chunks[1:]:
-            if not chunk:
-                continue
-
-            # Letzten Eintrag des bisherigen result mit dem ersten des neuen Arrays verbinden
-            result[-1] = result[-1] + chunk[0]
-
-            # Rest normal anhängen (ab index 1)
-            result.extend(chunk[1:])
-
-        return result
 
 class PromptGeneratorGPT:
-    def __init__(self):
+    def __init__(self, cache: LLMCache = None):
 
+        self.transport = get_transport("llm")
         if config.USE_OPENAI_API:
             print("Using OpenAI GPT model for prompt generation.")
-            self.client = OpenAI(api_key=config.OPENAI_API_KEY)
+            self.client = self.transport.openai_client(None, config.OPENAI_API_KEY)
             self.model = config.OPENAI_MODEL
         else:
             print("Using local ollama gpt model for prompt generation.")
-            self.client = OpenAI(
-                base_url="http://localhost:11434/v1",  # Local Ollama API
-                api_key="ollama"                       # Dummy key
+            self.client = self.transport.openai_client(
+                config.OLLAMA_BASE_URL,  # Local Ollama API
+                "ollama"                 # Dummy key
             )
-            self.model = "gpt-oss:20b"
+            self.model = config.OLLAMA_MODEL
 
         self.SYSTEM_PROMPT = """
             You are a tool that generates Prompts for a 360° panorama image generator.
@@ -184,17 +389,105 @@ class PromptGeneratorGPT:
             Do not include people, characters or too specific details, as this will confuse the image generator. Respond with ONLY the image prompt. Always respond ONLY in English, regardless of the input language.
         """
 
+        self.BATCH_SYSTEM_PROMPT = """
+            You are a tool that generates Prompts for a 360° panorama image generator.
+            The input given to you consists of several numbered parts of a narrative text ("### Scene <n>"), each taking place in one location. For every part, extract details about its location from the text and use them to formulate a short, simple image prompt (under 50 words).
+            If a location is surreal or abstract, describe it as accurately as possible.
+            Do not include people, characters or too specific details, as this will confuse the image generator.
+            Respond ONLY with a JSON object of the form {"prompts": [{"scene": <n>, "prompt": "<image prompt>"}, ...]} with exactly one entry per scene. Always write the prompts in English, regardless of the input language.
+        """
+
+        self.BATCH_MAX_SCENES = max(1, config.PROMPT_BATCH_MAX_SCENES)
+        self.BATCH_TOKENS = config.PROMPT_BATCH_TOKENS
+        self.BATCH_RETRIES = 1
+        # wird abgeschaltet, sobald das Backend kein JSON-Schema annimmt
+        self.structured_output = config.LLM_STRUCTURED_OUTPUT
+
+        self.cache = cache if cache is not None else get_default_cache()
+
     def generate_prompts(self, scenes: list[str]) -> list[str]:
         '''
-        Generates image prompts based on book scenes with help of an LLM
+        Generates image prompts based on book scenes with help of an LLM, several scenes per request
         
         :param scenes: Scenes that should be turned into image prompts
         :type scenes: list[str]
         :return: Image Prompt for each input scene
         :rtype: list[str]
         '''
+        prompts = []
+        batch = []
+        for scene in scenes:
+            if batch and not self.fits_batch(batch + [scene]):
+                prompts.extend(self.generate_prompt_batch(batch))
+                batch = []
+            batch.append(scene)
+        if batch:
+            prompts.extend(self.generate_prompt_batch(batch))
+        return prompts
+
+    def fits_batch(self, scene_texts: list[str]) -> bool:
+        '''
+        Checks whether the scenes fit into one request: at most BATCH_MAX_SCENES scenes, and the estimated tokens
+        of system prompt, scene texts and answers within the token budget. A single scene always fits.
+        '''
+        if len(scene_texts) <= 1:
+            return True
+        if len(scene_texts) > self.BATCH_MAX_SCENES:
+            return False
+        chars = len(self.BATCH_SYSTEM_PROMPT) + sum(len(text) + 16 for text in scene_texts)
+        tokens = chars / config.LLM_CHARS_PER_TOKEN + len(scene_texts) * config.PROMPT_ANSWER_TOKENS
+        return tokens <= self.BATCH_TOKENS
+
+    def generate_prompt_batch(self, scene_texts: list[str]) -> list[str]:
+        '''
+        Generates the image prompts for several scenes in one request.
+        The answer is validated per scene; scenes without a valid prompt are requested again together,
+        and finally one by one, so a partially broken answer never costs a whole batch.
 
-        return [self._call_openai(scene) for scene in scenes]
+        :param scene_texts: Original book texts of the scenes
+        :type scene_texts: list[str]
+        :return: image prompt for each scene
+        :rtype: list[str]
+        '''
+        if len(scene_texts) == 1:
+            return [self.generate_prompt(scene_texts[0])]
+
+        prompts = [None] * len(scene_texts)
+        cache_keys = [self.cache.make_key(self.model, self.BATCH_SYSTEM_PROMPT, text) for text in scene_texts]
+        for i, key in enumerate(cache_keys):
+            prompts[i] = self.cache.get(key)
+            MT.incr("llm_cache_hits_total" if prompts[i] is not None else "llm_cache_misses_total", kind="prompt_batch")
+
+        todo = [i for i, prompt in enumerate(prompts) if prompt is None]
+        for _ in range(self.BATCH_RETRIES + 1):
+            if len(todo) <= 1:
+                break
+            answers = self._call_openai_batch([scene_texts[i] for i in todo])
+            for j, prompt in answers.items():
+                prompts[todo[j]] = prompt
+                self.cache.put(cache_keys[todo[j]], prompt)
+
+            failed = [i for i in todo if prompts[i] is None]
+            if failed:
+                print(f"Prompt batch: no valid prompt for {len(failed)} of {len(todo)} scenes, retrying them")
+                MT.incr("llm_batch_failed_items_total", len(failed))
+            todo = failed
+
+        # übrig gebliebene Szenen einzeln nachholen
+        for i in todo:
+            prompts[i] = self.generate_prompt(scene_texts[i])
+        return prompts
+
+    def generate_prompt(self, scene_text: str) -> str:
+        '''
+        Generates the image prompt for a single book scene
+        
+        :param scene_text: Original book text of the scene
+        :type scene_text: str
+        :return: image prompt for the scene
+        :rtype: str
+        '''
+        return self._call_openai(scene_text)
 
     def _call_openai(self, scene_text: str) -> str:
         '''
@@ -205,18 +498,149 @@ class PromptGeneratorGPT:
         :return: image prompt for the scene
         :rtype: str
         '''
-        response = self.client.chat.completions.create(
-            model = self.model,
-            messages = [
-                {
-                    "role": "system", 
-                    "content": self.SYSTEM_PROMPT
-                },
-                {
-                    "role": "user", 
-                    "content": scene_text
-                }
-            ]
-        )
+        cache_key = self.cache.make_key(self.model, self.SYSTEM_PROMPT, scene_text)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            MT.incr("llm_cache_hits_total", kind="prompt")
+            return cached
+        MT.incr("llm_cache_misses_total", kind="prompt")
+
+        with MT.span("llm_call", kind="prompt"):
+            response = self.transport.call(
+                self.client.chat.completions.create,
+                model = self.model,
+                messages = [
+                    {
+                        "role": "system", 
+                        "content": self.SYSTEM_PROMPT
+                    },
+                    {
+                        "role": "user", 
+                        "content": scene_text
+                    }
+                ]
+            )
+        _record_usage(response, "prompt")
 
-        return response.choices[0].message.content
\ No newline at end of file
+        # Reasoning-Modelle liefern u.U. keinen Inhalt; leere Antworten nicht cachen
+        prompt = response.choices[0].message.content or ""
+        if prompt.strip():
+            self.cache.put(cache_key, prompt)
+        return prompt
+
+    def _call_openai_batch(self, scene_texts: list[str]) -> dict[int, str]:
+        '''
+        Calls GPT model to return image prompts for several scenes at once
+
+        :param scene_texts: Original book texts of the scenes
+        :type scene_texts: list[str]
+        :return: valid image prompts by position in scene_texts, missing for scenes without a valid prompt
+        :rtype: dict[int, str]
+        '''
+        user_text = "\n\n".join(f"### Scene {i + 1}\n{text}" for i, text in enumerate(scene_texts))
+        options = {}
+        if self.structured_output:
+            options["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "image_prompts", "strict": True, "schema": PROMPT_BATCH_SCHEMA}
+            }
+
+        with MT.span("llm_call", kind="prompt_batch"):
+            try:
+                response = self.transport.call(
+                    self.client.chat.completions.create,
+                    model = self.model,
+                    messages = [
+                        {
+                            "role": "system",
+                            "content": self.BATCH_SYSTEM_PROMPT
+                        },
+                        {
+                            "role": "user",
+                            "content": user_text
+                        }
+                    ],
+                    **options
+                )
+            except openai.BadRequestError:
+                if not self.structured_output:
+                    raise
+                # Backend kennt kein JSON-Schema: das Format gibt dann nur der System-Prompt vor
+                print("LLM backend does not support structured output, falling back to plain JSON")
+                self.structured_output = False
+                return self._call_openai_batch(scene_texts)
+        _record_usage(response, "prompt_batch")
+
+        return _parse_prompt_batch(response.choices[0].message.content or "", len(scene_texts))
+
+
+# Erstes Array aus ganzen Zahlen in einer Modellantwort, z.B. [3, 7] oder []
+INT_LIST_PATTERN = re.compile(r"\[\s*(?:-?\d+(?:\s*,\s*-?\d+)*)?\s*\]")
+
+# Antwortformat der Batch-Prompts: Szenennummer zu jedem Prompt, damit fehlende Einträge erkennbar sind
+PROMPT_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "prompts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"scene": {"type": "integer"}, "prompt": {"type": "string"}},
+                "required": ["scene", "prompt"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["prompts"],
+    "additionalProperties": False
+}
+
+
+def _parse_prompt_batch(content: str, count: int) -> dict[int, str]:
+    '''
+    Extracts the valid prompts from a batch answer ({"prompts": [{"scene": n, "prompt": ...}]}, also accepted
+    without the outer object or as plain list of exactly count strings)
+
+    :return: prompts by position (scene number - 1)
+    :rtype: dict[int, str]
+    '''
+    try:
+        data = json.loads(content)
+    except ValueError:
+        # Text vor oder nach dem JSON (z.B. Begründungen von Reasoning-Modellen) abschneiden
+        match = re.search(r"[\[{].*[\]}]", content, re.DOTALL)
+        try:
+            data = json.loads(match.group()) if match else None
+        except ValueError:
+            data = None
+
+    if isinstance(data, dict):
+        data = data.get("prompts")
+    if not isinstance(data, list):
+        return {}
+
+    # reine Liste von Prompts nur bei passender Anzahl eindeutig zuzuordnen
+    if len(data) == count and all(isinstance(item, str) for item in data):
+        return {i: item.strip() for i, item in enumerate(data) if item.strip()}
+
+    prompts = {}
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        try:
+            scene = int(item.get("scene"))
+        except (TypeError, ValueError):
+            continue
+        prompt = item.get("prompt")
+        if 1 <= scene <= count and isinstance(prompt, str) and prompt.strip():
+            prompts.setdefault(scene - 1, prompt.strip())
+    return prompts
+
+
+def _record_usage(response, kind: str):
+    # Token-Zähler, falls das Backend sie liefert (Ollama und OpenAI tun das)
+    MT.incr("llm_calls_total", kind=kind)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        MT.incr("llm_tokens_in_total", usage.prompt_tokens or 0, kind=kind)
+        MT.incr("llm_tokens_out_total", usage.completion_tokens or 0, kind=kind)
@@ -0,0 +1,245 @@
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+import config
+from modules.book_store import BookStore
+
+# Häufige deutsche und englische Wörter, die weder indexiert noch gesucht werden
+STOPWORDS = {
+    "der", "die", "das", "den", "dem", "des", "ein", "eine", "einer", "eines", "einem", "einen", "und", "oder", "aber",
+    "ist", "war", "sind", "waren", "sein", "hat", "hatte", "ich", "du", "er", "sie", "es", "wir", "ihr", "mich", "dich",
+    "sich", "ihn", "ihm", "ihnen", "zu", "zum", "zur", "mit", "von", "vom", "im", "in", "an", "am", "auf", "aus", "bei",
+    "nach", "für", "nicht", "als", "auch", "so", "wie", "dass", "da", "wo", "wenn", "noch", "nur", "schon",
+    "a", "the", "and", "or", "but", "of", "on", "at", "with", "by", "to", "from", "for", "is", "are", "was",
+    "were", "be", "it", "its", "he", "she", "they", "his", "her", "their", "this", "that", "as", "not",
+}
+
+# Buchstaben, nach denen ein End-s bzw. End-st im Deutschen eine Flexionsendung ist
+_S_ENDING = set("bdfghklmnrt")
+_ST_ENDING = set("bdfghklmnt")
+
+_FOLDING = str.maketrans({"ä": "a", "à": "a", "á": "a", "â": "a", "ö": "o", "ó": "o", "ô": "o", "ü": "u", "ú": "u",
+                          "û": "u", "é": "e", "è": "e", "ê": "e", "ß": "ss"})
+
+
+def stem(word: str) -> str:
+    '''
+    Light stemmer for German and English words (after J. Savoy, as in Lucene's GermanLightStemmer):
+    folds umlauts and strips inflection endings, e.g. "Häuser" -> "haus", "Waldes" -> "wald", "trees" -> "tre"
+    '''
+    word = word.lower().translate(_FOLDING)
+
+    if len(word) > 5 and word.endswith("ern"):
+        word = word[:-3]
+    elif len(word) > 4 and word.endswith(("em", "en", "er", "es")):
+        word = word[:-2]
+    elif len(word) > 3 and word.endswith("e"):
+        word = word[:-1]
+    elif len(word) > 3 and word.endswith("s") and word[-2] in _S_ENDING:
+        word = word[:-1]
+
+    if len(word) > 5 and word.endswith("est"):
+        word = word[:-3]
+    elif len(word) > 4 and word.endswith(("er", "en")):
+        word = word[:-2]
+    elif len(word) > 4 and word.endswith("st") and word[-3] in _ST_ENDING:
+        word = word[:-2]
+
+    return word
+
+
+def terms(text: str) -> list[str]:
+    '''
+    Splits a text into stemmed index terms without stopwords
+    '''
+    return [stem(w) for w in re.findall(r"\w+", text.lower()) if w not in STOPWORDS]
+
+
+def snippet(text: str, query: str, width: int = 160) -> str:
+    '''
+    Returns the part of a scene text around the first word matching the query
+    '''
+    query_terms = terms(query)
+    start = 0
+    for match in re.finditer(r"\w+", text):
+        if query_terms and match.group().lower() not in STOPWORDS:
+            term = stem(match.group())
+            if term in query_terms or term.startswith(query_terms[-1]):
+                start = max(0, match.start() - width // 3)
+                break
+
+    # an Wortgrenzen schneiden
+    if start > 0:
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < start + 20 else start
+    end = min(len(text), start + width)
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        end = space if space > start else end
+
+    return ("…" if start > 0 else "") + text[start:end].strip() + ("…" if end < len(text) else "")
+
+
+class SearchIndex:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS scenes (
+            id INTEGER PRIMARY KEY,
+            book_id TEXT NOT NULL,
+            idx INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS scenes_book ON scenes (book_id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS scene_terms USING fts5(text, image_prompt, prefix='2 3');
+        CREATE TABLE IF NOT EXISTS indexed_books (
+            book_id TEXT PRIMARY KEY,
+            revision TEXT
+        );
+    '''
+
+    def __init__(self, db_path: Path, text_weight: float = 1.0, prompt_weight: float = 0.5):
+        '''
+        Persistent full-text index over the scene texts and image prompts of all books (SQLite FTS5, ranked with BM25).
+        Texts are indexed as stemmed terms (see stem), so "Hexe" also finds "Hexen" and, as last word of a query, "Hexenhaus".
+        Books are re-indexed as a whole whenever their revision in the book store changes.
+
+        :param db_path: path of the index file (can be deleted, it is rebuilt from the book store)
+        :type db_path: Path
+        :param text_weight: BM25 weight of matches in the scene text
+        :type text_weight: float
+        :param prompt_weight: BM25 weight of matches in the image prompt
+        :type prompt_weight: float
+        '''
+        self.DB_PATH = db_path
+        self.TEXT_WEIGHT = text_weight
+        self.PROMPT_WEIGHT = prompt_weight
+        self.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+        # eine Verbindung pro Thread, wie im SqliteBookStore
+        self._local = threading.local()
+        self._connection().executescript(self.SCHEMA)
+
+    def update_book(self, book_id: str, data: dict, revision: str | None = None):
+        '''
+        (Re-)indexes all scenes of a book
+
+        :param book_id: id of the book
+        :type book_id: str
+        :param data: book data with the list "scenes"
+        :type data: dict
+        :param revision: revision of the book in the book store, lets sync skip the book until it changes
+        :type revision: str | None
+        '''
+        rows = [
+            (index, " ".join(terms(scene.get("text") or "")), " ".join(terms(scene.get("image_prompt") or "")))
+            for index, scene in enumerate(data.get("scenes", []))
+        ]
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete_scenes(db, book_id)
+            for index, text, prompt in rows:
+                scene_id = db.execute("INSERT INTO scenes (book_id, idx) VALUES (?, ?)", (book_id, index)).lastrowid
+                db.execute("INSERT INTO scene_terms (rowid, text, image_prompt) VALUES (?, ?, ?)", (scene_id, text, prompt))
+            db.execute("INSERT INTO indexed_books (book_id, revision) VALUES (?, ?) "
+                       "ON CONFLICT (book_id) DO UPDATE SET revision = excluded.revision", (book_id, revision))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def remove_book(self, book_id: str):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete_scenes(db, book_id)
+            db.execute("DELETE FROM indexed_books WHERE book_id = ?", (book_id,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def sync(self, store: BookStore) -> int:
+        '''
+        Brings the index up to date with the book store: indexes new and changed books, removes deleted ones
+
+        :param store: book store to index
+        :type store: BookStore
+        :return: number of re-indexed books
+        :rtype: int
+        '''
+        revisions = store.revisions()
+        indexed = dict(self._connection().execute("SELECT book_id, revision FROM indexed_books"))
+
+        for book_id in indexed.keys() - revisions.keys():
+            self.remove_book(book_id)
+
+        changed = [book_id for book_id, revision in sorted(revisions.items()) if indexed.get(book_id) != revision]
+        for book_id in changed:
+            try:
+                data = store.read_book(book_id)
+            except Exception:
+                continue  # unlesbares Buch, beim nächsten Abgleich erneut versuchen
+            self.update_book(book_id, data, revisions[book_id])
+        return len(changed)
+
+    def search(self, query: str, limit: int = config.SEARCH_LIMIT, book_id: str | None = None) -> list[tuple[str, int, float]]:
+        '''
+        Finds the scenes containing all words of the query, the last word also as prefix (search as you type)
+
+        :param query: search words
+        :type query: str
+        :param limit: maximum number of results
+        :type limit: int
+        :param book_id: only search in this book
+        :type book_id: str | None
+        :return: (book id, scene index, score) of the best matches, best first
+        :rtype: list[tuple[str, int, float]]
+        '''
+        query_terms = list(dict.fromkeys(terms(query)))
+        if not query_terms:
+            return []
+
+        # Terme bestehen nur aus Wortzeichen, Anführungszeichen schützen vor FTS5-Operatoren wie AND/OR/NOT.
+        # Präfixsuche erst ab zwei Buchstaben, sonst passt fast jedes Wort
+        match = " ".join(f'"{t}"' for t in query_terms)
+        if len(query_terms[-1]) >= 2:
+            match += "*"
+        sql = ("SELECT s.book_id, s.idx, bm25(scene_terms, ?, ?) AS rank "
+               "FROM scene_terms JOIN scenes s ON s.id = scene_terms.rowid WHERE scene_terms MATCH ?")
+        params = [self.TEXT_WEIGHT, self.PROMPT_WEIGHT, match]
+        if book_id is not None:
+            sql += " AND s.book_id = ?"
+            params.append(book_id)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+
+        # bm25() ist negativ, kleinere Werte = bessere Treffer
+        return [(b, int(i), round(-rank, 4)) for b, i, rank in self._connection().execute(sql, params)]
+
+    def _delete_scenes(self, db: sqlite3.Connection, book_id: str):
+        db.execute("DELETE FROM scene_terms WHERE rowid IN (SELECT id FROM scenes WHERE book_id = ?)", (book_id,))
+        db.execute("DELETE FROM scenes WHERE book_id = ?", (book_id,))
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.DB_PATH, timeout=30.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+def get_search_index() -> SearchIndex:
+    '''
+    Returns the search index shared by all modules of this process
+    '''
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = SearchIndex(Path(config.SEARCH_INDEX_FILE))
+        return _default_index
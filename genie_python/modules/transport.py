@@ -0,0 +1,218 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+import openai
+import requests
+from openai import OpenAI
+from requests.adapters import HTTPAdapter
+
+import config
+from modules import metrics as MT
+
+# Statuscodes, bei denen sich ein erneuter Versuch lohnt; 429/503 bedeuten zusätzlich "Backend überlastet"
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+OVERLOAD_STATUSES = {429, 503}
+
+
+class AdaptiveLimiter:
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        '''
+        Concurrency limit that adapts to the backend (AIMD): it halves whenever the backend reports overload
+        and grows by one again after a full limit's worth of successful calls.
+
+        :param max_limit: upper bound and initial value of the limit
+        :type max_limit: int
+        :param min_limit: lower bound of the limit
+        :type min_limit: int
+        '''
+        self.MAX_LIMIT = max(1, max_limit)
+        self.MIN_LIMIT = max(1, min(min_limit, self.MAX_LIMIT))
+
+        self.limit = self.MAX_LIMIT
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        '''
+        Waits for a free slot and holds it for the duration of the with-block
+        '''
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def record_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.MAX_LIMIT:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def record_overload(self):
+        with self._cond:
+            self.limit = max(self.MIN_LIMIT, self.limit // 2)
+            self._successes = 0
+
+
+class Transport:
+    def __init__(self, name: str, max_concurrency: int,
+                 max_retries: int = config.HTTP_MAX_RETRIES,
+                 timeout: float | tuple = config.HTTP_TIMEOUT,
+                 backoff_base: float = config.HTTP_BACKOFF_BASE,
+                 backoff_max: float = config.HTTP_BACKOFF_MAX):
+        '''
+        Shared access to one kind of backend (LLM or image generation): pooled keep-alive connections, timeouts,
+        retries with exponential backoff and full jitter, and an adaptive concurrency limit.
+
+        :param name: name of the backend, used in log output
+        :type name: str
+        :param max_concurrency: maximum number of concurrent calls
+        :type max_concurrency: int
+        :param max_retries: number of retries after a transient failure
+        :type max_retries: int
+        :param timeout: request timeout in seconds, or (connect, read) tuple
+        :type timeout: float | tuple
+        :param backoff_base: delay before the first retry in seconds, doubled for each further retry
+        :type backoff_base: float
+        :param backoff_max: maximum delay between two retries in seconds
+        :type backoff_max: float
+        '''
+        self.name = name
+        self.MAX_RETRIES = max_retries
+        self.TIMEOUT = timeout
+        self.BACKOFF_BASE = backoff_base
+        self.BACKOFF_MAX = backoff_max
+
+        self.limiter = AdaptiveLimiter(max_concurrency)
+        self.retries = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, max_concurrency))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._openai_clients = {}
+        self._lock = threading.Lock()
+
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        '''
+        Calls fn within the concurrency limit and retries it on transient errors (connection errors, timeouts, 408/429/5xx)
+
+        :param fn: function performing the request
+        :type fn: Callable
+        :return: return value of fn
+        :rtype: Any
+        '''
+        attempt = 0
+        while True:
+            with self.limiter.slot():
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    retryable, overloaded = classify_error(e)
+                    if overloaded:
+                        self.limiter.record_overload()
+                        MT.incr("backend_overloads_total", backend=self.name)
+                    if not retryable or attempt >= self.MAX_RETRIES:
+                        raise
+                    error = e
+                else:
+                    self.limiter.record_success()
+                    return result
+
+            # Warten außerhalb des Slots, damit andere Aufrufe weiterlaufen
+            delay = _retry_after(error)
+            if delay is None:
+                delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            MT.incr("http_retries_total", backend=self.name)
+            print(f"{self.name}: {type(error).__name__} ({error}), retry {attempt}/{self.MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def post_json(self, url: str, payload: dict, timeout: float | tuple | None = None) -> dict:
+        '''
+        Sends a JSON POST request over the pooled session and returns the parsed JSON response
+        '''
+        def post():
+            response = self.session.post(url, json=payload, timeout=timeout or self.TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+
+        return self.call(post)
+
+    def openai_client(self, base_url: str | None, api_key: str) -> OpenAI:
+        '''
+        Returns an OpenAI client shared by all callers with the same endpoint, so they reuse its keep-alive connection pool.
+        Retries are handled by call(), so the client's own retries are disabled.
+        '''
+        with self._lock:
+            key = (base_url, api_key)
+            if key not in self._openai_clients:
+                self._openai_clients[key] = OpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    timeout=config.LLM_TIMEOUT,
+                    max_retries=0
+                )
+            return self._openai_clients[key]
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def get_transport(name: str) -> Transport:
+    '''
+    Returns the transport shared by all callers of a backend. The Stable Diffusion backends use modules.backend_pool instead.
+    '''
+    with _transports_lock:
+        if name not in _transports:
+            if name == "llm":
+                _transports[name] = Transport(name, config.LLM_MAX_CONCURRENCY, timeout=config.LLM_TIMEOUT)
+            else:
+                raise ValueError(f"Unknown transport: {name}")
+        return _transports[name]
+
+
+def classify_error(error: Exception) -> tuple[bool, bool]:
+    '''
+    Classifies a failed request
+
+    :return: (worth retrying, backend reports overload)
+    :rtype: tuple[bool, bool]
+    '''
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, openai.APIConnectionError)):
+        return True, False
+
+    status = getattr(error, "status_code", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+
+    if status is None:
+        return False, False
+    return status in RETRY_STATUSES, status in OVERLOAD_STATUSES
+
+
+def _retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return min(float(headers.get("retry-after")), config.HTTP_BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return None
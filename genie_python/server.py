@@ -1,101 +1,376 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 import config
-from pathlib import Path 
+import asyncio
 import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path 
+from urllib.parse import parse_qs
+
+import generate_vrbook as GV
+from modules import book_store as BS
+from modules import bundle as BD
+from modules import cubemap as CM
+from modules import http_cache as HC
+from modules import metrics as MT
+from modules import search_index as SI
+from modules.catalog import BookCatalog
+from modules.image_derivatives import DerivativeStore, media_type
+from modules.jobs import JobService
 
 DATA_ROOT = Path(config.DATABASE_DIRECTORY)
+# books can be uploaded to a server that starts without any book
+DATA_ROOT.mkdir(parents=True, exist_ok=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # books changed while the server was down are indexed before the first search
+    search_index.sync(catalog.store)
+    # queued and interrupted generation jobs are resumed on startup
+    job_service.start()
+    yield
+    postprocess_pool.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+# request latency and response bytes per route, exposed under /metrics
+app.add_middleware(MT.MetricsMiddleware)
+
+# in-memory index of all books, refreshed when their revision in the book store changes
+catalog = BookCatalog(DATA_ROOT, BS.get_book_store())
+
+# full-text index over scene texts and image prompts
+search_index = SI.get_search_index()
+
+# serialized and compressed JSON responses, keyed by book content hash
+response_cache = HC.ResponseCache()
+
+# compressed, downscaled versions of the panorama images
+derivatives = DerivativeStore(DATA_ROOT)
+
+# offline bundles (metadata, scene texts and panoramas in one file) of the books
+bundles = BD.BundleStore(derivatives)
+
+# cubemap conversions run on their own pool (like the postprocessing of the pipeline), not in the request threads;
+# the six faces of a panorama are requested in parallel, but only converted once: requests for a panorama that is
+# being converted wait for the running conversion, conversions of different panoramas run side by side
+postprocess_pool = ThreadPoolExecutor(max_workers=config.POSTPROCESS_WORKERS)
+cubemap_conversions = {}
+cubemap_conversions_lock = threading.Lock()
+
+# uploaded books are generated in background threads, several at a time
+job_service = JobService(
+    Path(config.JOBS_DIRECTORY),
+    lambda book_path, title, author, prompts_only, on_progress: GV.generate_vrbook(
+        book_path, title, author, prompts_only=prompts_only, on_progress=on_progress
+    )
+)
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles with Cache-Control headers. URLs whose version parameter (?v=..., see image_url in get_book) matches
+    the current st_mtime_ns of the file point to exactly this file version and may be cached forever; stale or
+    made-up versions only get STATIC_MAX_AGE, so an outdated image is never pinned in the client cache.
+    """
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if response.status_code in (200, 304):
+            versions = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("v", [])
+            if versions == [str(stat_result.st_mtime_ns)]:
+                response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+            else:
+                response.headers["Cache-Control"] = f"public, max-age={config.STATIC_MAX_AGE}"
+        return response
 
-app = FastAPI()
 
 # static endpoint for images 
-app.mount("/static", StaticFiles(directory=str(DATA_ROOT)), name="static")
+app.mount("/static", CachedStaticFiles(directory=str(DATA_ROOT)), name="static")
+
+
+def _json_response(request: Request, etag: str, key: tuple, build) -> Response:
+    """
+    Builds a JSON response with ETag validation (304 on If-None-Match) and gzip/brotli compression.
+    The serialized and compressed body is cached, so unchanged books are never re-encoded.
+    """
+    etag_header = f'W/"{etag}"'
+    headers = {"ETag": etag_header, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    if HC.etag_matches(request.headers.get("if-none-match"), etag_header):
+        return Response(status_code=304, headers=headers)
+
+    encoding = HC.negotiate_encoding(request.headers.get("accept-encoding"))
+
+    def encode() -> tuple[bytes, str]:
+        body = json.dumps(build(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # kleine Antworten lohnen die Kompression nicht
+        if len(body) < config.COMPRESSION_MIN_BYTES:
+            return body, "identity"
+        return HC.compress(body, encoding), encoding
+
+    body, body_encoding = response_cache.get_or_build((etag, key, encoding), encode)
+    if body_encoding != "identity":
+        headers["Content-Encoding"] = body_encoding
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _load_book(book_id: str) -> dict:
+    """
+    Returns the catalog entry of a book or raises the matching HTTP error
+    """
+    entry = catalog.get_book(book_id)
+
+    if entry is None:
+        if (DATA_ROOT / book_id).is_dir():
+            raise HTTPException(status_code=500, detail="Book data missing")
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    if entry["detail"] is None:
+        raise HTTPException(status_code=500, detail="Book data invalid")
+
+    return entry
+
+
+def _check_scene_index(book_id: str, index: int) -> int:
+    if index < 0 or index >= _load_book(book_id)["detail"]["num_scenes"]:
+        raise HTTPException(status_code=404, detail="Scene not found")
+    return index
 
 
 @app.get("/books")
-def book_overview():
+def book_overview(request: Request):
     """
     Returns a list of all available books in the file database.
-    Each book is a folder inside DATA_ROOT containing book.json.
+    Each book is stored in the book store (book.json in a folder inside DATA_ROOT, or the SQLite database).
     """
-    books = []
+    return _json_response(request, catalog.overview_etag(), ("books",), lambda: {"books": catalog.list_books()})
 
-    if not DATA_ROOT.exists():
-        return {"books": []}
 
-    # Jeden Unterordner durchsuchen
-    for book_dir in DATA_ROOT.iterdir(): 
-        if not book_dir.is_dir():
-            continue
+@app.post("/books", status_code=202)
+async def upload_book(request: Request, title: str, author: str | None = None,
+                      book_id: str | None = Query(None, alias="id"), prompts_only: bool = False, replace: bool = False):
+    """
+    Uploads a book text (request body, UTF-8 plain text) and queues its generation, e.g.
+    curl --data-binary @rotkaeppchen.txt "http://localhost:8000/books?title=Rotkäppchen&author=Brüder%20Grimm"
+    The book id is derived from the title unless given as ?id=. An existing book is only regenerated with ?replace=true.
+    Returns the job, whose progress is available under /jobs/<job-id>.
+    """
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > config.MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Book text too large")
 
-        json_file = book_dir / "book.json"
-        if not json_file.exists():
-            continue
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Book text must be UTF-8")
+    if not text.strip():
+        raise HTTPException(status_code=400, detail="Book text is empty")
 
-        # JSON lesen
-        try:
-            with json_file.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-        except Exception:
-            continue  # falls eine Datei kaputt ist
+    try:
+        job = await run_in_threadpool(job_service.submit, text, title, author, book_id, prompts_only, replace)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileExistsError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
-        # Antwort-Objekt erstellen
-        books.append({
-            "id": data.get("id", None),
-            "title": data.get("title", book_dir.name),
-            "author": data.get("author"),
-            "num_scenes": len(data.get("scenes", [])),
-            "cover": data.get("cover", None)
-        })
+    return JSONResponse(job, status_code=202, headers={"Location": f"/jobs/{job['id']}"})
 
-    return {"books": books}
+
+@app.get("/jobs")
+def list_jobs():
+    """
+    Returns all generation jobs, newest first
+    """
+    return {"jobs": job_service.list_jobs()}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """
+    Returns status and progress of a generation job:
+    status "queued", "running", "done" or "failed"; progress counts split scenes, prompts and finished panoramas
+    (previews first, if enabled), "readable" turns true once the book is published and "refined" counts final panoramas
+    """
+    job = job_service.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/search")
+def search(request: Request,
+           q: str = Query(..., min_length=1, max_length=200),
+           limit: int = Query(config.SEARCH_LIMIT, ge=1, le=config.SEARCH_LIMIT_MAX),
+           book: str | None = None):
+    """
+    Searches the scene texts and image prompts of all books, e.g. /search?q=Wolf%20Großmutter
+    Returns the best matching scenes (book id, scene index, score, text snippet); ?book=<book-id> restricts the search to one book.
+    """
+    def build() -> dict:
+        # Bücher, die sich seit dem letzten Abgleich geändert haben, neu indexieren
+        search_index.sync(catalog.store)
+
+        results = []
+        for book_id, index, score in search_index.search(q, limit, book):
+            entry = catalog.get_book(book_id)
+            if entry is None or entry["detail"] is None or index >= entry["detail"]["num_scenes"]:
+                continue
+            scene = entry["detail"]["scenes"][index]
+            results.append({
+                "book_id": book_id,
+                "title": entry["detail"]["title"],
+                "index": index,
+                "score": score,
+                "snippet": SI.snippet(scene["text"] or "", q),
+                "image_url": scene["image_url"],
+            })
+        return {"query": q, "results": results}
+
+    # Die Treffer ändern sich nur, wenn sich ein Buch ändert
+    return _json_response(request, catalog.overview_etag(), ("search", q, limit, book), build)
 
 
 @app.get("/books/{book_id}")
-def get_book(book_id: str):
+def get_book(book_id: str, request: Request):
     """
     Gibt ein komplettes Buch zurück:
     - Metadaten
     - alle Szenen
     - pro Szene: Text, Prompt, Bild-URL
     """
-    book_dir = DATA_ROOT / book_id
+    entry = _load_book(book_id)
+    return _json_response(request, entry["etag"], ("book", book_id), lambda: entry["detail"])
 
-    if not book_dir.exists() or not book_dir.is_dir():
-        raise HTTPException(status_code=404, detail="Book not found")
 
-    json_file = book_dir / "book.json"
-    if not json_file.exists():
-        raise HTTPException(status_code=500, detail="book.json missing")
-
-    with json_file.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    scenes_out = []
-    for scene in data.get("scenes", []):
-        image_file = scene.get("image_file")
-        image_url = None
-
-        if image_file:
-            img_path = book_dir / image_file
-            if img_path.exists():
-                # URL, unter der FastAPI das Bild ausliefert
-                image_url = f"/static/{book_id}/{image_file}"
-
-        scenes_out.append({
-            "index": scene.get("index"),
-            "text": scene.get("text"),
-            "image_prompt": scene.get("image_prompt"),
-            "image_file": image_file,
-            "image_url": image_url,
-        })
-
-    return {
-        "id": book_id,
-        "title": data.get("title", book_id),
-        "author": data.get("author"),
-        "source_file": data.get("source_file"),
-        "created_at": data.get("created_at"),
-        "num_scenes": len(scenes_out),
-        "scenes": scenes_out,
-    }
\ No newline at end of file
+@app.get("/books/{book_id}/scenes")
+def get_scenes(book_id: str, request: Request,
+               offset: int = Query(0, ge=0),
+               limit: int = Query(config.SCENE_PAGE_SIZE, ge=1, le=config.SCENE_PAGE_MAX)):
+    """
+    Returns a page of scenes of a book, e.g. /books/<book-id>/scenes?offset=20&limit=10
+    """
+    entry = _load_book(book_id)
+
+    def build() -> dict:
+        detail = entry["detail"]
+        scenes = detail["scenes"][offset:offset + limit]
+        next_offset = offset + limit if offset + limit < detail["num_scenes"] else None
+        return {
+            "id": book_id,
+            "num_scenes": detail["num_scenes"],
+            "offset": offset,
+            "limit": limit,
+            "next_offset": next_offset,
+            "scenes": scenes,
+        }
+
+    return _json_response(request, entry["etag"], ("scenes", book_id, offset, limit), build)
+
+
+@app.get("/books/{book_id}/scenes/{index}")
+def get_scene(book_id: str, index: int, request: Request):
+    """
+    Returns a single scene of a book
+    """
+    entry = _load_book(book_id)
+    _check_scene_index(book_id, index)
+    return _json_response(request, entry["etag"], ("scene", book_id, index), lambda: entry["detail"]["scenes"][index])
+
+
+@app.get("/books/{book_id}/bundle")
+def get_bundle(book_id: str):
+    """
+    Returns a book as one bundle file for offline reading (format see modules/bundle.py).
+    The bundle is built on first request and rebuilt when the book or its images change;
+    interrupted downloads can be resumed with Range requests (If-Range with the returned ETag).
+    """
+    entry = _load_book(book_id)
+    path = bundles.get(book_id, entry["data"])
+    return FileResponse(path, media_type=BD.MEDIA_TYPE, filename=f"{book_id}.genie",
+                        headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/images/{image_file:path}")
+def get_image(image_file: str, request: Request, width: int | None = None, format: str | None = None, preview: bool = False):
+    """
+    Returns a compressed version of an image from the database, e.g. /images/<book-id>/scene_0.png?width=2048
+    - width: requested width in pixels (rounded up to the next available width)
+    - format: "jpeg" or "webp"; without it WebP is only returned if the Accept header allows it
+    - preview: tiny, heavily compressed version for placeholders
+    """
+    if format is None:
+        format = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+
+    try:
+        path = derivatives.get(image_file, width, format, preview)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return FileResponse(path, media_type=media_type(format), headers={"Vary": "Accept"})
+
+
+@app.get("/books/{book_id}/scenes/{index}/cubemap/{face}")
+async def get_cubemap_face(book_id: str, index: int, face: str):
+    """
+    Returns one face (px, nx, py, ny, pz, nz) of the cubemap of a scene panorama.
+    Faces that were not generated together with the panorama are converted on first request.
+    """
+    if face not in CM.FACES:
+        raise HTTPException(status_code=404, detail="Unknown cube face")
+
+    image_file, up_to_date = await run_in_threadpool(_cubemap_state, book_id, index)
+    if not up_to_date:
+        await asyncio.wrap_future(_convert_cubemap(image_file))
+
+    return FileResponse(DATA_ROOT / CM.face_path(image_file, face), media_type="image/jpeg")
+
+
+def _cubemap_state(book_id: str, index: int) -> tuple[str, bool]:
+    scene = _load_book(book_id)["detail"]["scenes"][_check_scene_index(book_id, index)]
+
+    image_file = scene["image_file"]
+    if not image_file or not (DATA_ROOT / image_file).is_file():
+        raise HTTPException(status_code=404, detail="Image not found")
+    return image_file, CM.is_up_to_date(DATA_ROOT, image_file)
+
+
+def _convert_cubemap(image_file: str) -> Future:
+    with cubemap_conversions_lock:
+        future = cubemap_conversions.get(image_file)
+        if future is not None:
+            return future
+        future = cubemap_conversions[image_file] = postprocess_pool.submit(_update_cubemap, image_file)
+    # außerhalb des Locks: bei schon fertigem Future läuft der Callback sofort in diesem Thread
+    future.add_done_callback(lambda done: _forget_conversion(image_file, done))
+    return future
+
+
+def _forget_conversion(image_file: str, future: Future):
+    with cubemap_conversions_lock:
+        if cubemap_conversions.get(image_file) is future:
+            del cubemap_conversions[image_file]
+
+
+def _update_cubemap(image_file: str):
+    if not CM.is_up_to_date(DATA_ROOT, image_file):
+        CM.generate_cubemap(DATA_ROOT, image_file)
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Returns request metrics in the Prometheus text format
+    """
+    return PlainTextResponse(MT.get_registry().render_prometheus(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Module werden wie in generate_vrbook.py und server.py relativ zu genie_python importiert
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
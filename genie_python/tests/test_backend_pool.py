@@ -0,0 +1,90 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from modules.backend_pool import BackendPool
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    # Antwortet auf die ersten FAILURES POST-Requests mit 500, danach normal
+    FAILURES = 1
+    posts = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._send(200, {"progress": 0.0})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).posts += 1
+        if type(self).posts <= self.FAILURES:
+            self._send(500, {"error": "transient"})
+        else:
+            self._send(200, {"images": ["ok"]})
+
+    def _send(self, status: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def flaky_server():
+    handler = type("Handler", (FlakyHandler,), {"posts": 0})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", handler
+    server.shutdown()
+    server.server_close()
+
+
+def _closed_port_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+
+def _pool(urls: list[str]) -> BackendPool:
+    pool = BackendPool("test", urls, health_check_interval=3600)
+    pool.transport.BACKOFF_BASE = 0.01
+    return pool
+
+
+def test_single_backend_recovers_from_transient_error(flaky_server):
+    url, handler = flaky_server
+    pool = _pool([url])
+
+    assert pool.post_json("/sdapi/v1/txt2img", {}) == {"images": ["ok"]}
+    assert handler.posts == 2
+    assert pool.backends[0].healthy
+
+
+def test_single_unreachable_backend_is_probed_again(flaky_server):
+    url, handler = flaky_server
+    handler.FAILURES = 0
+    pool = _pool([url])
+    # z.B. vom Health Check als ausgefallen markiert, inzwischen aber wieder erreichbar
+    pool.backends[0].healthy = False
+
+    assert pool.post_json("/sdapi/v1/txt2img", {}) == {"images": ["ok"]}
+    assert pool.backends[0].healthy
+
+
+def test_unreachable_backend_is_skipped(flaky_server):
+    url, handler = flaky_server
+    handler.FAILURES = 0
+    pool = _pool([_closed_port_url(), url])
+    pool.backends[1].outstanding = 1  # erste Anfrage geht an die nicht erreichbare Instanz
+
+    assert pool.post_json("/sdapi/v1/txt2img", {}) == {"images": ["ok"]}
+    assert not pool.backends[0].healthy
+    assert pool.backends[1].healthy
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from modules import book_store as BS
+
+BOOK = {"id": "buch", "title": "Buch", "scenes": [{"index": i, "quality": "preview"} for i in range(4)]}
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "json":
+        store = BS.JsonBookStore(tmp_path)
+    else:
+        store = BS.SqliteBookStore(tmp_path / "books.sqlite3")
+    store.write_book("buch", BOOK)
+    return store
+
+
+def test_update_scenes_writes_all_scenes_at_once(store):
+    revision = store.revision("buch")
+    store.update_scenes("buch", {1: {"quality": "final"}, 3: {"quality": "final"}})
+
+    assert [scene["quality"] for scene in store.read_book("buch")["scenes"]] == ["preview", "final", "preview", "final"]
+    assert store.revision("buch") != revision
+
+
+def test_update_scenes_with_unknown_scene_changes_nothing(store):
+    with pytest.raises(IndexError):
+        store.update_scenes("buch", {0: {"quality": "final"}, 9: {"quality": "final"}})
+    assert store.read_scene("buch", 0)["quality"] == "preview"
+
+
+def test_json_writers_of_different_books_do_not_block_each_other(tmp_path):
+    store = BS.JsonBookStore(tmp_path)
+    store.write_book("buch", BOOK)
+
+    done = threading.Event()
+    with store._locked("buch"):
+        writer = threading.Thread(target=lambda: (store.write_book("anderes", BOOK), done.set()))
+        writer.start()
+        assert done.wait(5)
+    writer.join()
+    assert store.exists("anderes")
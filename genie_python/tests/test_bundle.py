@@ -0,0 +1,26 @@
+import os
+
+from modules.bundle import BundleReader, BundleStore
+from modules.image_derivatives import DerivativeStore
+
+
+def _book(text):
+    return {"id": "buch", "title": "Buch", "scenes": [{"index": 0, "text": text}]}
+
+
+def test_outdated_bundles_are_kept_for_running_downloads(tmp_path):
+    bundles = BundleStore(DerivativeStore(tmp_path / "db", tmp_path / "deriv"), tmp_path / "bundles", retention=60)
+
+    first = bundles.get("buch", _book("eins"))
+    second = bundles.get("buch", _book("zwei"))
+    assert first.exists() and second.exists()
+
+    # die vorige Version bleibt immer, ältere nur für die Aufbewahrungszeit
+    third = bundles.get("buch", _book("drei"))
+    assert first.exists() and second.exists()
+    os.utime(first, (0, 0))
+    fourth = bundles.get("buch", _book("vier"))
+    assert sorted(p.name for p in (tmp_path / "bundles").iterdir()) == sorted(p.name for p in (second, third, fourth))
+
+    with BundleReader(fourth) as reader:
+        assert reader.scene_text(0) == "vier"
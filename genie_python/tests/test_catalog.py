@@ -0,0 +1,28 @@
+from modules import book_store as BS
+from modules.catalog import BookCatalog
+
+
+def _catalog(tmp_path):
+    store = BS.JsonBookStore(tmp_path)
+    store.write_book("buch", {"id": "buch", "title": "Buch", "scenes": [{"index": 0, "text": "Wald"}]})
+    return store, BookCatalog(tmp_path, store, refresh_interval=0)
+
+
+def test_etag_is_kept_when_book_is_rewritten_unchanged(tmp_path):
+    store, catalog = _catalog(tmp_path)
+    etag = catalog.get_book("buch")["etag"]
+
+    store.write_book("buch", store.read_book("buch"))
+    assert catalog.get_book("buch")["etag"] == etag
+
+
+def test_etag_changes_with_same_size_content_change(tmp_path):
+    store, catalog = _catalog(tmp_path)
+    etag = catalog.get_book("buch")["etag"]
+    overview_etag = catalog.overview_etag()
+
+    store.update_scene("buch", 0, {"text": "Haus"})
+    entry = catalog.get_book("buch")
+    assert entry["detail"]["scenes"][0]["text"] == "Haus"
+    assert entry["etag"] != etag
+    assert catalog.overview_etag() != overview_etag
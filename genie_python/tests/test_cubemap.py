@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules import cubemap as CM
+
+
+def _panorama(path, color):
+    Image.new("RGB", (64, 32), color).save(path)
+
+
+def test_faces_of_a_replaced_panorama_are_outdated(tmp_path):
+    (tmp_path / "book").mkdir()
+    image_file = "book/scene_0.png"
+    _panorama(tmp_path / image_file, "red")
+    assert not CM.is_up_to_date(tmp_path, image_file)
+
+    CM.generate_cubemap(tmp_path, image_file, face_size=8)
+    assert CM.is_up_to_date(tmp_path, image_file)
+
+    # finales Bild ersetzt die Vorschau, ist aber älter als die aus der Vorschau erzeugten Faces
+    _panorama(tmp_path / image_file, "blue")
+    face_mtime = (tmp_path / CM.face_path(image_file, "px")).stat().st_mtime_ns
+    os.utime(tmp_path / image_file, ns=(face_mtime - 10**9, face_mtime - 10**9))
+    assert not CM.is_up_to_date(tmp_path, image_file)
+
+    CM.generate_cubemap(tmp_path, image_file, face_size=8)
+    assert CM.is_up_to_date(tmp_path, image_file)
+
+
+@pytest.mark.parametrize("face", CM.FACES)
+def test_vectorized_conversion_matches_reference_sampler(face):
+    equirect = np.random.default_rng(0).random((32, 64, 3))
+    faces = CM.equirect_to_cubemap(equirect, 12)
+    assert faces[face].shape == (12, 12, 3)
+    assert np.abs(faces[face] - CM.reference_face(equirect, face, 12)).max() < 1e-4
+
+
+def test_integer_panorama_is_rounded_like_reference():
+    equirect = np.random.default_rng(1).integers(0, 256, size=(32, 64, 3), dtype=np.uint8)
+    faces = CM.equirect_to_cubemap(equirect, 12)
+    for face in CM.FACES:
+        assert faces[face].dtype == np.uint8
+        assert np.abs(faces[face].astype(np.float64) - CM.reference_face(equirect.astype(np.float64), face, 12)).max() <= 0.5 + 1e-3
@@ -0,0 +1,26 @@
+import pytest
+from PIL import Image
+
+from modules.image_derivatives import DerivativeStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    (tmp_path / "app" / "database" / "book").mkdir(parents=True)
+    Image.new("RGB", (64, 32), "red").save(tmp_path / "app" / "database" / "book" / "scene_0.png")
+    return DerivativeStore(tmp_path / "app" / "database", tmp_path / "app" / "cache", widths=[16, 32], preview_width=8)
+
+
+def test_derivative_is_built_in_cache_dir(store, tmp_path):
+    path = store.get("book/scene_0.png", 16)
+    assert path == (tmp_path / "app" / "cache" / "book" / "scene_0.w16.jpg").resolve()
+    with Image.open(path) as img:
+        assert img.width == 16
+
+
+@pytest.mark.parametrize("image_file", ["../../app/database/book/scene_0.png", "book/../../../app/database/book/scene_0.png"])
+def test_escaping_image_file_is_rejected(store, tmp_path, image_file):
+    with pytest.raises(FileNotFoundError):
+        store.get(image_file, 16)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["app"]
+    assert not (tmp_path / "app" / "cache").exists()
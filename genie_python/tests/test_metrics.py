@@ -0,0 +1,36 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import metrics as MT
+
+
+def _generation(name: str, reports: dict, barrier: threading.Barrier):
+    with MT.run_metrics() as registry:
+        barrier.wait()
+        MT.incr("scenes_total", book=name)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for future in [pool.submit(MT.in_run(MT.incr), "images_total", book=name) for _ in range(3)]:
+                future.result()
+        barrier.wait()
+    reports[name] = registry.report()["counters"]
+
+
+def test_concurrent_runs_get_separate_registries():
+    reports = {}
+    barrier = threading.Barrier(2)
+    threads = [threading.Thread(target=_generation, args=(name, reports, barrier)) for name in ("a", "b")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for name in ("a", "b"):
+        assert reports[name] == {f'images_total{{book="{name}"}}': 3, f'scenes_total{{book="{name}"}}': 1}
+
+
+def test_metrics_outside_a_run_only_reach_the_process_registry():
+    with MT.run_metrics() as registry:
+        pass
+    MT.incr("outside_total")
+    assert registry.report()["counters"] == {}
+    assert MT.get_registry().report()["counters"]["outside_total"] >= 1
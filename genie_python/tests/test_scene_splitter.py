@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+from modules import scene_deconstructor as SD
+from modules.llm_cache import LLMCache
+
+
+class FakeStream:
+    def __init__(self, deltas):
+        self.deltas = deltas
+
+    def __iter__(self):
+        for delta in self.deltas:
+            choice = SimpleNamespace(delta=SimpleNamespace(content=delta), finish_reason=None)
+            yield SimpleNamespace(usage=None, choices=[choice])
+
+    def close(self):
+        pass
+
+
+class FakeCompletions:
+    def __init__(self, stream_deltas, answer, finish_reason="stop"):
+        self.stream_deltas = stream_deltas
+        self.answer = answer
+        self.finish_reason = finish_reason
+        self.calls = []
+
+    def create(self, stream=False, **kwargs):
+        self.calls.append("stream" if stream else ("plain", kwargs.get("max_tokens")))
+        if stream:
+            return FakeStream(self.stream_deltas)
+        message = SimpleNamespace(content=self.answer)
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=message, finish_reason=self.finish_reason)])
+
+
+def _splitter(tmp_path, completions):
+    splitter = SD.SceneSplitterGPT(max_workers=1, cache=LLMCache(tmp_path))
+    splitter.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    splitter.MAX_OUTPUT_TOKENS = 5
+    return splitter
+
+
+def test_stream_stops_at_first_array(tmp_path):
+    completions = FakeCompletions(["[1,", " 3]", " because", " ..."], None)
+    assert _splitter(tmp_path, completions)._call_openai("chunk") == [1, 3]
+    assert completions.calls == ["stream"]
+
+
+def test_exhausted_budget_retries_chunk_without_streaming(tmp_path):
+    completions = FakeCompletions(["Let", " me", " think", " about", " it", " ..."], "[2]")
+    assert _splitter(tmp_path, completions)._call_openai("chunk") == [2]
+    assert completions.calls == ["stream", ("plain", 5)]
+
+
+def test_chunk_without_split_points_if_retry_runs_out_of_budget(tmp_path):
+    completions = FakeCompletions(["Let", " me", " think", " about", " it", " ..."], "Let me think", "length")
+    splitter = _splitter(tmp_path, completions)
+    assert splitter._call_openai("chunk") == []
+    assert completions.calls == ["stream", ("plain", 5)]
+    assert splitter.cache.get(splitter.cache.make_key(splitter.model, splitter.SYSTEM_PROMPT, "chunk")) is None
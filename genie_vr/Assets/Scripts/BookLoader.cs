@@ -30,6 +30,8 @@ public class BookLoader : MonoBehaviour
     private Material _skyboxMaterialInstance;
     private Coroutine _skyboxTransitionRoutine;
     private const float _skyboxTransitionDuration = 0.75f;
+    [Tooltip("Width of the panorama textures requested from the server (rounded up to the next available width)")]
+    [SerializeField] private int skyboxTextureWidth = 4096;
 
     [Header("Floor")]
     [SerializeField] private Renderer floorQuadRenderer;
@@ -74,6 +76,20 @@ public class BookLoader : MonoBehaviour
         public string text;
         public string image_prompt;
         public string image_file;
+        public SceneVisual visual;
+    }
+
+    /// <summary>
+    /// Image statistics precomputed by the server, colors as "#rrggbb"
+    /// </summary>
+    [Serializable]
+    public class SceneVisual
+    {
+        public string average_color;
+        public string dominant_color;
+        public string floor_color;
+        public float brightness;
+        public string phash;
     }
     
     private void Start()
@@ -284,7 +300,7 @@ public class BookLoader : MonoBehaviour
         // Show Skybox
         if (!string.IsNullOrEmpty(scene.image_file))
         {
-            StartCoroutine(FetchAndUpdateSkybox(scene.image_file));
+            StartCoroutine(FetchAndUpdateSkybox(scene));
         }
         else
         {
@@ -296,16 +312,19 @@ public class BookLoader : MonoBehaviour
     /// <summary>
     /// Fetches 360° panorama image from server and sets it as the skybox
     /// </summary>
-    /// <param name="imageFile">path of the image file on server</param>
+    /// <param name="scene">scene whose image should be shown</param>
     /// <returns></returns>
-    private IEnumerator FetchAndUpdateSkybox(string imageFile)
+    private IEnumerator FetchAndUpdateSkybox(Scene scene)
     {
+        string imageFile = scene.image_file;
+
         if (_skyboxMaterialInstance == null)
             yield break;
         if (_currentBook == null)
             yield break;
 
-        string url = $"{BaseUrl}/static/{imageFile}";
+        // compressed JPEG version instead of the full PNG
+        string url = $"{BaseUrl}/images/{imageFile}?width={skyboxTextureWidth}&format=jpeg";
 
         using (UnityWebRequest request = UnityWebRequestTexture.GetTexture(url))
         {
@@ -319,17 +338,22 @@ public class BookLoader : MonoBehaviour
             
             Texture2D tex = DownloadHandlerTexture.GetContent(request);
             
-            SetSkybox(tex);
+            SetSkybox(tex, scene.visual);
         }
     }
 
-    private void SetSkybox(Texture2D texture)
+    private void SetSkybox(Texture2D texture, SceneVisual visual)
     {
         Material mat = new Material(Shader.Find("Skybox/Panoramic"));
         mat.SetTexture("_MainTex", texture);
         mat.SetFloat("_Rotation", 90f);
         
-        Color col = CalculateFloorColor(texture);
+        // use floor color precomputed by the server, only scan pixels for books without image statistics
+        Color col;
+        if (visual == null || string.IsNullOrEmpty(visual.floor_color) || !ColorUtility.TryParseHtmlString(visual.floor_color, out col))
+        {
+            col = CalculateFloorColor(texture);
+        }
             
         SetSkybox(mat, col);
     }